@@ -2,7 +2,7 @@ import decimal
 import json
 
 # from django.contrib.postgres.fields import JSONField
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
@@ -13,6 +13,7 @@ from django_countries.fields import CountryField
 
 from shoptools.util import \
     get_shipping_module, get_vouchers_module, validate_options
+from shoptools.quotes import calculate_shipping
 
 
 # TODO
@@ -108,14 +109,41 @@ class ICart(object):
         """Delete all cart lines. """
         raise NotImplementedError()
 
+    def content_signature(self):
+        """Return a hashable signature of the cart's contents (items, options
+           and quantities), for use in cache keys. """
+        return tuple(sorted(
+            (line.ctype, line.item.pk,
+             json.dumps(line.options, sort_keys=True), line.quantity)
+            for line in self.get_lines()))
+
     @property
     def shipping_cost(self):
+        return calculate_shipping(self)
+
+    def resolve_shipping(self):
+        """Return the shipping module's resolution (available options,
+           effective selection and cost) for this cart, or None if the module
+           doesn't support it. """
         shipping_module = get_shipping_module()
-        if shipping_module:
-            return shipping_module.calculate(self)
-        return 0
+        if shipping_module and hasattr(shipping_module, 'resolve_shipping'):
+            return shipping_module.resolve_shipping(self)
+        return None
+
+    def save_shipping_option(self):
+        """Persist the effective shipping option picked by resolve_shipping,
+           if it differs from the stored one. Validation never writes, so
+           views call this once per request to coalesce the write. """
+        resolution = self.resolve_shipping()
+        if resolution and resolution.pending and \
+                hasattr(self, 'set_shipping_option'):
+            self.set_shipping_option(resolution.selected_id)
 
     def shipping_errors(self):
+        resolution = self.resolve_shipping()
+        if resolution:
+            return list(resolution.errors)
+
         shipping_module = get_shipping_module()
 
         if shipping_module and hasattr(shipping_module, 'available_options'):
@@ -156,23 +184,51 @@ class ICart(object):
 
     # TODO tidy up discount stuff - does it belong here?
     def calculate_discounts(self, include_shipping=True):
+        """Return (discounts, invalid_codes) from the vouchers module. The
+           result is memoized on the cart until the voucher codes, contents,
+           shipping option or currency change, since total, total_discount
+           and the voucher templates all ask for it. """
+
         voucher_module = get_vouchers_module()
-        if voucher_module:
-            return voucher_module.calculate_discounts(
-                self, self.get_voucher_codes(),
-                include_shipping=include_shipping)
-        return ([], None)
+        if not voucher_module:
+            return ([], None)
+
+        codes = list(self.get_voucher_codes())
+        if not codes:
+            return ([], [])
+
+        key = (tuple(sorted(codes)), self.content_signature(),
+               self.get_shipping_option()
+               if hasattr(self, 'get_shipping_option') else None,
+               self.get_currency() if hasattr(self, 'get_currency') else None,
+               include_shipping)
+        memo = getattr(self, '_discounts_memo', None)
+        if memo is None or memo[0] != key:
+            memo = (key, voucher_module.calculate_discounts(
+                self, codes, include_shipping=include_shipping))
+            self._discounts_memo = memo
+        return memo[1]
 
     @property
     def total_discount(self):
         discounts, invalid = self.calculate_discounts()
         return sum(d.amount for d in discounts)
 
-    def save_to(self, obj):
+    def save_to(self, obj, lines=None):
+        """Save this cart's lines (or the given lines, if they've already
+           been fetched), shipping option and discounts to obj. Return a list
+           of the discounts which couldn't be saved because their voucher has
+           been used up since the cart was validated. """
+
         assert isinstance(obj, AbstractOrder)
 
+        # stored totals are out of date until the lines and discounts have
+        # been saved
+        if hasattr(obj, 'clear_totals'):
+            obj.clear_totals()
+
         [l.delete() for l in obj.get_lines()]
-        for cart_line in self.get_lines():
+        for cart_line in (self.get_lines() if lines is None else lines):
             line = obj.get_line_cls()()
             line.parent_object = obj
             line.item = cart_line.item
@@ -184,19 +240,33 @@ class ICart(object):
 
         if hasattr(obj, 'set_shipping_option') and \
            hasattr(self, 'get_shipping_option'):
-            obj.set_shipping_option(self.get_shipping_option())
+            resolution = self.resolve_shipping()
+            if resolution and resolution.selected:
+                obj.set_shipping_option(resolution.selected_id)
+            else:
+                obj.set_shipping_option(self.get_shipping_option())
 
         # save valid discounts - TODO should this go here?
         # Do we need to subclass Cart as DiscountCart?
         # TODO create an interface - IDiscountable or something, rather than
         # tying it to checkout.Order
         from shoptools.checkout.models import Order
+        unavailable = []
         if isinstance(obj, Order):
             voucher_module = get_vouchers_module()
             vouchers = self.get_voucher_codes() if voucher_module else None
             if vouchers:
-                [d.delete() for d in obj.discount_set.all()]
-                voucher_module.save_discounts(obj, vouchers)
+                # release and reclaim voucher usage in one transaction, so
+                # resubmitting an order can't lose a voucher's last use
+                with transaction.atomic():
+                    [d.delete() for d in obj.discount_set.all()]
+                    saved, unavailable = \
+                        voucher_module.save_discounts(obj, vouchers)
+
+        if hasattr(obj, 'update_totals'):
+            obj.update_totals()
+
+        return unavailable
 
 
 class IShippable(object):
@@ -271,6 +341,16 @@ class ICartItem(object):
            stock. """
         return []
 
+    def get_shipping_weight(self):
+        """Weight of a single unit of this item in kg, used by rate table
+           shipping. """
+        return 0
+
+    def get_shipping_volume(self):
+        """Volume of a single unit of this item in m3, used by rate table
+           shipping. """
+        return 0
+
     def cart_description(self):
         """Describes the item in the checkout admin. Needed because it needs
            to store a description of the item as purchased, even if it is
@@ -394,8 +474,10 @@ class AbstractOrder(models.Model, ICart):
         """This method should always be used to get lines, rather than
            directly via orm. """
 
-        lines = self.get_line_cls().objects.filter(parent_object=self) \
-            .order_by('pk')
+        lines = self._prefetched_lines()
+        if lines is None:
+            lines = self.get_line_cls().objects.filter(parent_object=self) \
+                .order_by('pk')
         rv = []
         for line in lines:
             if line.item:
@@ -405,6 +487,16 @@ class AbstractOrder(models.Model, ICart):
                 rv.append(line)
         return rv
 
+    def _prefetched_lines(self):
+        """Return lines from a prefetch_related() of the reverse line
+           relation, sorted by pk, or None if they weren't prefetched. """
+        field = self.get_line_cls()._meta.get_field('parent_object')
+        cache_name = field.remote_field.get_accessor_name()
+        cache = getattr(self, '_prefetched_objects_cache', {})
+        if cache_name not in cache:
+            return None
+        return sorted(cache[cache_name], key=lambda line: line.pk)
+
     def empty(self):
         return not self.count()
 
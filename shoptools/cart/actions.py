@@ -1,4 +1,4 @@
-from shoptools.util import unpack_instance_key
+from shoptools.util import get_vouchers_module, unpack_instance_key
 
 
 def cart_action(params=[]):
@@ -98,8 +98,15 @@ def clear(cart, confirm):
 def set_voucher_codes(cart, codes=''):
     """Set voucher codes for a cart. No validation here - invalid codes
        will just be ignored, with an error message displayed on the cart
-       page. """
+       page - but the vouchers module may refuse new codes if there have been
+       too many invalid attempts. """
 
     codes = [c for c in map(str.strip, codes.split(',')) if c]
+
+    errors = None
+    vouchers_module = get_vouchers_module()
+    if vouchers_module and hasattr(vouchers_module, 'check_codes'):
+        codes, errors = vouchers_module.check_codes(cart, codes)
+
     cart.set_voucher_codes(codes)
-    return (True, None)
+    return (not errors, errors or None)
@@ -82,12 +82,13 @@ class SavedCart(AbstractOrder, IShippable):
     def get_line_cls(self):
         return SavedCartLine
 
-    def save_to(self, obj):
-        super(SavedCart, self).save_to(obj)
+    def save_to(self, obj, lines=None):
+        unavailable = super(SavedCart, self).save_to(obj, lines=lines)
 
         # link the order to the cart
         self.order_obj = obj
         self.save()
+        return unavailable
 
 
 class SavedCartLine(AbstractOrderLine):
@@ -50,8 +50,11 @@ class SessionCartLine(dict, ICartLine):
 
     @property
     def item(self):
-        instance, options = unpack_line_key(self.key)
-        return instance
+        # cache the instance on the line, since it's read several times per
+        # line (total, description, ctype, shipping etc)
+        if not hasattr(self, '_item'):
+            self._item, options = unpack_line_key(self.key)
+        return self._item
 
     options = property(lambda s: s['options'])
     quantity = property(lambda s: s['quantity'])
@@ -197,17 +200,34 @@ class SessionCart(ICart, IShippable):
         rv = []
         if self._data is None:
             return rv
+
+        # lines load their items, so reuse them until the contents change
+        signature = self.content_signature()
+        memo = getattr(self, '_lines_memo', None)
+        if memo and memo[0] == signature:
+            return list(memo[1])
+
         for line in self._data["lines"]:
             line = self.make_line_obj(line)
             if line.item:
                 rv.append(line)
-        return rv
+        self._lines_memo = (signature, rv)
+        return list(rv)
 
     def count(self):
         if self._data is None:
             return 0
         return sum(r['quantity'] for r in self._data["lines"])
 
+    def content_signature(self):
+        """Build the signature from the stored line keys, which already
+           encode each line's item and options, so it doesn't need to load
+           the items. """
+        if self._data is None:
+            return ()
+        return tuple(sorted((line['key'], line['quantity'])
+                            for line in self._data['lines']))
+
     def get_currency(self):
         regions_module = get_regions_module()
         if regions_module:
@@ -253,11 +273,12 @@ class SessionCart(ICart, IShippable):
             del self.request.session[self.session_key]
             self._data = None
 
-    def save_to(self, obj):
-        super(SessionCart, self).save_to(obj)
+    def save_to(self, obj, lines=None):
+        unavailable = super(SessionCart, self).save_to(obj, lines=lines)
 
         # link the order to the cart
         self.order_obj = obj
+        return unavailable
 
     # Private methods
     def _init_session_cart(self):
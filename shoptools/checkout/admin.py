@@ -1,14 +1,29 @@
-from datetime import date
+import os
+from datetime import date, timedelta
+from django.conf.urls import url
 from django.contrib import admin
-from django.http import HttpResponse
+from django.contrib.admin.views.main import ChangeList
+from django.core.exceptions import PermissionDenied
+from django.http import FileResponse, Http404
 from django import forms
+from django.db import models
+from django.db.models.functions import Concat
+from django.shortcuts import get_object_or_404
+from django.template.response import TemplateResponse
+try:
+    from django.urls import reverse
+except ImportError:
+    from django.core.urlresolvers import reverse
+from django.utils import timezone
 from django.utils.text import mark_safe
 
+from shoptools.exports import export_response
 from shoptools.util import get_payment_module, get_vouchers_module
 
-from .models import Order, OrderLine, Address
-from .export import generate_csv
-from .emails import send_dispatch_email
+from .models import \
+    Order, OrderLine, Address, ExportJob, DailySales, DailyItemSales
+from .emails import send_dispatch_emails
+from .sales import sale_date
 
 payment_mod = get_payment_module()
 payment_inlines = getattr(payment_mod, "get_checkout_inlines",
@@ -79,31 +94,53 @@ class AddOrderLineInline(admin.TabularInline):
         return OrderLine.objects.none()
 
 
+class OrderChangeList(ChangeList):
+    def get_results(self, request):
+        super(OrderChangeList, self).get_results(request)
+
+        # Annotate the shipping name and email on the current page only, so
+        # the queryset passed to actions (e.g. exports) stays plain. One join
+        # to the shipping address, which is unique per order.
+        shipping = models.FilteredRelation('addresses', condition=models.Q(
+            addresses__address_type=Address.TYPE_SHIPPING))
+        self.result_list = self.result_list.annotate(shipping=shipping) \
+            .annotate(shipping_name=Concat(
+                'shipping__first_name', models.Value(' '),
+                'shipping__last_name', output_field=models.CharField()),
+                shipping_email=models.F('shipping__email'))
+
+
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
     list_display = ('name', 'user', 'email', 'status',
                     'amount_paid', 'created', 'links')
+    list_select_related = ('user', )
     list_filter = ('status', 'created')
+    # avoid counting every order on each changelist page
+    show_full_result_count = False
     inlines = [
         AddressInline,
         OrderLineInline,
         AddOrderLineInline
     ] + voucher_inlines + payment_inlines
     save_on_top = True
-    search_fields = ('id', 'addresses__first_name', 'addresses__last_name',
-                     'addresses__email', 'addresses__phone',
-                     'addresses__address', 'addresses__city',
-                     'addresses__state', 'addresses__postcode',
-                     'addresses__suburb')
-    actions = ('csv_export', 'resend_dispatch_email')
+    # see get_search_results
+    search_fields = ('_search_text', )
+    actions = ('csv_export', 'mark_shipped', 'resend_dispatch_email')
     readonly_fields = ('created', 'checkout_completed', '_shipping_cost', 'id',
-                       'amount_paid', 'currency_code', )
+                       'amount_paid', 'currency_code', '_subtotal',
+                       '_discount_total', '_total', )
+
+    def mark_shipped(self, request, queryset):
+        shipped = queryset.mark_shipped()
+        self.message_user(request, "Orders shipped: %s" % len(shipped))
+    mark_shipped.short_description = 'Mark selected orders as shipped'
 
     def resend_dispatch_email(self, request, queryset):
-        for order in queryset:
-            send_dispatch_email(order)
+        orders = list(queryset.with_addresses().prefetch_related('lines'))
+        send_dispatch_emails(orders)
 
-        self.message_user(request, "Emails sent: %s" % queryset.count())
+        self.message_user(request, "Emails sent: %s" % len(orders))
 
     # def dispatch(self, request, order_pk):
     #     return
@@ -116,21 +153,166 @@ class OrderAdmin(admin.ModelAdmin):
 
     def csv_export(self, request, queryset):
         filename = 'order_export_' + date.today().strftime('%Y%m%d')
+        return export_response(
+            self, request, queryset,
+            'shoptools.checkout.export.stream_csv', filename)
 
-        # response = HttpResponse()
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = \
-            "attachment; filename=%s.csv" % filename
-
-        generate_csv(queryset, response)
-        return response
+    def save_related(self, request, form, formsets, change):
+        super(OrderAdmin, self).save_related(request, form, formsets, change)
+        # lines or discounts may have changed
+        if form.instance._total is not None:
+            form.instance.update_totals()
 
     def has_add_permission(self, request):
         return False
 
     def get_queryset(self, request):
-        return Order.objects.all().order_by('-created')
+        return Order.objects.order_by('-created')
+
+    def get_changelist(self, request, **kwargs):
+        return OrderChangeList
+
+    def get_search_results(self, request, queryset, search_term):
+        """Match each word against the order's denormalised search text (or
+           the order number), rather than joining addresses for each search
+           field, so there are no duplicate rows to remove. """
+
+        for word in search_term.lower().split():
+            q = models.Q(_search_text__contains=word)
+            if word.isdigit():
+                q |= models.Q(pk=int(word))
+            queryset = queryset.filter(q)
+        return queryset, False
+
+    def name(self, obj):
+        return obj.shipping_name or ''
+
+    def email(self, obj):
+        return obj.shipping_email or ''
 
     def links(self, obj):
         return mark_safe(
             '<a href="%s">View order</a>' % obj.get_absolute_url())
+
+
+@admin.register(ExportJob)
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = ('name', 'created', 'user', 'status', 'progress',
+                    'rows', 'download')
+    list_filter = ('status', )
+    fields = ('name', 'created', 'user', 'status', 'total', 'rows',
+              'started', 'finished', 'download', 'error')
+    readonly_fields = fields
+
+    def has_add_permission(self, request):
+        return False
+
+    def get_queryset(self, request):
+        qs = super(ExportJobAdmin, self).get_queryset(request)
+        return qs.select_related('user').defer('pks')
+
+    def changelist_view(self, request, extra_context=None):
+        ExportJob.fail_stale()
+        return super(ExportJobAdmin, self).changelist_view(
+            request, extra_context)
+
+    def progress(self, obj):
+        return '%s%%' % obj.progress
+
+    def download(self, obj):
+        if obj.status != ExportJob.STATUS_COMPLETE or not obj.file:
+            return ''
+        return mark_safe('<a href="%s">Download</a>' % reverse(
+            'admin:checkout_exportjob_download', args=(obj.pk, )))
+
+    def download_view(self, request, pk):
+        job = get_object_or_404(ExportJob, pk=pk,
+                                status=ExportJob.STATUS_COMPLETE)
+        if not self.has_change_permission(request, job) or not job.file:
+            raise Http404
+        filename = os.path.basename(job.file.name)
+        return FileResponse(job.file.open('rb'), as_attachment=True,
+                            filename=filename)
+
+    def get_urls(self):
+        return [
+            url(r'^(\d+)/download/$',
+                self.admin_site.admin_view(self.download_view),
+                name='checkout_exportjob_download'),
+        ] + super(ExportJobAdmin, self).get_urls()
+
+
+class SalesReportForm(forms.Form):
+    since = forms.DateField(required=False)
+    until = forms.DateField(required=False)
+    currency_code = forms.ChoiceField(required=False, label='Currency')
+
+    def __init__(self, *args, **kwargs):
+        super(SalesReportForm, self).__init__(*args, **kwargs)
+        codes = DailySales.objects.order_by('currency_code') \
+                                  .values_list('currency_code', flat=True) \
+                                  .distinct()
+        self.fields['currency_code'].choices = \
+            [('', 'All')] + [(code, code) for code in codes]
+
+
+@admin.register(DailySales)
+class DailySalesAdmin(admin.ModelAdmin):
+    list_display = ('date', 'currency_code', 'orders', 'subtotal',
+                    'discounts', 'shipping', 'total')
+    fields = list_display
+    readonly_fields = fields
+    list_filter = ('currency_code', )
+    date_hierarchy = 'date'
+    change_list_template = 'admin/checkout/dailysales/change_list.html'
+
+    def has_add_permission(self, request):
+        return False
+
+    def report_view(self, request):
+        """Sales and top selling items per day for a range of days (by
+           default the last 30), read only from the summary tables. """
+
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+
+        form = SalesReportForm(request.GET or None)
+        data = form.cleaned_data if form.is_valid() else {}
+        until = data.get('until') or sale_date(timezone.now())
+        since = data.get('since') or until - timedelta(days=30)
+
+        filters = {'date__gte': since, 'date__lte': until}
+        if data.get('currency_code'):
+            filters['currency_code'] = data['currency_code']
+
+        days = DailySales.objects.filter(**filters)
+        sums = dict((name, models.Sum(name)) for name in (
+            'orders', 'subtotal', 'discounts', 'shipping', 'total'))
+        totals = days.order_by('currency_code') \
+                     .values('currency_code').annotate(**sums)
+        items = DailyItemSales.objects.filter(**filters) \
+            .values('currency_code', 'item_content_type', 'item_object_id') \
+            .annotate(description=models.Max('description'),
+                      quantity=models.Sum('quantity'),
+                      total=models.Sum('total')) \
+            .order_by('-total')[:20]
+
+        context = dict(
+            self.admin_site.each_context(request),
+            opts=self.model._meta,
+            title='Sales report',
+            form=form,
+            since=since,
+            until=until,
+            days=days,
+            totals=totals,
+            items=items,
+        )
+        return TemplateResponse(
+            request, 'admin/checkout/dailysales/report.html', context)
+
+    def get_urls(self):
+        return [
+            url(r'^report/$', self.admin_site.admin_view(self.report_view),
+                name='checkout_dailysales_report'),
+        ] + super(DailySalesAdmin, self).get_urls()
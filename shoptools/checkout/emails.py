@@ -26,3 +26,17 @@ def send_dispatch_email(order):
         email_module.send_email('dispatch', TEMPLATE_DIR, [order.email],
                                 related_obj=order, fail_silently=True,
                                 order=order)
+
+
+def send_dispatch_emails(orders):
+    """Send dispatch emails for a batch of orders, over one connection if the
+       email module supports it. """
+
+    if email_module and hasattr(email_module, 'send_emails'):
+        email_module.send_emails(
+            'dispatch', TEMPLATE_DIR,
+            [([order.email], order, {'order': order}) for order in orders],
+            fail_silently=True)
+    else:
+        for order in orders:
+            send_dispatch_email(order)
@@ -6,6 +6,8 @@ import csv
 
 from django.db import models
 
+from shoptools.exports import Echo
+
 
 def getval(obj, getter):
     """Gets a value from an object, using a getter which
@@ -30,13 +32,13 @@ ORDER_FIELDS = (
     ('Created', lambda o: o.created.strftime('%d/%m/%Y %H:%M')),
     ('Status', 'get_status_display'),
     ('Invoice Number', 'invoice_number'),
-    ('Delivery Name', 'name'),
-    ('Delivery Address', 'address'),
-    ('Delivery Postcode', 'postcode'),
-    ('Delivery City', 'city'),
-    ('Delivery State', 'state'),
-    ('Delivery Country', 'country'),
-    ('Delivery Email', 'email'),
+    ('Delivery Name', 'shipping_address.name'),
+    ('Delivery Address', 'shipping_address.address'),
+    ('Delivery Postcode', 'shipping_address.postcode'),
+    ('Delivery City', 'shipping_address.city'),
+    ('Delivery State', 'shipping_address.state'),
+    ('Delivery Country', 'shipping_address.country.name'),
+    ('Delivery Email', 'shipping_address.email'),
     ('Subtotal', 'subtotal'),
     ('Shipping Cost', 'shipping_cost'),
     ('Discounts', 'total_discount'),
@@ -49,8 +51,34 @@ LINE_FIELDS = (
 )
 
 
-def generate_csv(qs, file_object):
-    csvfile = csv.writer(file_object)
+def export_orders(qs, chunk_size=500):
+    """Iterate over the orders in qs, in order, with their lines, addresses
+       and discounts prefetched chunk_size orders at a time, so memory use
+       doesn't grow with the number of orders. """
+
+    from .models import OrderLine
+
+    lines = OrderLine.objects.order_by('pk').prefetch_related('item')
+    prefetch = [models.Prefetch('lines', queryset=lines)]
+    if hasattr(qs.model, 'discount_set'):
+        prefetch.append('discount_set')
+
+    pks = list(qs.values_list('pk', flat=True))
+    for i in range(0, len(pks), chunk_size):
+        chunk = pks[i:i + chunk_size]
+        orders = qs.model.objects.filter(pk__in=chunk).with_addresses() \
+                                 .prefetch_related(*prefetch)
+        orders = dict((order.pk, order) for order in orders)
+        for pk in chunk:
+            if pk in orders:
+                yield orders[pk]
+
+
+def stream_csv(qs, chunk_size=500):
+    """Yield lines of CSV for the orders in qs, e.g. for a
+       StreamingHttpResponse. """
+
+    csvfile = csv.writer(Echo())
 
     header = [f[0] for f in ORDER_FIELDS]
 
@@ -58,12 +86,12 @@ def generate_csv(qs, file_object):
     lines_max = qs.annotate(line_count=models.Count('lines'))\
                   .aggregate(lines_max=models.Max('line_count'))['lines_max']
 
-    for i in range(1, lines_max + 1):
+    for i in range(1, (lines_max or 0) + 1):
         header += [(f[0] + ' (%s)' % i) for f in LINE_FIELDS]
 
-    csvfile.writerow(header)
+    yield csvfile.writerow(header)
 
-    for obj in qs:
+    for obj in export_orders(qs, chunk_size):
         row = []
         for name, getter in ORDER_FIELDS:
             row.append(getval(obj, getter))
@@ -72,4 +100,9 @@ def generate_csv(qs, file_object):
             for name, getter in LINE_FIELDS:
                 row.append(getval(line, getter))
 
-        csvfile.writerow(row)
+        yield csvfile.writerow(row)
+
+
+def generate_csv(qs, file_object):
+    for line in stream_csv(qs):
+        file_object.write(line)
@@ -20,6 +20,9 @@ class OrderMetaForm(forms.Form):
 
     save_details = forms.BooleanField(initial=False, required=False)
     billing_is_shipping = forms.BooleanField(initial=True, required=False)
+    # identifies this submission of the form, so repeats are ignored
+    checkout_key = forms.RegexField(r'^[0-9a-f]{32}$', required=False,
+                                    widget=forms.HiddenInput)
 
 
 class AddressForm(forms.ModelForm):
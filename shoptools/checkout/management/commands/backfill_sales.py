@@ -0,0 +1,83 @@
+import datetime
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from shoptools.checkout.models import \
+    Order, OrderLine, DailySales, DailyItemSales
+from shoptools.checkout.sales import sale_date, summarise, add_summaries
+
+
+def date_arg(value):
+    date = parse_date(value)
+    if date is None:
+        raise ValueError(value)
+    return date
+
+
+def start_of_day(date):
+    dt = datetime.datetime.combine(date, datetime.time.min)
+    if settings.USE_TZ:
+        dt = timezone.make_aware(dt)
+    return dt
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the daily sales summaries from paid orders, for days '
+            'before --until (by default, today). Later days are left to be '
+            'maintained as orders are paid.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument(
+            '--since', type=date_arg,
+            help="First day to rebuild (YYYY-MM-DD), by default the first "
+                 "sale")
+        parser.add_argument(
+            '--until', type=date_arg,
+            help="Day to stop before (YYYY-MM-DD), by default today")
+
+    def handle(self, chunk_size, since, until, **options):
+        until = until or sale_date(timezone.now())
+        started = time.time()
+        processed = 0
+        last_pk = 0
+
+        qs = Order.objects.filter(status__gte=Order.STATUS_PAID,
+                                  checkout_completed__isnull=False,
+                                  checkout_completed__lt=start_of_day(until))
+        summaries = (DailySales.objects.filter(date__lt=until),
+                     DailyItemSales.objects.filter(date__lt=until))
+        if since:
+            qs = qs.filter(checkout_completed__gte=start_of_day(since))
+            summaries = [s.filter(date__gte=since) for s in summaries]
+
+        with transaction.atomic():
+            for summary in summaries:
+                summary.delete()
+
+        lines = OrderLine.objects.order_by('pk')
+        qs = qs.order_by('pk').prefetch_related(
+            models.Prefetch('lines', queryset=lines))
+        if hasattr(Order, 'discount_set'):
+            # for orders without stored totals
+            qs = qs.prefetch_related('discount_set')
+
+        # walk the table in primary key ranges, adding each chunk's totals to
+        # the summaries with one UPDATE or INSERT per summary row
+        while True:
+            orders = list(qs.filter(pk__gt=last_pk)[:chunk_size])
+            if not orders:
+                break
+            last_pk = orders[-1].pk
+            processed += len(orders)
+            add_summaries(*summarise(orders))
+
+        elapsed = time.time() - started
+        self.stdout.write(
+            'Summarised %s paid orders in %.1fs (%.0f orders/s)' % (
+                processed, elapsed, processed / elapsed if elapsed else 0))
@@ -0,0 +1,65 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import models
+
+from shoptools.checkout.models import Order, OrderLine
+
+
+class Command(BaseCommand):
+    help = ("Check orders' stored subtotal, discount total and total "
+            "against their lines, shipping cost and discounts.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument(
+            '--fix', action='store_true', default=False,
+            help="Store the correct totals for orders which don't match")
+        parser.add_argument(
+            '--include-missing', action='store_true', default=False,
+            help="Also check (and with --fix, store) totals for orders "
+                 "which don't have them stored yet")
+
+    def handle(self, chunk_size, fix, include_missing, **options):
+        started = time.time()
+        checked = mismatched = 0
+        last_pk = 0
+
+        lines = OrderLine.objects.order_by('pk').prefetch_related('item')
+        qs = Order.objects.order_by('pk').prefetch_related(
+            models.Prefetch('lines', queryset=lines))
+        if hasattr(Order, 'discount_set'):
+            qs = qs.prefetch_related('discount_set')
+        if not include_missing:
+            qs = qs.filter(_total__isnull=False)
+
+        while True:
+            orders = list(qs.filter(pk__gt=last_pk)[:chunk_size])
+            if not orders:
+                break
+            last_pk = orders[-1].pk
+            checked += len(orders)
+
+            for order in orders:
+                stored = (order._subtotal, order._discount_total,
+                          order._total)
+                subtotal, discount_total, total = order.calculate_totals()
+                if stored == (subtotal, discount_total, total):
+                    continue
+
+                mismatched += 1
+                if options['verbosity'] > 1:
+                    self.stdout.write(
+                        '%s: stored %s, calculated %s' % (
+                            order, stored,
+                            (subtotal, discount_total, total)))
+                if fix:
+                    Order.objects.filter(pk=order.pk).update(
+                        _subtotal=subtotal, _discount_total=discount_total,
+                        _total=total)
+
+        elapsed = time.time() - started
+        self.stdout.write(
+            '%s of %s orders had incorrect totals%s (%.1fs)' % (
+                mismatched, checked, ', fixed' if fix and mismatched else '',
+                elapsed))
@@ -0,0 +1,182 @@
+import gzip
+import json
+import os
+import time
+from datetime import timedelta
+
+from django.apps import apps
+from django.core import serializers
+from django.core.management.base import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, transaction
+from django.utils import timezone
+
+from shoptools.checkout.models import Order, skip_search_text
+
+
+class Command(BaseCommand):
+    help = ('Archive to JSON Lines files, then delete, unpaid orders and '
+            'saved carts which have been abandoned for more than --days '
+            'days.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=90)
+        parser.add_argument('--chunk-size', type=int, default=100)
+        parser.add_argument(
+            '--output-dir', default='.',
+            help="Directory to write the archive files to")
+        parser.add_argument(
+            '--gzip', action='store_true', default=False,
+            help="Compress the archive files")
+        parser.add_argument(
+            '--sleep', type=float, default=0,
+            help="Seconds to pause between chunks, to spread the load")
+        parser.add_argument(
+            '--skip-orders', action='store_true', default=False)
+        parser.add_argument(
+            '--skip-carts', action='store_true', default=False)
+        parser.add_argument(
+            '--dry-run', action='store_true', default=False,
+            help="Count the rows which would be purged without changing "
+                 "anything")
+
+    def handle(self, days, skip_orders, skip_carts, **options):
+        self.options = options
+        self.cutoff = timezone.now() - timedelta(days=days)
+        self.stamp = timezone.now().strftime('%Y%m%d-%H%M%S')
+
+        if not skip_orders:
+            related = ['lines', 'addresses']
+            if hasattr(Order, 'discount_set'):
+                related.append('discount_set')
+            qs = Order.objects.filter(
+                status__in=(Order.STATUS_NEW, Order.STATUS_PAYMENT_FAILED),
+                created__lt=self.cutoff)
+            self.purge('orders', qs, related, self.delete_orders)
+
+        if not skip_carts and apps.is_installed('shoptools.cart'):
+            from shoptools.cart.models import SavedCart
+
+            # carts whose owner hasn't logged in or added anything since the
+            # cutoff
+            qs = SavedCart.objects.filter(
+                models.Q(user__last_login__lt=self.cutoff) |
+                models.Q(user__last_login__isnull=True),
+                created__lt=self.cutoff) \
+                .exclude(savedcartline__created__gte=self.cutoff)
+            self.purge('carts', qs, ['savedcartline_set'],
+                       lambda qs: qs.delete())
+
+    def purge(self, name, qs, related, delete):
+        """Archive and delete the rows matching qs, walking the table in
+           primary key ranges of --chunk-size rows. Each chunk is read and
+           deleted in its own short transaction, rechecking qs so rows which
+           have changed since (e.g. orders paid) are kept, then archived once
+           that has committed. """
+
+        chunk_size = self.options['chunk_size']
+        dry_run = self.options['dry_run']
+        started = time.time()
+        purged = skipped = 0
+        last_pk = 0
+        archive = None
+
+        qs = qs.order_by('pk')
+        try:
+            while True:
+                pks = list(qs.filter(pk__gt=last_pk)
+                             .values_list('pk', flat=True)[:chunk_size])
+                if not pks:
+                    break
+                last_pk = pks[-1]
+
+                if dry_run:
+                    purged += len(pks)
+                    continue
+
+                if archive is None:
+                    archive = self.open_archive(name)
+                with transaction.atomic():
+                    objs = list(qs.filter(pk__in=pks).select_for_update()
+                                  .prefetch_related(*related))
+                    records = [self.serialize(obj, related) for obj in objs]
+                    deleted = self.delete_chunk(qs, objs, delete)
+
+                # only archive the rows once their deletion has committed
+                archive.writelines(
+                    record for obj, record in zip(objs, records)
+                    if obj.pk in deleted)
+                archive.flush()
+                purged += len(deleted)
+                skipped += len(objs) - len(deleted)
+
+                if self.options['sleep']:
+                    time.sleep(self.options['sleep'])
+        finally:
+            if archive is not None:
+                archive.close()
+
+        elapsed = time.time() - started
+        self.stdout.write(
+            '%s %s abandoned %s in %.1fs (%.0f rows/s)%s' % (
+                'Would purge' if dry_run else 'Archived and deleted', purged,
+                name, elapsed, purged / elapsed if elapsed else 0,
+                ', skipped %s protected' % skipped if skipped else ''))
+        if archive is not None:
+            self.stdout.write('Archived %s to %s' % (name, archive.name))
+
+    def delete_chunk(self, qs, objs, delete):
+        """Delete a chunk of rows, returning the set of deleted pks. If any
+           row is protected by a PROTECT foreign key, fall back to deleting
+           the rows one at a time and leave the protected ones in place. """
+
+        pks = set(obj.pk for obj in objs)
+        try:
+            with transaction.atomic():
+                delete(qs.filter(pk__in=pks))
+            return pks
+        except models.ProtectedError:
+            pass
+
+        deleted = set()
+        for pk in sorted(pks):
+            try:
+                with transaction.atomic():
+                    delete(qs.filter(pk=pk))
+                deleted.add(pk)
+            except models.ProtectedError as e:
+                if self.options['verbosity'] > 1:
+                    self.stdout.write('%s: protected by %s' % (
+                        pk, ', '.join(str(obj)
+                                      for obj in e.protected_objects)))
+        return deleted
+
+    def delete_orders(self, qs):
+        # don't rebuild each order's search text as its addresses are
+        # deleted, just before it's deleted too. Discounts are deleted
+        # individually by the collector, so their receiver releases the
+        # vouchers' usage.
+        with skip_search_text():
+            qs.delete()
+
+    def serialize(self, obj, related):
+        """Return obj as a line of JSON, in the format of Django's python
+           serializer with its related rows nested under their model
+           labels. """
+
+        record = serializers.serialize('python', [obj])[0]
+        for name in related:
+            rows = list(getattr(obj, name).all())
+            if rows:
+                record[rows[0]._meta.label_lower] = [
+                    dict(pk=row['pk'], **row['fields'])
+                    for row in serializers.serialize('python', rows)]
+        return json.dumps(record, cls=DjangoJSONEncoder) + '\n'
+
+    def open_archive(self, name):
+        os.makedirs(self.options['output_dir'], exist_ok=True)
+        path = os.path.join(self.options['output_dir'],
+                            '%s-%s.jsonl' % (name, self.stamp))
+        if self.options['gzip']:
+            return gzip.open(path + '.gz', 'wt', encoding='utf-8')
+        return open(path, 'w', encoding='utf-8')
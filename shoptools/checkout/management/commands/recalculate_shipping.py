@@ -0,0 +1,135 @@
+import decimal
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models, transaction
+from django.http import HttpRequest
+
+from shoptools import settings as shoptools_settings
+from shoptools.checkout.models import Order, OrderLine, Address
+from shoptools.quotes import calculate_shipping
+from shoptools.util import get_shipping_module, get_regions_module
+
+
+CENTS = decimal.Decimal('0.01')
+
+
+class Command(BaseCommand):
+    help = ('Recalculate the shipping cost of unpaid orders using the '
+            'shipping module, e.g. after changing shipping costs. Where the '
+            'module picks a different option, it is stored with its cost.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument(
+            '--dry-run', action='store_true', default=False,
+            help="Report the changes without saving them")
+
+    def handle(self, chunk_size, dry_run, **options):
+        if not get_shipping_module():
+            raise CommandError('No shipping module is configured')
+
+        self.requests = {}
+        self.region_ids = {}
+        started = time.time()
+        checked = changed = 0
+        last_pk = 0
+
+        lines = OrderLine.objects.order_by('pk').prefetch_related('item')
+        qs = Order.objects.filter(status__lt=Order.STATUS_PAID) \
+                          .order_by('pk') \
+                          .prefetch_related(
+                              models.Prefetch('lines', queryset=lines),
+                              'addresses')
+
+        # walk the table in primary key ranges so only one chunk of orders
+        # is held in memory at a time
+        while True:
+            orders = list(qs.filter(pk__gt=last_pk)[:chunk_size])
+            if not orders:
+                break
+            last_pk = orders[-1].pk
+            checked += len(orders)
+
+            updates = {}
+            for order in orders:
+                order.set_request(self.get_request(order))
+                stored = (order._shipping_option, order._shipping_cost)
+                # the cost is for the option the shipping module picks, which
+                # may not be the stored one (or none, if it's no longer
+                # valid), so that option is stored with it
+                resolution = order.resolve_shipping()
+                if resolution:
+                    order._shipping_option = resolution.selected_id
+                cost = decimal.Decimal(calculate_shipping(order)) \
+                    .quantize(CENTS)
+                if (order._shipping_option, cost) != stored:
+                    updates[order.pk] = (order._shipping_option, cost)
+                    if options['verbosity'] > 1:
+                        self.stdout.write('%s: %s -> %s' % (
+                            order, stored, updates[order.pk]))
+
+            if updates and not dry_run:
+                self.save(updates)
+            changed += len(updates)
+
+        elapsed = time.time() - started
+        self.stdout.write(
+            '%s %s of %s unpaid orders in %.1fs (%.0f orders/s)' % (
+                'Would update' if dry_run else 'Updated', changed, checked,
+                elapsed, checked / elapsed if elapsed else 0))
+
+    def save(self, updates):
+        """Write a chunk of new options and costs in a single UPDATE
+           statement. Orders which have been paid since they were read are
+           left alone. """
+
+        def new_value(index, output_field):
+            return models.Case(
+                *[models.When(pk=pk, then=models.Value(values[index]))
+                  for pk, values in updates.items()],
+                output_field=output_field)
+
+        def new_cost():
+            return new_value(1, models.DecimalField())
+
+        with transaction.atomic():
+            # stored totals (null if not stored yet) include shipping
+            Order.objects.filter(pk__in=list(updates),
+                                 status__lt=Order.STATUS_PAID) \
+                         .update(_shipping_option=new_value(
+                                     0, models.PositiveSmallIntegerField()),
+                                 _shipping_cost=new_cost(),
+                                 _total=models.F('_subtotal') + new_cost() -
+                                 models.F('_discount_total'))
+
+    def get_request(self, order):
+        """Return a request carrying the region for the order's shipping
+           country, since shipping modules look up the region from the
+           request. Requests are shared between orders in the same region. """
+
+        country_code = None
+        for address in order.addresses.all():
+            if address.address_type == Address.TYPE_SHIPPING:
+                country_code = address.country.code
+
+        region_id = self.get_region_id(country_code)
+        if region_id not in self.requests:
+            request = HttpRequest()
+            if region_id:
+                request.COOKIES[shoptools_settings.LOCATION_COOKIE_NAME] = \
+                    json.dumps({'region_id': region_id,
+                                'country_code': country_code})
+            self.requests[region_id] = request
+        return self.requests[region_id]
+
+    def get_region_id(self, country_code):
+        regions_module = get_regions_module()
+        if not regions_module or \
+                not hasattr(regions_module, 'get_region_id'):
+            return None
+        if country_code not in self.region_ids:
+            self.region_ids[country_code] = \
+                regions_module.get_region_id(country_code)
+        return self.region_ids[country_code]
@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shoptools.checkout.models import ExportJob
+from shoptools.exports import run_job
+
+
+class Command(BaseCommand):
+    help = ('Run pending CSV export jobs started from the admin, oldest '
+            'first.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('job_ids', nargs='*', type=int,
+                            help="Only run these jobs")
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, job_ids, chunk_size, **options):
+        stale = ExportJob.fail_stale()
+        if stale:
+            self.stderr.write('Marked %s timed out jobs as failed' % stale)
+
+        qs = ExportJob.objects.filter(status=ExportJob.STATUS_PENDING) \
+                              .order_by('pk')
+        if job_ids:
+            qs = qs.filter(pk__in=job_ids)
+
+        for job in qs:
+            started = time.time()
+            try:
+                if not run_job(job, chunk_size=chunk_size):
+                    # started by another runner in the meantime
+                    continue
+            except Exception as e:
+                self.stderr.write('%s failed: %s' % (job, e))
+                continue
+
+            elapsed = time.time() - started
+            self.stdout.write(
+                '%s: %s rows to %s in %.1fs (%.0f rows/s)' % (
+                    job, job.rows, job.file.name, elapsed,
+                    job.rows / elapsed if elapsed else 0))
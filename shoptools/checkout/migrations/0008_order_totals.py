@@ -0,0 +1,28 @@
+# Generated by Django 2.1.15 on 2026-10-19 05:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0007_auto_20180808_0200'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='_discount_total',
+            field=models.DecimalField(db_column='discount_total', decimal_places=2, editable=False, max_digits=8, null=True, verbose_name='discount total'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='_subtotal',
+            field=models.DecimalField(db_column='subtotal', decimal_places=2, editable=False, max_digits=8, null=True, verbose_name='subtotal'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='_total',
+            field=models.DecimalField(db_column='total', decimal_places=2, editable=False, max_digits=8, null=True, verbose_name='total'),
+        ),
+    ]
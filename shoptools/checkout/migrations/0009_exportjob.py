@@ -0,0 +1,42 @@
+# Generated by Django 2.1.15 on 2026-10-19 05:47
+
+from django.conf import settings
+import django.core.files.storage
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('checkout', '0008_order_totals'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('name', models.CharField(max_length=255)),
+                ('exporter', models.CharField(max_length=255)),
+                ('query', models.BinaryField()),
+                ('compress', models.BooleanField(default=False)),
+                ('status', models.PositiveSmallIntegerField(choices=[(1, 'Pending'), (2, 'Running'), (3, 'Complete'), (4, 'Failed')], default=1)),
+                ('total', models.PositiveIntegerField(blank=True, null=True)),
+                ('rows', models.PositiveIntegerField(default=0)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('file', models.FileField(blank=True, default='', storage=django.core.files.storage.FileSystemStorage(), upload_to='')),
+                ('error', models.TextField(blank=True, default='')),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ('-created',),
+            },
+        ),
+    ]
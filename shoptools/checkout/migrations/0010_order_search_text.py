@@ -0,0 +1,61 @@
+# Generated by Django 2.1.15 on 2026-10-19 05:48
+
+import itertools
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+SEARCH_FIELDS = ('first_name', 'last_name', 'email', 'phone', 'address',
+                 'suburb', 'city', 'state', 'postcode')
+
+
+def populate_search_text(apps, schema_editor):
+    Order = apps.get_model('checkout', 'Order')
+    Address = apps.get_model('checkout', 'Address')
+
+    rows = Address.objects.order_by('order', 'pk') \
+                          .values_list('order', *SEARCH_FIELDS) \
+                          .iterator()
+    for order_id, values in itertools.groupby(rows, lambda row: row[0]):
+        text = ' '.join(str(value) for row in values for value in row[1:])
+        Order.objects.filter(pk=order_id).update(_search_text=text.lower())
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute(
+        'CREATE INDEX checkout_order_search_text_trgm ON checkout_order '
+        'USING gin (search_text gin_trgm_ops)')
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'DROP INDEX IF EXISTS checkout_order_search_text_trgm')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0009_exportjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='_search_text',
+            field=models.TextField(blank=True, db_column='search_text', default='', editable=False, verbose_name='search text'),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='created',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(populate_search_text,
+                             migrations.RunPython.noop),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.15 on 2026-10-19 05:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0010_order_search_text'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='checkout_key',
+            field=models.CharField(editable=False, max_length=32, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 2.1.15 on 2026-10-19 05:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('checkout', '0011_order_checkout_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyItemSales',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('currency_code', models.CharField(max_length=4)),
+                ('item_object_id', models.PositiveIntegerField()),
+                ('description', models.CharField(blank=True, default='', max_length=255)),
+                ('quantity', models.IntegerField(default=0)),
+                ('total', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('item_content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+            ],
+            options={
+                'verbose_name_plural': 'daily item sales',
+                'ordering': ('-date', 'currency_code'),
+            },
+        ),
+        migrations.CreateModel(
+            name='DailySales',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('currency_code', models.CharField(max_length=4)),
+                ('orders', models.PositiveIntegerField(default=0)),
+                ('subtotal', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('discounts', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('shipping', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('total', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+            ],
+            options={
+                'verbose_name_plural': 'daily sales',
+                'ordering': ('-date', 'currency_code'),
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailysales',
+            unique_together={('date', 'currency_code')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailyitemsales',
+            unique_together={('date', 'currency_code', 'item_content_type', 'item_object_id')},
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.1.15 on 2026-10-19 06:25
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def fail_pending_jobs(apps, schema_editor):
+    # their rows were stored as a pickled query, which is dropped
+    ExportJob = apps.get_model('checkout', 'ExportJob')
+    ExportJob.objects.filter(status__in=(1, 2)).update(
+        status=4, finished=django.utils.timezone.now(),
+        error='Export must be started again after upgrading')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0012_sales_summaries'),
+    ]
+
+    operations = [
+        migrations.RunPython(fail_pending_jobs, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='exportjob',
+            name='query',
+        ),
+        migrations.AddField(
+            model_name='exportjob',
+            name='pks',
+            field=models.TextField(default='[]'),
+            preserve_default=False,
+        ),
+    ]
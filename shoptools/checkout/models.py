@@ -1,7 +1,17 @@
 import decimal
-
-from django.db import models
+import gzip
+import itertools
+import json
+import os
+import threading
+import traceback
+from contextlib import contextmanager
+
+from django.core.files.storage import FileSystemStorage
+from django.db import models, transaction, IntegrityError
+from django.dispatch import receiver
 from django.utils import timezone
+from django.utils.module_loading import import_string
 try:
     from django.urls import reverse
 except ImportError:
@@ -10,14 +20,62 @@ except ImportError:
 from shoptools import settings as shoptools_settings
 from shoptools.abstractions.models import \
     AbstractOrderLine, AbstractOrder, AbstractAddress
-from shoptools.util import make_uuid, get_shipping_module
+from shoptools.util import \
+    make_uuid, get_shipping_module, get_vouchers_module
+from shoptools.quotes import calculate_shipping
 
-from .emails import send_email_receipt, send_dispatch_email
+from .emails import \
+    send_email_receipt, send_dispatch_email, send_dispatch_emails
 from .signals import \
     checkout_post_payment_pre_success, checkout_post_payment_post_success, \
     checkout_post_payment_pre_failure, checkout_post_payment_post_failure
 
 
+CENTS = decimal.Decimal('0.01')
+TOTAL_FIELDS = ('_subtotal', '_discount_total', '_total')
+# address fields the admin searches, see Order._search_text
+SEARCH_FIELDS = ('first_name', 'last_name', 'email', 'phone', 'address',
+                 'suburb', 'city', 'state', 'postcode')
+
+
+def make_search_text(addresses):
+    return ' '.join(str(getattr(address, field))
+                    for address in addresses
+                    for field in SEARCH_FIELDS).lower()
+
+
+class OrderQuerySet(models.QuerySet):
+    def with_addresses(self):
+        """Fetch every order's addresses in one extra query, so the address
+           accessors (shipping_address, name etc) don't query per order. """
+
+        return self.prefetch_related('addresses')
+
+    def mark_shipped(self):
+        """Mark the paid orders in this queryset as shipped and dispatched,
+           in a single UPDATE, and send their dispatch emails once the
+           transaction commits. Orders which had already been dispatched are
+           left alone. Return a list of the orders which were shipped. """
+
+        # Read the pks before updating, since the queryset may be filtered on
+        # the status being changed (e.g. the changelist's status filter). The
+        # rows are locked so concurrent calls can't both ship an order.
+        pks = list(self.filter(
+            status__in=(Order.STATUS_PAID, Order.STATUS_SHIPPED),
+            dispatched__isnull=True).values_list('pk', flat=True))
+        with transaction.atomic():
+            qs = Order.objects.filter(pk__in=pks, dispatched__isnull=True)
+            pks = list(qs.select_for_update().values_list('pk', flat=True))
+            Order.objects.filter(pk__in=pks).update(
+                status=Order.STATUS_SHIPPED, dispatched=timezone.now())
+        orders = list(Order.objects.filter(pk__in=pks)
+                                   .with_addresses().prefetch_related('lines'))
+
+        if orders:
+            transaction.on_commit(lambda: send_dispatch_emails(orders))
+        return orders
+
+
 class Order(AbstractOrder):
 
     # values are integers so we can do numeric comparison, i.e.
@@ -46,7 +104,7 @@ class Order(AbstractOrder):
         max_length=1, editable=False,
         default=shoptools_settings.DEFAULT_CURRENCY_SYMBOL)
 
-    created = models.DateTimeField(default=timezone.now)
+    created = models.DateTimeField(default=timezone.now, db_index=True)
     checkout_completed = models.DateTimeField(blank=True, null=True)
     status = models.PositiveSmallIntegerField(
         choices=STATUS_CHOICES, default=STATUS_NEW)
@@ -65,10 +123,45 @@ class Order(AbstractOrder):
         blank=True, null=True, editable=False,
         db_column='shipping_option', verbose_name='shipping option')
 
+    # Totals are stored once the order's lines and discounts have been saved
+    # (see update_totals), and read from here afterwards. Null until then.
+    _subtotal = models.DecimalField(
+        max_digits=8, decimal_places=2, null=True, editable=False,
+        db_column='subtotal', verbose_name='subtotal')
+    _discount_total = models.DecimalField(
+        max_digits=8, decimal_places=2, null=True, editable=False,
+        db_column='discount_total', verbose_name='discount total')
+    _total = models.DecimalField(
+        max_digits=8, decimal_places=2, null=True, editable=False,
+        db_column='total', verbose_name='total')
+
     dispatched = models.DateTimeField(null=True, editable=False)
+    # key of the checkout form submission which last saved the order, so
+    # repeated submissions can be detected, see checkout.views.checkout
+    checkout_key = models.CharField(max_length=32, null=True, unique=True,
+                                    editable=False)
     success_page_viewed = models.BooleanField(default=False, editable=False)
 
+    # Lower-cased text of the order's addresses, kept up to date by the
+    # Address receivers below, so the admin can search one column without
+    # joining addresses. Trigram indexed on PostgreSQL.
+    _search_text = models.TextField(
+        blank=True, default='', editable=False, db_column='search_text',
+        verbose_name='search text')
+
+    objects = OrderQuerySet.as_manager()
+
     def save(self, *args, **kwargs):
+        # totals are only written by update_totals and clear_totals, and the
+        # search text by the Address receivers, so a stale instance can't
+        # overwrite them
+        if not self._state.adding and not kwargs.get('update_fields') and \
+                not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in TOTAL_FIELDS and
+                f.name != '_search_text']
+
         super(Order, self).save(*args, **kwargs)
         if self.status == self.STATUS_SHIPPED and not self.dispatched:
             # Only send the email if the update actually does something,
@@ -81,12 +174,26 @@ class Order(AbstractOrder):
         self.request = request
 
     def set_shipping_option(self, option_id):
-        """Saves the provided option_id to this order."""
+        """Saves the provided option_id to this order, or the option the
+           shipping module picks in its place, with its cost. """
         self._shipping_option = option_id
-        shipping_module = get_shipping_module()
-        if shipping_module:
-            self._shipping_cost = shipping_module.calculate(self)
+        if get_shipping_module():
+            # store the option that's priced (none if option_id isn't
+            # valid), so the two can't disagree
+            resolution = self.resolve_shipping()
+            if resolution:
+                self._shipping_option = resolution.selected_id
+            self._shipping_cost = calculate_shipping(self)
         self.save()
+        self.clear_totals()
+
+    def update_quantity(self, *args, **kwargs):
+        self.clear_totals()
+        return super(Order, self).update_quantity(*args, **kwargs)
+
+    def update_options(self, *args, **kwargs):
+        self.clear_totals()
+        return super(Order, self).update_options(*args, **kwargs)
 
     def get_shipping_option(self):
         return self._shipping_option
@@ -124,25 +231,93 @@ class Order(AbstractOrder):
     def __str__(self):
         return 'Order #%s' % (self.pk)
 
+    @property
+    def subtotal(self):
+        if self._subtotal is not None:
+            return self._subtotal
+        return super(Order, self).subtotal
+
+    @property
+    def total_discount(self):
+        if self._discount_total is not None:
+            return self._discount_total
+        return self.calculate_totals()[1]
+
     @property
     def total(self):
-        return self.subtotal + decimal.Decimal(self.shipping_cost) \
-            - self.total_discount
+        if self._total is not None:
+            return self._total
+        return self.calculate_totals()[2]
+
+    def calculate_totals(self):
+        """Return (subtotal, discount_total, total) calculated from the
+           order's lines, shipping cost and discounts. """
+
+        subtotal = super(Order, self).subtotal
+        discount_total = decimal.Decimal(
+            sum(d.amount for d in self.discount_set.all())
+            if hasattr(self, 'discount_set') else 0)
+        total = subtotal + decimal.Decimal(self.shipping_cost) \
+            - discount_total
+        return tuple(decimal.Decimal(value).quantize(CENTS)
+                     for value in (subtotal, discount_total, total))
+
+    def update_totals(self):
+        """Calculate and store the order's totals. Called once lines and
+           discounts have been saved, or after they're changed. """
+
+        self._subtotal, self._discount_total, self._total = \
+            self.calculate_totals()
+        Order.objects.filter(pk=self.pk).update(
+            _subtotal=self._subtotal, _discount_total=self._discount_total,
+            _total=self._total)
+
+    def clear_totals(self):
+        """Stop using the stored totals until update_totals is next called,
+           e.g. when lines are changed. """
+
+        if self._total is not None:
+            self._subtotal = self._discount_total = self._total = None
+            Order.objects.filter(pk=self.pk).update(
+                _subtotal=None, _discount_total=None, _total=None)
 
     def get_line_cls(self):
         return OrderLine
 
+    def _get_addresses(self):
+        """Return the order's addresses by type, from a prefetch_related() of
+           addresses if there was one, otherwise from a single query which is
+           reused until the order's addresses are saved or deleted. """
+
+        cache = getattr(self, '_prefetched_objects_cache', {})
+        if 'addresses' in cache:
+            return dict((address.address_type, address)
+                        for address in cache['addresses'])
+        if getattr(self, '_addresses', None) is None:
+            self._addresses = {}
+            if self.pk is not None:
+                # through the related manager, so each address has this
+                # order cached and clear_order_addresses can clear the memo
+                self._addresses = dict(
+                    (address.address_type, address)
+                    for address in self.addresses.all())
+        return self._addresses
+
+    def clear_addresses(self):
+        """Forget the addresses read by _get_addresses. """
+
+        self._addresses = None
+        getattr(self, '_prefetched_objects_cache', {}).pop('addresses', None)
+
+    def refresh_from_db(self, *args, **kwargs):
+        self.clear_addresses()
+        return super(Order, self).refresh_from_db(*args, **kwargs)
+
     def get_address(self, address_type, create=False):
-        params = {
-            'address_type': address_type,
-            'order': self,
-        }
-        try:
-            return Address.objects.get(**params)
-        except Address.DoesNotExist:
-            if create:
-                return Address(**params)
-        return None
+        address = self._get_addresses().get(address_type)
+        if address is None and create:
+            return Address(address_type=address_type, order=self)
+        return address
 
     @property
     def shipping_address(self):
@@ -161,7 +336,10 @@ class Order(AbstractOrder):
         # means the discounts are set and won't change if the voucher is
         # removed or modified
         if hasattr(self, 'discount_set'):
-            return self.discount_set.all(), None
+            discounts = self.discount_set.all()
+            if hasattr(discounts, 'select_vouchers'):
+                discounts = discounts.select_vouchers()
+            return discounts, None
         return ([], None)
 
     # payment integration:
@@ -190,8 +368,27 @@ class Order(AbstractOrder):
             self.checkout_completed = timezone.now()
             needs_save = True
 
-        if needs_save:
-            self.save()
+        # the transaction argument hides the module
+        from django.db.transaction import atomic
+        from .sales import record_sale
+
+        with atomic():
+            # Claim the change to paid with a conditional UPDATE, so if the
+            # same payment is handled concurrently (e.g. a notification and
+            # the return view) only one adds the order to the sales
+            # summaries. They're updated in the same transaction as the
+            # status, so can't miss a paid order.
+            unpaid = Order.objects.filter(pk=self.pk,
+                                          status__lt=self.STATUS_PAID)
+            newly_paid = complete and bool(unpaid.update(
+                status=self.STATUS_PAID,
+                checkout_completed=self.checkout_completed))
+
+            if needs_save:
+                self.save()
+
+            if newly_paid:
+                record_sale(self)
 
         if complete:
             send_email_receipt(self)
@@ -213,6 +410,12 @@ class Order(AbstractOrder):
         self.status = self.STATUS_PAYMENT_FAILED
         self.save()
 
+        # give back any voucher usage claimed for this order
+        vouchers_module = get_vouchers_module()
+        if vouchers_module and hasattr(vouchers_module, 'release_discounts'):
+            vouchers_module.release_discounts(self)
+            self.update_totals()
+
         checkout_post_payment_post_failure.send(
             sender=Order, transaction=transaction, interactive=interactive,
             status_updated=status_updated)
@@ -276,3 +479,255 @@ class Address(AbstractAddress):
     def __str__(self):
         return '%s address for %s' % (
             self.get_address_type_display(), self.order)
+
+
+class ExportJob(models.Model):
+    """A CSV export run outside the request, see shoptools.exports. The
+       rows to export are stored as their model (content_type) and a JSON
+       list of their primary keys, and exporter is the import path of a
+       function which takes the queryset and yields lines of CSV, e.g.
+       shoptools.checkout.export.stream_csv. """
+
+    STATUS_PENDING = 1
+    STATUS_RUNNING = 2
+    STATUS_COMPLETE = 3
+    STATUS_FAILED = 4
+
+    STATUS_CHOICES = [
+        (STATUS_PENDING, "Pending"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_COMPLETE, "Complete"),
+        (STATUS_FAILED, "Failed"),
+    ]
+
+    created = models.DateTimeField(default=timezone.now)
+    user = models.ForeignKey('auth.User', null=True, blank=True,
+                             on_delete=models.SET_NULL)
+    name = models.CharField(max_length=255)
+    content_type = models.ForeignKey('contenttypes.ContentType',
+                                     on_delete=models.CASCADE)
+    exporter = models.CharField(max_length=255)
+    pks = models.TextField()
+    compress = models.BooleanField(default=False)
+
+    status = models.PositiveSmallIntegerField(
+        choices=STATUS_CHOICES, default=STATUS_PENDING)
+    total = models.PositiveIntegerField(null=True, blank=True)
+    rows = models.PositiveIntegerField(default=0)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    # always local, since it's written a chunk at a time
+    file = models.FileField(storage=FileSystemStorage(), blank=True,
+                            default='')
+    error = models.TextField(blank=True, default='')
+
+    class Meta:
+        ordering = ('-created', )
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def progress(self):
+        """Percentage of rows written. """
+        if self.status == self.STATUS_COMPLETE:
+            return 100
+        if not self.total:
+            return 0
+        return min(100, 100 * self.rows // self.total)
+
+    def get_queryset(self):
+        model = self.content_type.model_class()
+        return model._default_manager.filter(pk__in=json.loads(self.pks))
+
+    @classmethod
+    def fail_stale(cls):
+        """Mark jobs which have been running for longer than
+           SHOPTOOLS_EXPORT_TIMEOUT seconds as failed, e.g. because the
+           process running them was killed. Return the number marked. """
+
+        timeout = shoptools_settings.EXPORT_TIMEOUT
+        if not timeout:
+            return 0
+        now = timezone.now()
+        return cls.objects.filter(
+            status=cls.STATUS_RUNNING,
+            started__lt=now - timezone.timedelta(seconds=timeout)) \
+            .update(status=cls.STATUS_FAILED, finished=now,
+                    error='Timed out after %s seconds' % timeout)
+
+    def claim(self):
+        """Mark a pending job as running. Return False if it's already been
+           started, e.g. by another runner. """
+
+        started = timezone.now()
+        if not ExportJob.objects.filter(pk=self.pk,
+                                        status=self.STATUS_PENDING) \
+                                .update(status=self.STATUS_RUNNING,
+                                        started=started):
+            return False
+        self.status = self.STATUS_RUNNING
+        self.started = started
+        return True
+
+    def run(self, chunk_size=500):
+        """Write the export to a file under MEDIA_ROOT, chunk_size rows at a
+           time, recording the number of rows written after each chunk. The
+           file is written under a temporary name and only set on the job
+           once it's complete. """
+
+        name = os.path.join(
+            shoptools_settings.EXPORT_DIR, '%s_%s.csv%s' % (
+                self.name, make_uuid().hex[:8],
+                '.gz' if self.compress else ''))
+        path = self.file.storage.path(name)
+
+        opener = gzip.open if self.compress else open
+        try:
+            qs = self.get_queryset()
+            self.total = qs.count()
+            ExportJob.objects.filter(pk=self.pk).update(total=self.total)
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with opener(path + '.part', 'wt', encoding='utf-8',
+                        newline='') as f:
+                lines = iter(import_string(self.exporter)(qs))
+                # header
+                for line in itertools.islice(lines, 1):
+                    f.write(line)
+                while True:
+                    chunk = list(itertools.islice(lines, chunk_size))
+                    if not chunk:
+                        break
+                    f.write(''.join(chunk))
+                    self.rows += len(chunk)
+                    ExportJob.objects.filter(pk=self.pk).update(
+                        rows=self.rows)
+            os.replace(path + '.part', path)
+        except Exception:
+            if os.path.exists(path + '.part'):
+                os.remove(path + '.part')
+            self.status = self.STATUS_FAILED
+            self.error = traceback.format_exc()
+            self.finished = timezone.now()
+            self.save()
+            raise
+
+        self.file.name = name
+        self.status = self.STATUS_COMPLETE
+        self.finished = timezone.now()
+        self.save()
+
+
+class SalesSummary(models.Model):
+    """Base for the sales summary tables, which are added to as orders are
+       paid (see shoptools.checkout.sales) so reports needn't aggregate
+       orders. Rebuild them with ./manage.py backfill_sales """
+
+    date = models.DateField()
+    currency_code = models.CharField(max_length=4)
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def add(cls, keys, counts, values=None):
+        """Add counts to the row identified by keys, creating it if need be,
+           and set values on it. The sums are F() expressions, so concurrent
+           updates aren't lost. """
+
+        values = values or {}
+        updates = dict((name, models.F(name) + value)
+                       for name, value in counts.items())
+        updates.update(values)
+        if cls.objects.filter(**keys).update(**updates):
+            return
+
+        fields = dict(keys, **counts)
+        fields.update(values)
+        try:
+            with transaction.atomic():
+                cls.objects.create(**fields)
+        except IntegrityError:
+            # created concurrently
+            cls.objects.filter(**keys).update(**updates)
+
+
+class DailySales(SalesSummary):
+    orders = models.PositiveIntegerField(default=0)
+    subtotal = models.DecimalField(max_digits=12, decimal_places=2,
+                                   default=0)
+    discounts = models.DecimalField(max_digits=12, decimal_places=2,
+                                    default=0)
+    shipping = models.DecimalField(max_digits=12, decimal_places=2,
+                                   default=0)
+    total = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    class Meta:
+        ordering = ('-date', 'currency_code')
+        unique_together = ('date', 'currency_code')
+        verbose_name_plural = 'daily sales'
+
+    def __str__(self):
+        return '%s %s' % (self.date, self.currency_code)
+
+
+class DailyItemSales(SalesSummary):
+    item_content_type = models.ForeignKey('contenttypes.ContentType',
+                                          on_delete=models.CASCADE)
+    item_object_id = models.PositiveIntegerField()
+    # the latest description, so reports needn't look the item up
+    description = models.CharField(max_length=255, blank=True, default='')
+    quantity = models.IntegerField(default=0)
+    total = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    class Meta:
+        ordering = ('-date', 'currency_code')
+        unique_together = ('date', 'currency_code', 'item_content_type',
+                           'item_object_id')
+        verbose_name_plural = 'daily item sales'
+
+    def __str__(self):
+        return '%s %s %s' % (self.date, self.currency_code, self.description)
+
+
+@receiver(models.signals.post_delete, sender=ExportJob)
+def delete_export_file(sender, instance, **kwargs):
+    if instance.file:
+        instance.file.delete(save=False)
+
+
+@receiver(models.signals.post_save, sender=Address)
+@receiver(models.signals.post_delete, sender=Address)
+def clear_order_addresses(sender, instance, **kwargs):
+    # the order the address was assigned from may have read its addresses
+    # already, so make it read them again
+    if Address._meta.get_field('order').is_cached(instance):
+        instance.order.clear_addresses()
+
+
+_search_text = threading.local()
+
+
+@contextmanager
+def skip_search_text():
+    """Don't update orders' search text when their addresses are saved or
+       deleted within the block, e.g. while deleting the orders too. """
+
+    skip = getattr(_search_text, 'skip', False)
+    _search_text.skip = True
+    try:
+        yield
+    finally:
+        _search_text.skip = skip
+
+
+@receiver(models.signals.post_save, sender=Address)
+@receiver(models.signals.post_delete, sender=Address)
+def update_search_text(sender, instance, **kwargs):
+    if getattr(_search_text, 'skip', False):
+        return
+    text = make_search_text(Address.objects.filter(order_id=instance.order_id))
+    Order.objects.filter(pk=instance.order_id).update(_search_text=text)
+    if Address._meta.get_field('order').is_cached(instance):
+        instance.order._search_text = text
@@ -0,0 +1,72 @@
+"""
+Incrementally maintained sales summaries. Each paid order is added to the
+DailySales row for the day it was paid and its currency, and each of its
+lines to the DailyItemSales row for that day, currency and item, so reports
+read a row per day rather than aggregating every order.
+
+Order.transaction_succeeded calls record_sale when an order is paid, and
+./manage.py backfill_sales rebuilds past days from the orders.
+"""
+
+from collections import OrderedDict
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import DailySales, DailyItemSales
+
+
+def sale_date(dt):
+    """Return the (local) date of a datetime. """
+    if timezone.is_aware(dt):
+        dt = timezone.localtime(dt)
+    return dt.date()
+
+
+def summarise(orders):
+    """Return the summary counts for some paid orders, as two dicts mapping
+       DailySales and DailyItemSales keys to their counts. Orders should have
+       their lines prefetched. """
+
+    days = OrderedDict()
+    items = OrderedDict()
+    for order in orders:
+        day = {'date': sale_date(order.checkout_completed),
+               'currency_code': order.currency_code}
+        counts = days.setdefault(tuple(sorted(day.items())), {
+            'orders': 0, 'subtotal': 0, 'discounts': 0, 'shipping': 0,
+            'total': 0})
+        counts['orders'] += 1
+        counts['subtotal'] += order.subtotal
+        counts['discounts'] += order.total_discount
+        counts['shipping'] += order.shipping_cost
+        counts['total'] += order.total
+
+        for line in order.lines.all():
+            key = dict(day, item_content_type_id=line.item_content_type_id,
+                       item_object_id=line.item_object_id)
+            counts = items.setdefault(tuple(sorted(key.items())), {
+                'quantity': 0, 'total': 0, 'description': ''})
+            counts['quantity'] += line.quantity
+            counts['total'] += line.total or 0
+            counts['description'] = line.description[:255]
+
+    return days, items
+
+
+def add_summaries(days, items):
+    """Add counts returned by summarise to the summary tables, with one
+       UPDATE (or INSERT) per row. """
+
+    with transaction.atomic():
+        for key, counts in days.items():
+            DailySales.add(dict(key), counts)
+        for key, counts in items.items():
+            counts = dict(counts)
+            values = {'description': counts.pop('description')}
+            DailyItemSales.add(dict(key), counts, values)
+
+
+def record_sale(order):
+    """Add a newly paid order to the summaries. """
+    add_summaries(*summarise([order]))
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+The checkout's view of the cart for one request: its lines, validation
+errors, shipping resolution and totals. Validation runs per-line checks and
+resolves shipping, and the totals depend on both, so the cart and checkout
+views work them out once here and pass the result to the forms, the templates
+(as checkout) and save_to, rather than asking the cart again each time.
+"""
+
+from django.utils.functional import cached_property
+
+from shoptools.util import \
+    get_regions_module, get_shipping_module, get_vouchers_module
+
+
+class CheckoutState(object):
+    def __init__(self, request, cart):
+        self.request = request
+        self.cart = cart
+
+        self.lines = cart.get_lines()
+        self.count = sum(line.quantity for line in self.lines)
+        # also resolves shipping, so this comes before cart.resolve_shipping
+        self.errors = cart.get_errors()
+        self.shipping = cart.resolve_shipping()
+
+    @property
+    def empty(self):
+        return not self.lines
+
+    @property
+    def is_valid(self):
+        return bool(self.count) and not self.errors
+
+    @cached_property
+    def currency(self):
+        return self.cart.get_currency()
+
+    @cached_property
+    def subtotal(self):
+        return self.cart.subtotal
+
+    @cached_property
+    def shipping_cost(self):
+        return self.cart.shipping_cost
+
+    @cached_property
+    def total_discount(self):
+        return self.cart.total_discount
+
+    @cached_property
+    def total(self):
+        return self.cart.total
+
+    @cached_property
+    def shipping_countries(self):
+        from .views import available_countries
+        return available_countries(self.cart)
+
+    def get_context(self):
+        """Return template context for the cart and the regions, shipping and
+           vouchers modules. """
+
+        ctx = {
+            'cart': self.cart,
+            'cart_errors': self.errors,
+            'checkout': self,
+        }
+
+        region_module = get_regions_module()
+        if region_module:
+            context = region_module.get_context(self.request)
+            if context:
+                ctx.update(context)
+
+        shipping_module = get_shipping_module()
+        if shipping_module:
+            context = shipping_module.get_context(self.cart)
+            if context:
+                ctx.update(context)
+
+        vouchers_module = get_vouchers_module()
+        if vouchers_module:
+            context = vouchers_module.get_context(self.cart)
+            if context:
+                ctx.update(context)
+
+        return ctx
+
+    def save_to(self, obj):
+        """Save the validated lines to obj, see ICart.save_to. """
+        return self.cart.save_to(obj, lines=self.lines)
+
+
+def get_checkout_state(request, cart):
+    """Return the CheckoutState for the cart, creating it the first time it's
+       asked for during the request. """
+
+    state = getattr(request, '_checkout_state', None)
+    if state is None or state.cart is not cart:
+        state = request._checkout_state = CheckoutState(request, cart)
+    return state
@@ -1,4 +1,28 @@
-from django.test import TestCase
+import gzip
+import json
+import os
+import re
+import shutil
+import tempfile
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.http import HttpResponseRedirect
+from django.utils import timezone
+from django.test import TestCase, TransactionTestCase
+try:
+    from django.urls import reverse
+except ImportError:
+    from django.core.urlresolvers import reverse
+
+from shoptools.contrib.catalogue.models import Product
+from shoptools.contrib.regions.models import Currency, Region, Country
+from shoptools.contrib.shipping.models import Option, ShippingOption
+
+from .models import \
+    Order, OrderLine, Address, ExportJob, DailySales, DailyItemSales
 
 
 class CheckoutTestCase(TestCase):
@@ -7,3 +31,637 @@ class CheckoutTestCase(TestCase):
 
     def test_sample(self):
         self.assertEqual(1, 1)
+
+
+def create_order(product, quantity=1, shipping_option=None, **kwargs):
+    order = Order.objects.create(**kwargs)
+    OrderLine.objects.create(parent_object=order, item=product,
+                             quantity=quantity)
+    Address.objects.create(order=order, address_type=Address.TYPE_SHIPPING,
+                           address='1 Queen St', city='Auckland',
+                           postcode='1010', country='NZ')
+    if shipping_option:
+        Order.objects.filter(pk=order.pk).update(
+            _shipping_option=shipping_option.pk)
+    return order
+
+
+class RecalculateShippingTestCase(TestCase):
+    def setUp(self):
+        currency = Currency.objects.create(code='NZD', symbol='$')
+        region = Region.objects.create(name='NZ', currency=currency)
+        Region.objects.create(name='Other', currency=currency,
+                              is_default=True)
+        Country.objects.create(region=region, country='NZ')
+        self.shipping_option = ShippingOption.objects.create(
+            option=Option.objects.create(name='Standard'), region=region,
+            cost=10)
+        self.product = Product.objects.create(name='Widget', price=20,
+                                              shipping_cost=0)
+
+    def test_recalculate(self):
+        unpaid = create_order(self.product,
+                              shipping_option=self.shipping_option)
+        paid = create_order(self.product,
+                            shipping_option=self.shipping_option,
+                            status=Order.STATUS_PAID)
+
+        out = StringIO()
+        call_command('recalculate_shipping', dry_run=True, stdout=out)
+        self.assertIn('Would update 1 of 1', out.getvalue())
+        unpaid.refresh_from_db()
+        self.assertEqual(unpaid.shipping_cost, 0)
+
+        call_command('recalculate_shipping', chunk_size=1, stdout=out)
+        unpaid.refresh_from_db()
+        paid.refresh_from_db()
+        self.assertEqual(unpaid.shipping_cost, Decimal('10.00'))
+        self.assertEqual(paid.shipping_cost, 0)
+
+    def test_option_stored_with_cost(self):
+        # no option stored, so the shipping module picks one
+        order = create_order(self.product)
+
+        call_command('recalculate_shipping', stdout=StringIO())
+        order.refresh_from_db()
+        self.assertEqual((order.get_shipping_option(), order.shipping_cost),
+                         (self.shipping_option.pk, Decimal('10.00')))
+
+
+class OrderTotalsTestCase(TestCase):
+    def setUp(self):
+        self.product = Product.objects.create(name='Widget', price=20,
+                                              shipping_cost=0)
+
+    def test_totals(self):
+        order = create_order(self.product, quantity=2)
+        Order.objects.filter(pk=order.pk).update(_shipping_cost=5)
+        order = Order.objects.get(pk=order.pk)
+        self.assertIsNone(order._total)
+        self.assertEqual(order.total, Decimal('45.00'))
+
+        order.update_totals()
+        order = Order.objects.get(pk=order.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(order.subtotal, Decimal('40.00'))
+            self.assertEqual(order.total_discount, 0)
+            self.assertEqual(order.total, Decimal('45.00'))
+
+        # saving a stale instance doesn't overwrite the stored totals
+        stale = Order.objects.get(pk=order.pk)
+        order.add(self.product)
+        self.assertIsNone(Order.objects.get(pk=order.pk)._total)
+        order.update_totals()
+        stale.save()
+        self.assertEqual(Order.objects.get(pk=order.pk).total,
+                         Decimal('65.00'))
+
+    def test_check_command(self):
+        order = create_order(self.product)
+        order.update_totals()
+        create_order(self.product)
+        Order.objects.filter(pk=order.pk).update(_total=1)
+
+        out = StringIO()
+        call_command('check_order_totals', stdout=out)
+        self.assertIn('1 of 1 orders had incorrect totals', out.getvalue())
+
+        call_command('check_order_totals', fix=True, include_missing=True,
+                     stdout=out)
+        self.assertEqual(
+            Order.objects.filter(_total=Decimal('20.00')).count(), 2)
+
+
+class ExportTestCase(TestCase):
+    def setUp(self):
+        self.product = Product.objects.create(name='Widget', price=20,
+                                              shipping_cost=0)
+
+    def export(self, chunk_size):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from .export import stream_csv
+
+        with CaptureQueriesContext(connection) as queries:
+            rows = list(stream_csv(Order.objects.order_by('pk'),
+                                   chunk_size=chunk_size))
+        return rows, len(queries)
+
+    def test_export(self):
+        for i in range(3):
+            create_order(self.product, quantity=i + 1)
+        rows, queries = self.export(chunk_size=10)
+        self.assertEqual(len(rows), 4)
+        self.assertIn('Auckland', rows[1])
+        self.assertIn('Widget', rows[1])
+
+        # queries per chunk, not per order
+        for i in range(3):
+            create_order(self.product)
+        rows, more_queries = self.export(chunk_size=10)
+        self.assertEqual(len(rows), 7)
+        self.assertEqual(queries, more_queries)
+
+
+class AddressAccessorsTestCase(TestCase):
+    def setUp(self):
+        product = Product.objects.create(name='Widget', price=20,
+                                         shipping_cost=0)
+        self.order = create_order(product)
+        Address.objects.filter(order=self.order).update(
+            first_name='Jo', last_name='Bloggs', email='jo@example.com')
+
+    def test_memoized(self):
+        order = Order.objects.get(pk=self.order.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(order.name, 'Jo Bloggs')
+            self.assertEqual(order.email, 'jo@example.com')
+            # falls back to the shipping address
+            self.assertEqual(order.billing_address, order.shipping_address)
+
+        # saving an address assigned from the order clears its memo
+        Address.objects.create(order=order,
+                               address_type=Address.TYPE_BILLING,
+                               city='Wellington', country='NZ')
+        self.assertEqual(order.billing_address.city, 'Wellington')
+
+        # as does deleting an address it read itself
+        order.billing_address.delete()
+        self.assertEqual(order.billing_address.city, 'Auckland')
+
+    def test_with_addresses(self):
+        with self.assertNumQueries(2):
+            orders = list(Order.objects.with_addresses())
+            self.assertEqual(orders[0].name, 'Jo Bloggs')
+            self.assertEqual(orders[0].billing_address.city, 'Auckland')
+
+
+class ExportJobTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        product = Product.objects.create(name='Widget', price=20,
+                                         shipping_cost=0)
+        for i in range(3):
+            create_order(product)
+
+    def test_run(self):
+        from shoptools.exports import start_export
+
+        with self.settings(MEDIA_ROOT=self.media_root):
+            job = start_export(Order.objects.all(),
+                               'shoptools.checkout.export.stream_csv',
+                               'orders', compress=True)
+            out = StringIO()
+            call_command('run_export_jobs', chunk_size=2, stdout=out)
+            self.assertIn('3 rows', out.getvalue())
+
+            job.refresh_from_db()
+            self.assertEqual(job.status, ExportJob.STATUS_COMPLETE)
+            self.assertEqual((job.total, job.rows, job.progress),
+                             (3, 3, 100))
+            with gzip.open(job.file.path, 'rt') as f:
+                self.assertEqual(len(f.readlines()), 4)
+
+            # jobs only run once
+            call_command('run_export_jobs', stdout=out)
+            self.assertEqual(out.getvalue().count(': 3 rows to'), 1)
+
+            path = job.file.path
+            job.delete()
+            self.assertFalse(os.path.exists(path))
+
+    def test_failure(self):
+        from shoptools.exports import start_export
+
+        pks = Order.objects.order_by('pk').values_list('pk', flat=True)
+        job = start_export(Order.objects.filter(pk__in=pks[:2]),
+                           'shoptools.checkout.export.stream_csv', 'orders')
+        self.assertEqual(job.get_queryset().count(), 2)
+
+        # the job fails, rather than being left running, if its rows can't
+        # be fetched
+        ExportJob.objects.filter(pk=job.pk).update(pks='[')
+        err = StringIO()
+        with self.settings(MEDIA_ROOT=self.media_root):
+            call_command('run_export_jobs', stdout=StringIO(), stderr=err)
+        self.assertIn('orders failed', err.getvalue())
+        job.refresh_from_db()
+        self.assertEqual(job.status, ExportJob.STATUS_FAILED)
+        self.assertIn('JSONDecodeError', job.error)
+
+    def test_fail_stale(self):
+        from shoptools.exports import start_export
+
+        job = start_export(Order.objects.all(),
+                           'shoptools.checkout.export.stream_csv', 'orders')
+        self.assertTrue(job.claim())
+        self.assertEqual(ExportJob.fail_stale(), 0)
+
+        # as if the process running it was killed hours ago
+        ExportJob.objects.update(
+            started=timezone.now() - timezone.timedelta(days=1))
+        call_command('run_export_jobs', stdout=StringIO(),
+                     stderr=StringIO())
+        job.refresh_from_db()
+        self.assertEqual(job.status, ExportJob.STATUS_FAILED)
+        self.assertIn('Timed out', job.error)
+
+    def test_admin(self):
+        from django.contrib.auth.models import User
+
+        user = User.objects.create_superuser('admin', 'a@example.com', 'pw')
+        self.client.force_login(user)
+        data = {'action': 'csv_export', 'index': 0, '_selected_action':
+                list(Order.objects.values_list('pk', flat=True))}
+        url = reverse('admin:checkout_order_changelist')
+
+        # small exports are streamed straight back
+        response = self.client.post(url, data)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(len(b''.join(response.streaming_content)
+                             .splitlines()), 4)
+
+        with self.settings(MEDIA_ROOT=self.media_root), \
+                mock.patch('shoptools.settings.EXPORT_STREAM_LIMIT', 2):
+            response = self.client.post(url, data)
+            self.assertEqual(response.status_code, 302)
+            job = ExportJob.objects.get()
+            self.assertEqual(job.user, user)
+            self.assertEqual(job.status, ExportJob.STATUS_PENDING)
+
+            call_command('run_export_jobs', stdout=StringIO())
+            response = self.client.get(reverse(
+                'admin:checkout_exportjob_download', args=(job.pk, )))
+            self.assertEqual(len(b''.join(response.streaming_content)
+                                 .splitlines()), 4)
+            response.close()
+
+
+class OrderAdminTestCase(TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import User
+
+        self.product = Product.objects.create(name='Widget', price=20,
+                                              shipping_cost=0)
+        self.client.force_login(User.objects.create_superuser(
+            'admin', 'a@example.com', 'pw'))
+
+    def changelist(self, **params):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                reverse('admin:checkout_order_changelist'), params)
+        return response, len(queries)
+
+    def test_search_text(self):
+        order = create_order(self.product)
+        address = order.shipping_address
+        address.first_name = 'Jo'
+        address.save()
+        order.refresh_from_db()
+        self.assertIn('jo', order._search_text.split())
+        self.assertIn('auckland', order._search_text.split())
+
+        # a stale instance doesn't overwrite it
+        stale = Order.objects.get(pk=order.pk)
+        address.city = 'Wellington'
+        address.save()
+        stale.save()
+        order.refresh_from_db()
+        self.assertIn('wellington', order._search_text.split())
+
+    def test_changelist(self):
+        order = create_order(self.product)
+        Address.objects.filter(order=order).update(first_name='Jo',
+                                                   last_name='Bloggs')
+        response, queries = self.changelist()
+        self.assertContains(response, 'Jo Bloggs')
+
+        for i in range(5):
+            create_order(self.product)
+        response, more_queries = self.changelist()
+        self.assertEqual(queries, more_queries)
+
+    def test_search(self):
+        order = create_order(self.product)
+        address = order.shipping_address
+        address.email = 'Jo@Example.com'
+        address.save()
+        create_order(self.product)
+
+        response, queries = self.changelist(q='jo@example')
+        self.assertEqual(list(response.context['cl'].result_list), [order])
+        response, queries = self.changelist(q=str(order.pk))
+        self.assertIn(order, response.context['cl'].result_list)
+
+
+class MarkShippedTestCase(TransactionTestCase):
+    def setUp(self):
+        from django.contrib.auth.models import User
+
+        product = Product.objects.create(name='Widget', price=20,
+                                         shipping_cost=0)
+        self.paid = create_order(product, status=Order.STATUS_PAID)
+        self.unpaid = create_order(product)
+        self.dispatched = create_order(product, status=Order.STATUS_SHIPPED,
+                                       dispatched=timezone.now())
+        Address.objects.update(email='jo@example.com')
+        self.client.force_login(User.objects.create_superuser(
+            'admin', 'a@example.com', 'pw'))
+
+    def test_mark_shipped(self):
+        from django.core import mail
+        from shoptools.contrib.emails.models import Email
+
+        response = self.client.post(
+            reverse('admin:checkout_order_changelist'), {
+                'action': 'mark_shipped', 'index': 0,
+                '_selected_action': [self.paid.pk, self.unpaid.pk,
+                                     self.dispatched.pk]})
+        self.assertEqual(response.status_code, 302)
+
+        statuses = dict(Order.objects.values_list('pk', 'status'))
+        self.assertEqual(statuses, {
+            self.paid.pk: Order.STATUS_SHIPPED,
+            self.unpaid.pk: Order.STATUS_NEW,
+            self.dispatched.pk: Order.STATUS_SHIPPED})
+        self.paid.refresh_from_db()
+        self.assertIsNotNone(self.paid.dispatched)
+
+        # only the order which was shipped gets an email
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['jo@example.com'])
+        self.assertEqual(Email.objects.get().status, Email.STATUS_SENT)
+
+        # and shipping again does nothing
+        self.assertEqual(Order.objects.all().mark_shipped(), [])
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_status_filter(self):
+        from django.core import mail
+
+        # the changelist's status filter no longer matches once shipped
+        orders = Order.objects.filter(status=Order.STATUS_PAID) \
+                              .mark_shipped()
+        self.assertEqual([order.pk for order in orders], [self.paid.pk])
+        self.assertEqual(len(mail.outbox), 1)
+
+
+class CheckoutViewTestCase(TestCase):
+    def setUp(self):
+        currency = Currency.objects.create(code='NZD', symbol='$')
+        region = Region.objects.create(name='NZ', currency=currency,
+                                       is_default=True)
+        Country.objects.create(region=region, country='NZ')
+        ShippingOption.objects.create(
+            option=Option.objects.create(name='Standard'), region=region,
+            cost=10)
+        self.product = Product.objects.create(name='Widget', price=20,
+                                              shipping_cost=0)
+        self.client.post(reverse('cart_add'), {
+            'ctype': 'catalogue.product', 'pk': self.product.pk})
+
+    def checkout_data(self):
+        response = self.client.get(reverse('checkout_checkout'))
+        self.assertEqual(response.status_code, 200)
+        key = re.search(r'name="checkout_key" value="(\w+)"',
+                        response.content.decode()).group(1)
+        return {
+            'checkout_key': key,
+            'billing_is_shipping': 'on',
+            'shipping-first_name': 'Jo',
+            'shipping-last_name': 'Bloggs',
+            'shipping-email': 'jo@example.com',
+            'shipping-address': '1 Queen St',
+            'shipping-city': 'Auckland',
+            'shipping-postcode': '1010',
+            'shipping-country': 'NZ',
+        }
+
+    def test_repeat_submission(self):
+        data = self.checkout_data()
+        payment = HttpResponseRedirect('https://payment.example.com/1')
+        with mock.patch('shoptools.contrib.paypal.make_payment',
+                        return_value=payment) as make_payment:
+            first = self.client.post(reverse('checkout_checkout'), data)
+            second = self.client.post(reverse('checkout_checkout'), data)
+        self.assertEqual(make_payment.call_count, 1)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(first['Location'], 'https://payment.example.com/1')
+        self.assertEqual(second['Location'], first['Location'])
+
+    def test_repeat_submission_existing_order(self):
+        from . import views
+
+        data = self.checkout_data()
+        payment = HttpResponseRedirect('https://payment.example.com/1')
+        with mock.patch('shoptools.contrib.paypal.make_payment',
+                        return_value=payment) as make_payment:
+            self.client.post(reverse('checkout_checkout'), data)
+            order = Order.objects.get()
+            url = order.get_absolute_url()
+
+            # resubmitting the order with a new key takes payment again
+            data['checkout_key'] = '0' * 32
+            self.client.post(url, data)
+            self.assertEqual(make_payment.call_count, 2)
+
+            # a concurrent repeat passes the initial check before the first
+            # submission claims the key, then finds it claimed
+            data['checkout_key'] = '1' * 32
+            Order.objects.filter(pk=order.pk).update(
+                checkout_key=data['checkout_key'])
+            responses = iter([None])
+            repeat_submission_response = views.repeat_submission_response
+            with mock.patch.object(
+                    views, 'repeat_submission_response',
+                    side_effect=lambda request: next(
+                        responses, repeat_submission_response(request))):
+                response = self.client.post(url, data)
+        self.assertEqual(make_payment.call_count, 2)
+        self.assertRedirects(response, url, fetch_redirect_response=False)
+
+    def test_voucher_used_up(self):
+        from shoptools.contrib.vouchers.models import \
+            BaseVoucher, PercentageVoucher
+
+        PercentageVoucher.objects.create(code='TENOFF', amount=10, limit=1)
+        self.client.post(reverse('cart_set_voucher_codes'),
+                         {'codes': 'TENOFF'})
+        data = self.checkout_data()
+
+        # the voucher's last use is claimed by another order after the cart
+        # was validated
+        with mock.patch.object(BaseVoucher, 'claim', return_value=False), \
+                mock.patch('shoptools.contrib.paypal.make_payment') \
+                as make_payment:
+            response = self.client.post(reverse('checkout_checkout'), data)
+        self.assertFalse(make_payment.called)
+        self.assertContains(response, 'Voucher TENOFF has already been used')
+
+        order = Order.objects.get()
+        self.assertEqual(order.discount_set.count(), 0)
+        self.assertIsNone(order.checkout_key)
+
+    def test_query_budget(self):
+        url = reverse('checkout_checkout')
+        # the first request saves the shipping option picked for the cart
+        self.client.get(url)
+
+        # session, item, region, countries, regions and currency
+        with self.assertNumQueries(6):
+            response = self.client.get(url)
+        self.assertContains(response, 'checkout_key')
+
+
+class PurgeAbandonedTestCase(TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+        self.product = Product.objects.create(name='Widget', price=20,
+                                              shipping_cost=0)
+
+    def test_purge(self):
+        from shoptools.contrib.vouchers.models import \
+            PercentageVoucher, Discount
+
+        old = timezone.now() - timezone.timedelta(days=100)
+        voucher = PercentageVoucher.objects.create(amount=10, limit=1)
+        abandoned = create_order(self.product)
+        Discount.objects.create(order=abandoned, voucher=voucher, amount=2)
+        failed = create_order(self.product,
+                              status=Order.STATUS_PAYMENT_FAILED)
+        paid = create_order(self.product, status=Order.STATUS_PAID)
+        recent = create_order(self.product)
+        Order.objects.exclude(pk=recent.pk).update(created=old)
+        voucher.refresh_from_db()
+        self.assertEqual(voucher.use_count, 1)
+
+        out = StringIO()
+        call_command('purge_abandoned', days=30, dry_run=True,
+                     skip_carts=True, stdout=out)
+        self.assertIn('Would purge 2 abandoned orders', out.getvalue())
+        self.assertEqual(Order.objects.count(), 4)
+
+        with mock.patch('shoptools.checkout.models.make_search_text') as m:
+            call_command('purge_abandoned', days=30, chunk_size=1,
+                         skip_carts=True, output_dir=self.output_dir,
+                         stdout=out)
+        # the search text isn't rebuilt as the addresses are deleted
+        self.assertFalse(m.called)
+        self.assertIn('Archived and deleted 2 abandoned orders',
+                      out.getvalue())
+        self.assertEqual(set(Order.objects.values_list('pk', flat=True)),
+                         {paid.pk, recent.pk})
+        self.assertFalse(Address.objects.filter(
+            order_id__in=(abandoned.pk, failed.pk)).exists())
+
+        # the abandoned order's claim on the voucher is released
+        voucher.refresh_from_db()
+        self.assertEqual(voucher.use_count, 0)
+
+        path, = [os.path.join(self.output_dir, name)
+                 for name in os.listdir(self.output_dir)]
+        with open(path) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([r['pk'] for r in records],
+                         [abandoned.pk, failed.pk])
+        self.assertEqual(len(records[0]['checkout.orderline']), 1)
+        self.assertEqual(records[0]['checkout.address'][0]['city'],
+                         'Auckland')
+        self.assertEqual(records[0]['vouchers.discount'][0]['amount'],
+                         '2.00')
+
+    def test_carts(self):
+        from django.contrib.auth.models import User
+        from shoptools.cart.models import SavedCart, SavedCartLine
+
+        old = timezone.now() - timezone.timedelta(days=100)
+        carts = []
+        for name in ('stale', 'active'):
+            cart = SavedCart.objects.create(
+                user=User.objects.create(username=name), created=old)
+            SavedCartLine.objects.create(parent_object=cart,
+                                         item=self.product, quantity=1)
+            carts.append(cart)
+        SavedCartLine.objects.filter(parent_object=carts[0]) \
+                             .update(created=old)
+
+        out = StringIO()
+        call_command('purge_abandoned', days=30, skip_orders=True,
+                     gzip=True, output_dir=self.output_dir, stdout=out)
+        self.assertIn('Archived and deleted 1 abandoned carts',
+                      out.getvalue())
+        self.assertEqual(list(SavedCart.objects.all()), [carts[1]])
+
+        path, = [os.path.join(self.output_dir, name)
+                 for name in os.listdir(self.output_dir)]
+        with gzip.open(path, 'rt') as f:
+            record, = [json.loads(line) for line in f]
+        self.assertEqual(record['fields']['user'], carts[0].user_id)
+        self.assertEqual(len(record['cart.savedcartline']), 1)
+
+
+class SalesSummaryTestCase(TestCase):
+    def setUp(self):
+        self.product = Product.objects.create(name='Widget', price=20,
+                                              shipping_cost=0)
+        patcher = mock.patch('shoptools.checkout.models.send_email_receipt')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def pay(self, quantity):
+        order = create_order(self.product, quantity=quantity)
+        order.update_totals()
+        order.transaction_succeeded()
+        return order
+
+    def test_summaries(self):
+        self.pay(1)
+        order = self.pay(2)
+        # payments after the first don't count the order again, even when
+        # handled through an instance read before the order was paid
+        order.transaction_succeeded()
+        stale = create_order(self.product)
+        stale.update_totals()
+        Order.objects.get(pk=stale.pk).transaction_succeeded()
+        stale.transaction_succeeded()
+        create_order(self.product)
+
+        day = DailySales.objects.get()
+        self.assertEqual((day.orders, day.subtotal, day.total),
+                         (3, Decimal('80.00'), Decimal('80.00')))
+        item = DailyItemSales.objects.get()
+        self.assertEqual((item.item_object_id, item.quantity, item.total),
+                         (self.product.pk, 4, Decimal('80.00')))
+
+        # the backfill rebuilds the same totals from the orders
+        DailySales.objects.update(orders=0)
+        tomorrow = day.date + timezone.timedelta(days=1)
+        out = StringIO()
+        call_command('backfill_sales', chunk_size=1,
+                     until=tomorrow, stdout=out)
+        self.assertIn('Summarised 3 paid orders', out.getvalue())
+        self.assertEqual(DailySales.objects.get().orders, 3)
+        self.assertEqual(DailyItemSales.objects.get().quantity, 4)
+
+        # days from --until on are left alone
+        call_command('backfill_sales', '--until', day.date.isoformat(),
+                     stdout=out)
+        self.assertEqual(DailySales.objects.get().orders, 3)
+
+    def test_report(self):
+        from django.contrib.auth.models import User
+
+        self.pay(2)
+        user = User.objects.create_superuser('admin', 'a@example.com', 'pw')
+        self.client.force_login(user)
+        # session, user, currencies, then only the summary tables
+        with self.assertNumQueries(6):
+            response = self.client.get(
+                reverse('admin:checkout_dailysales_report'))
+        self.assertContains(response, 'Widget')
+        self.assertContains(response, '40.00')
@@ -1,9 +1,9 @@
 from django.template.loader import render_to_string
 
-from shoptools.util import \
-    get_regions_module, get_shipping_module, get_vouchers_module
 from shoptools.cart.util import get_cart
 
+from .state import get_checkout_state
+
 
 def get_html_snippet(request, cart=None, errors=[]):
     """
@@ -16,31 +16,9 @@ def get_html_snippet(request, cart=None, errors=[]):
     if not cart:
         cart = get_cart(request)
 
-    if not errors:
-        errors = cart.get_errors()
-
-    ctx = {
-        'cart': cart,
-        'cart_errors': errors
-    }
-
-    region_module = get_regions_module()
-    if region_module:
-        context = region_module.get_context(request)
-        if context:
-            ctx.update(context)
-
-    shipping_module = get_shipping_module()
-    if shipping_module:
-        context = shipping_module.get_context(cart)
-        if context:
-            ctx.update(context)
-
-    vouchers_module = get_vouchers_module()
-    if vouchers_module:
-        context = vouchers_module.get_context(cart)
-        if context:
-            ctx.update(context)
+    ctx = get_checkout_state(request, cart).get_context()
+    if errors:
+        ctx['cart_errors'] = errors
 
     return render_to_string('checkout/snippets/html_snippet.html', ctx,
                             request=request)
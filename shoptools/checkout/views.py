@@ -1,7 +1,8 @@
 from functools import partial
 
 from django.shortcuts import redirect, get_object_or_404, render
-from django.http import Http404
+from django.db import IntegrityError, transaction
+from django.http import Http404, HttpResponseRedirect
 try:
     from django.urls import reverse
 except ImportError:
@@ -13,16 +14,18 @@ from django.contrib.admin.views.decorators import staff_member_required
 
 from shoptools.cart import get_cart
 from shoptools.util import \
-    get_accounts_module, get_shipping_module, get_regions_module, \
-    get_vouchers_module, get_payment_module, get_email_module
+    get_accounts_module, get_shipping_module, get_vouchers_module, \
+    get_payment_module, get_email_module, make_uuid
 
 from .forms import OrderForm, OrderMetaForm, CheckoutUserForm, AddressForm
 from .models import Order, Address
 from .signals import checkout_pre_payment
+from .state import get_checkout_state
 from .emails import TEMPLATE_DIR
 
 
 CHECKOUT_SESSION_KEY = 'checkout-data'
+CHECKOUT_PAYMENT_SESSION_KEY = 'checkout-payment'
 
 
 def available_countries(cart):
@@ -82,30 +85,10 @@ def cart(request, cart, order=None):
     # Check for errors now, so if the cart is updated during this process it
     # is reflected in ctx.
     # TODO: rename error related methods to be validation related
-    errors = cart.get_errors()
+    ctx = get_checkout_state(request, cart).get_context()
 
-    ctx = {
-        'cart': cart,
-        'cart_errors': errors
-    }
-
-    region_module = get_regions_module()
-    if region_module:
-        context = region_module.get_context(request)
-        if context:
-            ctx.update(context)
-
-    shipping_module = get_shipping_module()
-    if shipping_module:
-        context = shipping_module.get_context(cart)
-        if context:
-            ctx.update(context)
-
-    vouchers_module = get_vouchers_module()
-    if vouchers_module:
-        context = vouchers_module.get_context(cart)
-        if context:
-            ctx.update(context)
+    # persist the shipping option picked during validation, if it changed
+    cart.save_shipping_option()
 
     return render(request, 'checkout/cart.html', ctx)
 
@@ -127,6 +110,13 @@ def checkout(request, cart, order=None):
     # TODO should the checkout view only ever work with an Order, which may
     # be unsaved (created on the fly from the cart contents)?
 
+    # a repeat of a submission which has already been saved (e.g. a double
+    # click) goes wherever the first one went, without saving again
+    if request.method == 'POST':
+        response = repeat_submission_response(request)
+        if response:
+            return response
+
     # if the cart is already linked with an (incomplete) order, show that order
     if not order.pk and cart.order_obj and \
             cart.order_obj.status < Order.STATUS_PAID:
@@ -143,7 +133,8 @@ def checkout(request, cart, order=None):
     # appropriate error message.
     # At this point we don't care about order.is_valid because its contents
     # will be overridden by the cart's contents anyway.
-    if not cart.is_valid:
+    state = get_checkout_state(request, cart)
+    if not state.is_valid:
         return redirect('checkout_cart')
 
     # if the user is anon, and accounts module is installed, show
@@ -163,7 +154,7 @@ def checkout(request, cart, order=None):
         account = None
 
     # available countries for shipping
-    shipping_countries = available_countries(cart)
+    shipping_countries = state.shipping_countries
 
     # get initial form data from the session, this may have been saved by a
     # previous form submission
@@ -220,6 +211,19 @@ def checkout(request, cart, order=None):
 
         if order_form.is_valid() and user_form_valid and \
                 shipping_form.is_valid() and billing_form_valid:
+            checkout_key = meta_form.cleaned_data.get('checkout_key') or None
+
+            # an existing order is updated in place, so a concurrent repeat
+            # of this submission won't fail to save - claim the key first,
+            # and leave the order to whichever request claimed it
+            if order.pk and checkout_key:
+                claimed = Order.objects.filter(pk=order.pk) \
+                    .exclude(checkout_key=checkout_key) \
+                    .update(checkout_key=checkout_key)
+                if not claimed:
+                    return repeat_submission_response(request) or \
+                        redirect(order)
+
             # save the order obj to the db...
             order = order_form.save(commit=False)
             code, symbol = cart.get_currency()
@@ -247,7 +251,16 @@ def checkout(request, cart, order=None):
             if request.user.is_authenticated:
                 order.user = request.user
 
-            order.save()
+            order.checkout_key = checkout_key
+            try:
+                with transaction.atomic():
+                    order.save()
+            except IntegrityError:
+                # the same submission was saved concurrently
+                response = repeat_submission_response(request)
+                if response:
+                    return response
+                raise
 
             shipping_address.order = order
             shipping_address.save()
@@ -263,62 +276,91 @@ def checkout(request, cart, order=None):
                 order.billing_address.delete()
 
             # save any cart lines to the order, overwriting any existing lines
-            cart.save_to(order)
-
-            # and off we go to pay, if necessary
-            payment_module = get_payment_module()
-            checkout_pre_payment.send(sender=Order, request=request)
-            if order.total <= 0:
-                order.transaction_succeeded()
-                return redirect(order)
+            unavailable = state.save_to(order)
+
+            if unavailable:
+                # a voucher was used up after the cart was validated, so the
+                # total has gone up - show the form again rather than charge
+                # it. The order keeps no checkout key, so resubmitting the
+                # form isn't mistaken for a repeat of this submission.
+                for discount in unavailable:
+                    order_form.add_error(
+                        None, 'Voucher %s has already been used' % (
+                            discount.voucher.code))
+                Order.objects.filter(pk=order.pk).update(checkout_key=None)
+                order.checkout_key = None
             else:
-                if payment_module:
-                    return payment_module.make_payment(order, request)
-                else:
-                    order.transaction_failed()
-                    return redirect(order)
+                # and off we go to pay, if necessary
+                return payment_response(request, order)
         else:
             # Save posted data so the user doesn't have to re-enter it
             request.session[CHECKOUT_SESSION_KEY] = request.POST.dict()
             request.session.modified = True
     else:
-        meta_form = OrderMetaForm()
+        meta_form = OrderMetaForm(
+            initial={'checkout_key': make_uuid().hex})
         order_form = get_order_form()
         shipping_form = get_shipping_form()
         billing_form = get_billing_form()
         user_form = get_user_form()
 
-    ctx = {
+    ctx = state.get_context()
+    ctx.update({
         'order_form': order_form,
         'meta_form': meta_form,
         'shipping_form': shipping_form,
         'billing_form': billing_form,
         'user_form': user_form,
-        'cart': cart,
         'order': order,
         'accounts_enabled': accounts_enabled,
         'account': account
-    }
+    })
 
-    region_module = get_regions_module()
-    if region_module:
-        context = region_module.get_context(request)
-        if context:
-            ctx.update(context)
+    cart.save_shipping_option()
 
-    shipping_module = get_shipping_module()
-    if shipping_module:
-        context = shipping_module.get_context(cart)
-        if context:
-            ctx.update(context)
+    return render(request, 'checkout/checkout.html', ctx)
 
-    vouchers_module = get_vouchers_module()
-    if vouchers_module:
-        context = vouchers_module.get_context(cart)
-        if context:
-            ctx.update(context)
 
-    return render(request, 'checkout/checkout.html', ctx)
+def payment_response(request, order):
+    """Complete a free order, or send the customer off to pay for it. """
+
+    payment_module = get_payment_module()
+    checkout_pre_payment.send(sender=Order, request=request)
+    if order.total <= 0:
+        order.transaction_succeeded()
+        return redirect(order)
+    else:
+        if payment_module:
+            response = payment_module.make_payment(order, request)
+            if order.checkout_key and \
+                    isinstance(response, HttpResponseRedirect):
+                request.session[CHECKOUT_PAYMENT_SESSION_KEY] = {
+                    'checkout_key': order.checkout_key,
+                    'url': response.url,
+                }
+            return response
+        else:
+            order.transaction_failed()
+            return redirect(order)
+
+
+def repeat_submission_response(request):
+    """If the checkout form's key matches an order which has already been
+       saved, return a redirect to the payment for that submission (if any)
+       or to the order, otherwise None. """
+
+    checkout_key = request.POST.get('checkout_key')
+    if not checkout_key:
+        return None
+    order = Order.objects.filter(checkout_key=checkout_key).first()
+    if not order:
+        return None
+
+    payment = request.session.get(CHECKOUT_PAYMENT_SESSION_KEY) or {}
+    if order.status < Order.STATUS_PAID and \
+            payment.get('checkout_key') == checkout_key:
+        return redirect(payment['url'])
+    return redirect(order)
 
 
 def order_success_response(request, order):
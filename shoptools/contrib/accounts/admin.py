@@ -3,10 +3,10 @@ from datetime import date
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import User
-from django.http import HttpResponse
+
+from shoptools.exports import export_response
 
 from .models import Account
-from .export import generate_csv
 from .forms import UserAdminChangeForm, UserAdminCreationForm
 
 
@@ -27,14 +27,9 @@ class AccountAdmin(admin.ModelAdmin):
 
     def csv_export(self, request, queryset):
         filename = 'account_export_' + date.today().strftime('%Y%m%d')
-
-        # response = HttpResponse()
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = \
-            "attachment; filename=%s.csv" % filename
-
-        generate_csv(queryset, response)
-        return response
+        return export_response(
+            self, request, queryset,
+            'shoptools.contrib.accounts.export.stream_csv', filename)
 
 
 admin.site.register(Account, AccountAdmin)
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import csv
 
+from shoptools.exports import Echo
+
 
 def getval(obj, getter):
     """Gets a value from an object, using a getter which
@@ -34,16 +36,24 @@ ORDER_FIELDS = (
 )
 
 
-def generate_csv(qs, file_object):
-    csvfile = csv.writer(file_object)
+def stream_csv(qs, chunk_size=2000):
+    """Yield lines of CSV for the accounts in qs, e.g. for a
+       StreamingHttpResponse. """
+
+    csvfile = csv.writer(Echo())
 
     header = [f[0] for f in ORDER_FIELDS]
 
-    csvfile.writerow(header)
+    yield csvfile.writerow(header)
 
-    for obj in qs:
+    for obj in qs.select_related('user').iterator(chunk_size=chunk_size):
         row = []
         for name, getter in ORDER_FIELDS:
             row.append(getval(obj, getter))
 
-        csvfile.writerow(row)
+        yield csvfile.writerow(row)
+
+
+def generate_csv(qs, file_object):
+    for line in stream_csv(qs):
+        file_object.write(line)
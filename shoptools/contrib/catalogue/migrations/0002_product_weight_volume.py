@@ -0,0 +1,23 @@
+# Generated by Django 2.1.15 on 2026-10-19 05:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalogue', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='volume',
+            field=models.DecimalField(decimal_places=4, default=0, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='weight',
+            field=models.DecimalField(decimal_places=3, default=0, max_digits=10),
+        ),
+    ]
@@ -8,6 +8,8 @@ class Product(models.Model, ICartItem):
     name = models.CharField(max_length=100)
     price = models.DecimalField(max_digits=10, decimal_places=2)
     shipping_cost = models.DecimalField(max_digits=10, decimal_places=2)
+    weight = models.DecimalField(max_digits=10, decimal_places=3, default=0)
+    volume = models.DecimalField(max_digits=10, decimal_places=4, default=0)
 
     def __str__(self):
         return self.name
@@ -30,6 +32,14 @@ class Product(models.Model, ICartItem):
     def get_shipping_cost(self, line):
         return self.shipping_cost * line.quantity
 
+    # rate table shipping integration
+
+    def get_shipping_weight(self):
+        return self.weight
+
+    def get_shipping_volume(self):
+        return self.volume
+
     def available_options(self):
         return (
             ('Colour', ['Red', 'Blue']),
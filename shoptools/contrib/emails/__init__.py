@@ -4,6 +4,11 @@ def send_email(*args, **kwargs):
     return send_email(*args, **kwargs)
 
 
+def send_emails(*args, **kwargs):
+    from .emails import send_emails
+    return send_emails(*args, **kwargs)
+
+
 def email_content(*args, **kwargs):
     from .emails import email_content
     return email_content(*args, **kwargs)
@@ -5,7 +5,7 @@ from django.contrib.contenttypes.models import ContentType
 from django.template.loader import render_to_string
 from django.conf import settings
 from django.utils import timezone
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.template import TemplateDoesNotExist
 from django.apps import apps
 
@@ -106,6 +106,15 @@ def create_email_record(email_type, template_dir, recipients, cc=[], bcc=[],
 
 
 def create_email_record_from_message(message, email_type, related_obj=None):
+    email_record = email_record_from_message(message, email_type,
+                                             related_obj=related_obj)
+    email_record.save()
+    return email_record
+
+
+def email_record_from_message(message, email_type, related_obj=None):
+    """Return an unsaved Email record for the message. """
+
     html = ''
     for content, mimetype in getattr(message, 'alternatives', []):
         if mimetype == 'text/html':
@@ -124,7 +133,6 @@ def create_email_record_from_message(message, email_type, related_obj=None):
         email_record.related_obj_content_type = \
             ContentType.objects.get_for_model(related_obj)
         email_record.related_obj_id = related_obj.id
-    email_record.save()
     return email_record
 
 
@@ -157,3 +165,45 @@ def send_email(email_type, template_dir, recipients, related_obj=None, cc=[],
         if not fail_silently:
             raise e
         return False
+
+
+def send_emails(email_type, template_dir, batch, fail_silently=False):
+    """Send an email of the same type to each of a batch of (recipients,
+       related_obj, context_dict) tuples, over one connection to the mail
+       server. The emails' records are saved together once they've been
+       sent. Return the number sent. """
+
+    messages = []
+    for recipients, related_obj, context_dict in batch:
+        message = create_message(email_type, template_dir, recipients,
+                                 **context_dict)
+        messages.append((message, email_record_from_message(
+            message, email_type, related_obj=related_obj)))
+
+    sent = 0
+    connection = get_connection(fail_silently=fail_silently)
+    try:
+        connection.open()
+        for message, email_record in messages:
+            message.connection = connection
+            try:
+                message.send()
+                email_record.status = email_record.STATUS_SENT
+                sent += 1
+            except Exception as e:
+                log = logging.getLogger('email_error')
+                if log:
+                    log.error('Email send failed', extra={
+                        'traceback': traceback.format_exc()
+                    })
+                email_record.status = email_record.STATUS_FAILED
+                email_record.error_message = traceback.format_exc()
+                if not fail_silently:
+                    raise e
+            email_record.status_updated = timezone.now()
+    finally:
+        connection.close()
+        Email.objects.bulk_create(
+            [email_record for message, email_record in messages])
+
+    return sent
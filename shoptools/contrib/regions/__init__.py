@@ -4,6 +4,11 @@ def get_region(request):
     return get_region(request)
 
 
+def get_region_id(country_code=None):
+    from .util import get_region_id
+    return get_region_id(country_code)
+
+
 def set_region(request):
     from .util import set_region
     return set_region(request)
@@ -78,17 +78,28 @@ def available_regions(request):
 
 
 def get_region(request):
-    """Get region instance from the session region id. """
+    """Get region instance from the session region id. The result is cached
+       on the request, keyed by region id, since the cart and shipping code
+       look it up several times per request. """
     info = get_cookie(request)
 
     region_id = get_int(info.get('region_id'))
 
+    cached = getattr(request, '_shoptools_region', None)
+    if cached and cached[0] == region_id:
+        return cached[1]
+
+    region = None
     if region_id:
         try:
-            return Region.objects.get(id=region_id)
+            region = Region.objects.get(id=region_id)
         except Region.DoesNotExist:
             pass
-    return Region.get_default()
+    if region is None:
+        region = Region.get_default()
+
+    request._shoptools_region = (region_id, region)
+    return region
 
 
 def set_region(request, response, region_id):
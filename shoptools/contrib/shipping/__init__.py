@@ -16,6 +16,11 @@ def available_options(cart):
     return available_options(cart)
 
 
+def resolve_shipping(cart):
+    from .util import resolve_shipping
+    return resolve_shipping(cart)
+
+
 def get_context(request):
     from .util import shipping_context
     return shipping_context(request)
@@ -23,7 +28,11 @@ def get_context(request):
 
 def get_shipping_option_instance(shipping_option_id):
     from .models import ShippingOption
-    return ShippingOption.objects.get(id=shipping_option_id)
+    from .index import get_index
+    entry = get_index().get(shipping_option_id)
+    if entry is None:
+        raise ShippingOption.DoesNotExist()
+    return entry.instance
 
 
 def get_region_inlines():
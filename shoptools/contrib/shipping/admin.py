@@ -2,7 +2,7 @@
 
 from django.contrib import admin
 
-from .models import Option, ShippingOption
+from .models import Option, ShippingOption, RateTable, RateBreakpoint
 
 
 @admin.register(Option)
@@ -25,3 +25,16 @@ class ShippingOptionAdmin(admin.ModelAdmin):
 class ShippingOptionInline(admin.TabularInline):
     model = ShippingOption
     extra = 1
+
+
+class RateBreakpointInline(admin.TabularInline):
+    model = RateBreakpoint
+    extra = 1
+
+
+@admin.register(RateTable)
+class RateTableAdmin(admin.ModelAdmin):
+    list_display = ('shipping_option', 'basis', 'volumetric_factor')
+    list_select_related = ('shipping_option__option',
+                           'shipping_option__region__currency')
+    inlines = [RateBreakpointInline]
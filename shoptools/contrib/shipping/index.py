@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory index of ShippingOption rows, so the shipping module can answer
+"which options are valid for this subtotal" and "what does option X cost"
+without touching the database.
+
+Options are grouped per region. Each region's [min_cart_value,
+max_cart_value] bands are split into elementary segments at every band
+boundary, and the set of valid options is precomputed for each segment, so a
+lookup is a single binary search over the boundaries.
+
+Rate tables (see rates.py) are loaded alongside the options. The index is
+built lazily and rebuilt when a ShippingOption, Option, RateTable or
+RateBreakpoint is saved or deleted (see the receivers in models.py). A
+generation token is kept in the default cache so other processes notice the
+change too.
+"""
+
+import uuid
+import threading
+from bisect import bisect_left
+
+from django.core.cache import cache
+from django.db import transaction
+
+from shoptools.quotes import shipping_quotes
+
+
+CACHE_KEY = 'shoptools_shipping_index'
+
+
+class ShippingOptionEntry(object):
+    """Lightweight, immutable snapshot of a ShippingOption row. """
+
+    __slots__ = ('id', 'option_id', 'name', 'cost', 'min_cart_value',
+                 'max_cart_value', 'instance', 'rates')
+
+    def __init__(self, instance, rates=None):
+        self.id = instance.id
+        self.option_id = instance.option_id
+        self.name = instance.option.name
+        self.cost = instance.cost
+        self.min_cart_value = instance.min_cart_value
+        self.max_cart_value = instance.max_cart_value
+        self.instance = instance
+        # RateArrays, if the option has a RateTable
+        self.rates = rates
+
+    def contains(self, value):
+        return self.min_cart_value <= value and \
+            (self.max_cart_value is None or value <= self.max_cart_value)
+
+
+class RegionIndex(object):
+    """Interval index of the shipping options for a single region. """
+
+    def __init__(self, entries):
+        self.by_id = dict((e.id, e) for e in entries)
+
+        boundaries = set()
+        for e in entries:
+            boundaries.add(e.min_cart_value)
+            if e.max_cart_value is not None:
+                boundaries.add(e.max_cart_value)
+        self.boundaries = sorted(boundaries)
+
+        # points[i] holds the options valid at exactly boundaries[i], and
+        # gaps[i] those valid strictly between boundaries[i - 1] and
+        # boundaries[i]. Entries keep the order they were passed in.
+        self.points = [tuple(e for e in entries if e.contains(b))
+                       for b in self.boundaries]
+        self.gaps = []
+        for i in range(len(self.boundaries) + 1):
+            if i == 0:
+                # below the lowest minimum, nothing can apply
+                self.gaps.append(())
+                continue
+            lower = self.boundaries[i - 1]
+            upper = self.boundaries[i] if i < len(self.boundaries) else None
+            self.gaps.append(tuple(
+                e for e in entries
+                if e.min_cart_value <= lower and
+                (e.max_cart_value is None or
+                 (upper is not None and e.max_cart_value >= upper))))
+
+    def valid_for(self, subtotal):
+        i = bisect_left(self.boundaries, subtotal)
+        if i < len(self.boundaries) and self.boundaries[i] == subtotal:
+            return self.points[i]
+        return self.gaps[i]
+
+    def get(self, shipping_option_id, subtotal=None):
+        entry = self.by_id.get(shipping_option_id)
+        if entry is None:
+            return None
+        if subtotal is not None and not entry.contains(subtotal):
+            return None
+        return entry
+
+
+EMPTY_REGION = RegionIndex([])
+
+
+class ShippingOptionIndex(object):
+    def __init__(self, token):
+        from .models import ShippingOption
+        from .rates import load_rate_arrays
+
+        self.token = token
+
+        rates = load_rate_arrays()
+        self.has_rates = bool(rates)
+
+        qs = ShippingOption.objects.select_related('option') \
+            .order_by('region_id', 'option__sort_order', 'option__name', 'id')
+
+        grouped = {}
+        self.by_id = {}
+        for instance in qs:
+            entry = ShippingOptionEntry(instance, rates.get(instance.id))
+            grouped.setdefault(instance.region_id, []).append(entry)
+            self.by_id[entry.id] = entry
+
+        self.regions = dict((region_id, RegionIndex(entries))
+                            for region_id, entries in grouped.items())
+
+    def for_region(self, region_id):
+        return self.regions.get(region_id, EMPTY_REGION)
+
+    def valid_for(self, region_id, subtotal):
+        """Return ShippingOptionEntry tuple valid for region and subtotal,
+           ordered by Option.sort_order and name. """
+        return self.for_region(region_id).valid_for(subtotal)
+
+    def cost(self, region_id, shipping_option_id, subtotal):
+        """Return the cost of the given shipping option, or None if it isn't
+           valid for the region and subtotal. For options with a RateTable
+           this is the base cost only; see resolve_shipping. """
+        entry = self.for_region(region_id).get(shipping_option_id, subtotal)
+        return entry.cost if entry else None
+
+    def get(self, shipping_option_id):
+        return self.by_id.get(shipping_option_id)
+
+
+_lock = threading.Lock()
+_index = None
+
+
+def _current_token():
+    token = cache.get(CACHE_KEY)
+    if token is None:
+        cache.add(CACHE_KEY, uuid.uuid4().hex, None)
+        token = cache.get(CACHE_KEY)
+    return token
+
+
+def get_index():
+    """Return the current ShippingOptionIndex, rebuilding it if it has been
+       invalidated in this or any other process. """
+
+    global _index
+
+    token = _current_token()
+    index = _index
+    if index is not None and index.token == token:
+        return index
+
+    with _lock:
+        if _index is None or _index.token != token:
+            _index = ShippingOptionIndex(token)
+        return _index
+
+
+def invalidate_index():
+    global _index
+
+    _index = None
+
+    # cached quotes may have been calculated from the old options
+    shipping_quotes.clear()
+
+    # other processes rebuild once they see a new token, which is only
+    # published once the change has committed, so they can't rebuild from
+    # the old rows in the meantime
+    _pending.index = True
+    transaction.on_commit(_publish)
+
+
+_pending = threading.local()
+
+
+def _publish():
+    # several callbacks may be registered in one transaction, so only the
+    # first publishes a new token
+    if not getattr(_pending, 'index', False):
+        return
+    _pending.index = False
+
+    cache.set(CACHE_KEY, uuid.uuid4().hex, None)
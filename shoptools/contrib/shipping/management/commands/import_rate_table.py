@@ -0,0 +1,62 @@
+import csv
+import decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from shoptools.contrib.shipping.index import invalidate_index
+from shoptools.contrib.shipping.models import \
+    ShippingOption, RateTable, RateBreakpoint
+
+
+class Command(BaseCommand):
+    help = ('Replace the rate table for a shipping option with breakpoints '
+            'from a CSV file of "max_value,cost" rows.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('shipping_option_id', type=int)
+        parser.add_argument('csv_file')
+        parser.add_argument('--basis', default=RateTable.BASIS_WEIGHT,
+                            choices=[c[0] for c in RateTable.BASIS_CHOICES])
+        parser.add_argument('--volumetric-factor', default=None)
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, shipping_option_id, csv_file, basis, volumetric_factor,
+               batch_size, **options):
+        try:
+            shipping_option = ShippingOption.objects.get(
+                pk=shipping_option_id)
+        except ShippingOption.DoesNotExist:
+            raise CommandError('No shipping option with id %s' %
+                               shipping_option_id)
+
+        rows = []
+        with open(csv_file) as f:
+            for n, row in enumerate(csv.reader(f), start=1):
+                if not row or not row[0].strip():
+                    continue
+                try:
+                    rows.append((decimal.Decimal(row[0].strip()),
+                                 decimal.Decimal(row[1].strip())))
+                except (decimal.InvalidOperation, IndexError):
+                    if n == 1:
+                        # header row
+                        continue
+                    raise CommandError('Invalid row %s: %s' % (n, row))
+
+        with transaction.atomic():
+            table, created = RateTable.objects.update_or_create(
+                shipping_option=shipping_option,
+                defaults={'basis': basis,
+                          'volumetric_factor': volumetric_factor})
+            table.breakpoints.all().delete()
+            RateBreakpoint.objects.bulk_create(
+                [RateBreakpoint(table=table, max_value=max_value, cost=cost)
+                 for max_value, cost in rows],
+                batch_size=batch_size)
+
+        # bulk operations don't send signals
+        invalidate_index()
+
+        self.stdout.write('Imported %s breakpoints for %s' %
+                          (len(rows), shipping_option))
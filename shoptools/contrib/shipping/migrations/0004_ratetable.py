@@ -0,0 +1,43 @@
+# Generated by Django 2.1.15 on 2026-10-19 05:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shipping', '0003_auto_20180809_0142'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RateBreakpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('max_value', models.DecimalField(decimal_places=3, help_text='Maximum weight or volume (inclusive) for this rate', max_digits=10)),
+                ('cost', models.DecimalField(decimal_places=2, max_digits=8)),
+            ],
+            options={
+                'ordering': ('table', 'max_value'),
+            },
+        ),
+        migrations.CreateModel(
+            name='RateTable',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('basis', models.CharField(choices=[('weight', 'Weight (kg)'), ('volume', 'Volume (m3)'), ('chargeable', 'Greater of weight and volumetric weight')], default='weight', max_length=20)),
+                ('volumetric_factor', models.DecimalField(blank=True, decimal_places=2, help_text='kg per m3, used to convert volume to volumetric weight', max_digits=8, null=True)),
+                ('shipping_option', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='rate_table', to='shipping.ShippingOption')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='ratebreakpoint',
+            name='table',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='breakpoints', to='shipping.RateTable'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='ratebreakpoint',
+            unique_together={('table', 'max_value')},
+        ),
+    ]
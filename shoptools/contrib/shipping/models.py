@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from django.db import models
+from django.dispatch import receiver
 
 from shoptools.contrib.regions.models import Region
 
@@ -38,3 +39,57 @@ class ShippingOption(models.Model):
 
     class Meta:
         ordering = ('region__name', 'option', )
+
+
+class RateTable(models.Model):
+    """Weight or volume based rates for a ShippingOption. The option's cost
+       is added to the rate as a base fee. """
+
+    BASIS_WEIGHT = 'weight'
+    BASIS_VOLUME = 'volume'
+    BASIS_CHARGEABLE = 'chargeable'
+    BASIS_CHOICES = (
+        (BASIS_WEIGHT, 'Weight (kg)'),
+        (BASIS_VOLUME, 'Volume (m3)'),
+        (BASIS_CHARGEABLE, 'Greater of weight and volumetric weight'),
+    )
+
+    shipping_option = models.OneToOneField(
+        ShippingOption, related_name='rate_table', on_delete=models.CASCADE)
+    basis = models.CharField(max_length=20, choices=BASIS_CHOICES,
+                             default=BASIS_WEIGHT)
+    volumetric_factor = models.DecimalField(
+        max_digits=8, decimal_places=2, blank=True, null=True,
+        help_text="kg per m3, used to convert volume to volumetric weight")
+
+    def __str__(self):
+        return 'Rates for %s' % self.shipping_option
+
+
+class RateBreakpoint(models.Model):
+    table = models.ForeignKey(RateTable, related_name='breakpoints',
+                              on_delete=models.CASCADE)
+    max_value = models.DecimalField(
+        max_digits=10, decimal_places=3,
+        help_text="Maximum weight or volume (inclusive) for this rate")
+    cost = models.DecimalField(max_digits=8, decimal_places=2)
+
+    class Meta:
+        ordering = ('table', 'max_value', )
+        unique_together = ('table', 'max_value')
+
+    def __str__(self):
+        return 'Up to %s: %s' % (self.max_value, self.cost)
+
+
+@receiver(models.signals.post_save, sender=RateTable)
+@receiver(models.signals.post_delete, sender=RateTable)
+@receiver(models.signals.post_save, sender=RateBreakpoint)
+@receiver(models.signals.post_delete, sender=RateBreakpoint)
+@receiver(models.signals.post_save, sender=Option)
+@receiver(models.signals.post_delete, sender=Option)
+@receiver(models.signals.post_save, sender=ShippingOption)
+@receiver(models.signals.post_delete, sender=ShippingOption)
+def invalidate_shipping_index(sender, **kwargs):
+    from .index import invalidate_index
+    invalidate_index()
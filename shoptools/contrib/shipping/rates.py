@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Weight/volume based shipping rates.
+
+A RateTable attached to a ShippingOption holds a list of breakpoints, each
+giving the cost of shipping anything up to and including its max_value. The
+tables are loaded into compact tuples by the shipping index (so they're
+cached per process alongside the options), and a cart's weight and volume are
+measured in a single pass over its lines, after which each table lookup is a
+binary search.
+"""
+
+import decimal
+from bisect import bisect_left
+
+
+def to_decimal(value):
+    # via str, so e.g. a float 0.1 is Decimal('0.1') not its binary value
+    if isinstance(value, decimal.Decimal):
+        return value
+    return decimal.Decimal(str(value or 0))
+
+
+def measure(lines):
+    """Return the total (weight, volume) of the given cart lines, as
+       Decimals, using the items' get_shipping_weight and
+       get_shipping_volume methods. """
+
+    weight = volume = decimal.Decimal(0)
+    for line in lines:
+        item = line.item
+        quantity = line.quantity
+        get_weight = getattr(item, 'get_shipping_weight', None)
+        get_volume = getattr(item, 'get_shipping_volume', None)
+        if get_weight:
+            weight += to_decimal(get_weight()) * quantity
+        if get_volume:
+            volume += to_decimal(get_volume()) * quantity
+    return (weight, volume)
+
+
+class RateArrays(object):
+    """Compact, read-only copy of a RateTable. Limits and costs are kept as
+       Decimals, so totals exactly on a limit get that limit's rate. """
+
+    __slots__ = ('basis', 'volumetric_factor', 'limits', 'costs')
+
+    def __init__(self, basis, volumetric_factor, breakpoints):
+        self.basis = basis
+        self.volumetric_factor = to_decimal(volumetric_factor)
+        self.limits = tuple(to_decimal(max_value)
+                            for max_value, cost in breakpoints)
+        self.costs = tuple(to_decimal(cost) for max_value, cost in breakpoints)
+
+    def measure(self, weight, volume):
+        from .models import RateTable
+
+        if self.basis == RateTable.BASIS_WEIGHT:
+            return weight
+        if self.basis == RateTable.BASIS_VOLUME:
+            return volume
+        return max(weight, volume * self.volumetric_factor)
+
+    def cost(self, weight, volume):
+        """Return the cost for the given totals, or None if they exceed the
+           table's largest breakpoint. """
+
+        i = bisect_left(self.limits, self.measure(weight, volume))
+        if i == len(self.limits):
+            return None
+        return self.costs[i]
+
+
+def load_rate_arrays():
+    """Load every RateTable into a dict of RateArrays, keyed by
+       shipping_option_id, with two queries. """
+
+    from .models import RateTable, RateBreakpoint
+
+    tables = dict(
+        (table_id, (option_id, basis, factor, []))
+        for table_id, option_id, basis, factor in RateTable.objects
+        .values_list('id', 'shipping_option_id', 'basis',
+                     'volumetric_factor'))
+
+    breakpoints = RateBreakpoint.objects.order_by('table_id', 'max_value') \
+        .values_list('table_id', 'max_value', 'cost')
+    for table_id, max_value, cost in breakpoints.iterator():
+        tables[table_id][3].append((max_value, cost))
+
+    return dict(
+        (option_id, RateArrays(basis, factor, rows))
+        for option_id, basis, factor, rows in tables.values())
@@ -0,0 +1,224 @@
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase, RequestFactory
+
+from shoptools.contrib.regions.models import Currency, Region
+
+from .index import CACHE_KEY, get_index
+from .models import Option, ShippingOption, RateTable, RateBreakpoint
+from .util import resolve_shipping
+
+
+class StubItem(object):
+    def __init__(self, weight, volume=0):
+        self.weight = weight
+        self.volume = volume
+        self.measured = 0
+
+    def get_shipping_weight(self):
+        self.measured += 1
+        return self.weight
+
+    def get_shipping_volume(self):
+        return self.volume
+
+
+class StubLine(object):
+    def __init__(self, item, quantity):
+        self.item = item
+        self.quantity = quantity
+
+
+class StubCart(object):
+    def __init__(self, subtotal, shipping_option=None, lines=()):
+        self.request = RequestFactory().get('/')
+        self.subtotal = Decimal(subtotal)
+        self.shipping_option = shipping_option
+        self.lines = list(lines)
+        self.writes = 0
+
+    def get_lines(self):
+        return self.lines
+
+    def get_shipping_option(self):
+        return self.shipping_option
+
+    def set_shipping_option(self, option_id):
+        self.shipping_option = option_id
+        self.writes += 1
+
+
+class ShippingIndexTestCase(TestCase):
+    def setUp(self):
+        currency = Currency.objects.create(code='NZD', symbol='$')
+        self.region = Region.objects.create(name='NZ', currency=currency)
+        standard = Option.objects.create(name='Standard', sort_order=0)
+        courier = Option.objects.create(name='Courier', sort_order=1)
+
+        self.cheap = ShippingOption.objects.create(
+            option=standard, region=self.region, cost=10,
+            max_cart_value=100)
+        self.free = ShippingOption.objects.create(
+            option=standard, region=self.region, cost=0,
+            min_cart_value=Decimal('100.01'))
+        self.courier = ShippingOption.objects.create(
+            option=courier, region=self.region, cost=20, min_cart_value=50)
+
+    def valid_ids(self, subtotal):
+        return [e.id for e in
+                get_index().valid_for(self.region.id, Decimal(subtotal))]
+
+    def test_valid_for(self):
+        self.assertEqual(self.valid_ids('0'), [self.cheap.id])
+        self.assertEqual(self.valid_ids('50'),
+                         [self.cheap.id, self.courier.id])
+        self.assertEqual(self.valid_ids('100'),
+                         [self.cheap.id, self.courier.id])
+        self.assertEqual(self.valid_ids('100.005'), [self.courier.id])
+        self.assertEqual(self.valid_ids('1000'),
+                         [self.free.id, self.courier.id])
+        self.assertEqual(get_index().valid_for(None, Decimal(10)), ())
+
+    def test_cost(self):
+        index = get_index()
+        self.assertEqual(
+            index.cost(self.region.id, self.courier.id, Decimal(60)), 20)
+        self.assertIsNone(
+            index.cost(self.region.id, self.courier.id, Decimal(10)))
+
+    def test_lookups_are_query_free(self):
+        get_index()
+        with self.assertNumQueries(0):
+            self.valid_ids('75')
+            get_index().cost(self.region.id, self.cheap.id, Decimal(75))
+
+    def test_invalidated_on_save(self):
+        get_index()
+        self.courier.cost = 25
+        self.courier.save()
+        self.assertEqual(
+            get_index().cost(self.region.id, self.courier.id, Decimal(60)),
+            25)
+
+        self.courier.delete()
+        self.assertEqual(self.valid_ids('75'), [self.cheap.id])
+
+
+class IndexPublishTestCase(TransactionTestCase):
+    def test_token_published_on_commit(self):
+        currency = Currency.objects.create(code='NZD', symbol='$')
+        region = Region.objects.create(name='NZ', currency=currency)
+        option = Option.objects.create(name='Standard')
+        index = get_index()
+
+        with transaction.atomic():
+            ShippingOption.objects.create(option=option, region=region,
+                                          cost=10)
+            ShippingOption.objects.create(option=option, region=region,
+                                          cost=20, min_cart_value=50)
+            self.assertEqual(cache.get(CACHE_KEY), index.token)
+        self.assertNotEqual(cache.get(CACHE_KEY), index.token)
+        self.assertEqual(len(get_index().valid_for(region.id, Decimal(60))),
+                         2)
+
+
+class ResolveShippingTestCase(TestCase):
+    setUp = ShippingIndexTestCase.setUp
+
+    def test_defaults_to_first_option_without_writing(self):
+        cart = StubCart(60)
+        resolution = resolve_shipping(cart)
+        self.assertEqual(resolution.selected_id, self.cheap.id)
+        self.assertEqual(resolution.cost, 10)
+        self.assertTrue(resolution.pending)
+        self.assertEqual(resolution.errors, [])
+        self.assertEqual(cart.writes, 0)
+
+    def test_memoized(self):
+        cart = StubCart(60, self.courier.id)
+        resolution = resolve_shipping(cart)
+        with self.assertNumQueries(0):
+            self.assertIs(resolve_shipping(cart), resolution)
+        self.assertFalse(resolution.pending)
+        self.assertEqual(resolution.cost, 20)
+
+    def test_keeps_same_option_when_band_changes(self):
+        cart = StubCart(500, self.cheap.id)
+        resolution = resolve_shipping(cart)
+        self.assertEqual(resolution.selected_id, self.free.id)
+        self.assertTrue(resolution.pending)
+
+    def test_errors(self):
+        resolution = resolve_shipping(StubCart(10, self.courier.id))
+        self.assertEqual(resolution.errors,
+                         ['Please select a shipping option.'])
+        self.assertEqual(resolution.cost, 0)
+
+        self.region.shipping_options.all().delete()
+        resolution = resolve_shipping(StubCart(10))
+        self.assertEqual(len(resolution.errors), 1)
+        self.assertIsNone(resolution.selected_id)
+
+
+class RateTableTestCase(TestCase):
+    setUp = ShippingIndexTestCase.setUp
+
+    def add_table(self, shipping_option, basis=RateTable.BASIS_WEIGHT,
+                  factor=None):
+        table = RateTable.objects.create(
+            shipping_option=shipping_option, basis=basis,
+            volumetric_factor=factor)
+        RateBreakpoint.objects.bulk_create([
+            RateBreakpoint(table=table, max_value=1, cost=5),
+            RateBreakpoint(table=table, max_value=5, cost=12),
+            RateBreakpoint(table=table, max_value=20, cost=30),
+        ])
+        table.save()
+
+    def test_weight_rates(self):
+        self.add_table(self.courier)
+        cart = StubCart(60, self.courier.id,
+                        [StubLine(StubItem(Decimal('0.5')), 2)])
+        self.assertEqual(resolve_shipping(cart).cost, 25)
+
+        cart = StubCart(60, self.courier.id, [StubLine(StubItem(3), 2)])
+        self.assertEqual(resolve_shipping(cart).cost, 50)
+
+    def test_too_heavy_option_unavailable(self):
+        self.add_table(self.courier)
+        cart = StubCart(60, self.courier.id, [StubLine(StubItem(21), 1)])
+        resolution = resolve_shipping(cart)
+        self.assertEqual(resolution.options,
+                         [(self.cheap.id, 'Standard')])
+        self.assertEqual(resolution.errors,
+                         ['Please select a shipping option.'])
+
+    def test_chargeable_weight(self):
+        self.add_table(self.courier, RateTable.BASIS_CHARGEABLE, 200)
+        item = StubItem(Decimal('0.5'), Decimal('0.01'))
+        cart = StubCart(60, self.courier.id, [StubLine(item, 1)])
+        # 0.01m3 * 200kg/m3 = 2kg volumetric weight
+        self.assertEqual(resolve_shipping(cart).cost, 32)
+
+    def test_limits_inclusive(self):
+        table = RateTable.objects.create(shipping_option=self.courier)
+        RateBreakpoint.objects.create(table=table, max_value=Decimal('0.3'),
+                                      cost=5)
+        RateBreakpoint.objects.create(table=table, max_value=1, cost=8)
+        table.save()
+
+        # 3 x 0.1 is exactly 0.3, not 0.30000000000000004 as floats
+        cart = StubCart(60, self.courier.id, [StubLine(StubItem(0.1), 3)])
+        self.assertEqual(resolve_shipping(cart).cost, 25)
+
+    def test_memo_keyed_on_contents(self):
+        self.add_table(self.courier)
+        item = StubItem(Decimal('0.5'))
+        cart = StubCart(60, self.courier.id, [StubLine(item, 2)])
+        cart.content_signature = lambda: ((item, 2), )
+
+        resolve_shipping(cart)
+        resolve_shipping(cart)
+        self.assertEqual(item.measured, 1)
@@ -9,6 +9,8 @@ from django.db.models import Q
 
 from shoptools.contrib.regions.util import get_region
 from .models import ShippingOption
+from .index import get_index
+from .rates import measure
 from .forms import ShippingOptionSelectionForm
 
 
@@ -22,7 +24,9 @@ def available_countries(cart):
 
 
 def available_options_qs(cart):
-    """Return available Options for this cart """
+    """Return available Options for this cart as a queryset. The shipping
+       module itself uses the in-memory index instead, see available_options.
+    """
 
     region = get_region(cart.request)
 
@@ -36,48 +40,148 @@ def available_options_qs(cart):
         region_query, min_query, max_query).distinct()
 
 
+def _region_id(cart):
+    region = get_region(cart.request)
+    return region.id if region else None
+
+
+class ShippingResolution(object):
+    """The outcome of resolve_shipping for a cart: the available options, the
+       effective selection, its cost and any validation errors.
+
+       selected may differ from the cart's stored shipping option (e.g. when
+       none is set yet, or the region changed); in that case pending is True
+       and the cart's save_shipping_option method persists it.
+    """
+
+    def __init__(self, entries=(), selected=None, errors=(), pending=False,
+                 costs=None):
+        self.entries = entries
+        self.selected = selected
+        self.errors = list(errors)
+        self.pending = pending
+        # cost per shipping option id, including any rate table charge
+        self.costs = costs or dict((e.id, e.cost) for e in entries)
+
+    @property
+    def options(self):
+        return [(e.id, e.name) for e in self.entries]
+
+    @property
+    def selected_id(self):
+        return self.selected.id if self.selected else None
+
+    @property
+    def selected_option(self):
+        return self.selected.instance if self.selected else None
+
+    @property
+    def cost(self):
+        return self.costs[self.selected.id] if self.selected else 0
+
+
+def resolve_shipping(cart):
+    """Work out the available shipping options, the effective selection and
+       its cost for the cart in a single pass. Never writes; the result is
+       memoized on the cart until its region, subtotal, contents or stored
+       option change. """
+
+    index = get_index()
+    region_id = _region_id(cart)
+    subtotal = cart.subtotal
+    current_id = cart.get_shipping_option() \
+        if hasattr(cart, 'get_shipping_option') else None
+
+    # rate tables depend on the cart's weight and volume, which means
+    # walking its lines, so the memo is keyed on the cart's contents instead
+    # where it can give a cheap signature of them
+    measurements = contents = None
+    if index.has_rates:
+        if hasattr(cart, 'content_signature'):
+            contents = cart.content_signature()
+        else:
+            contents = measurements = measure(cart.get_lines())
+
+    key = (index.token, region_id, subtotal, current_id, contents)
+    memo = getattr(cart, '_shipping_resolution', None)
+    if memo and memo[0] == key:
+        return memo[1]
+
+    if index.has_rates and measurements is None:
+        measurements = measure(cart.get_lines())
+    entries = index.valid_for(region_id, subtotal)
+
+    # add rate table charges, dropping options the cart is too heavy or
+    # bulky for
+    costs = {}
+    for entry in entries:
+        cost = entry.cost
+        if entry.rates:
+            rate = entry.rates.cost(*measurements)
+            if rate is None:
+                continue
+            cost += rate
+        costs[entry.id] = cost
+    entries = tuple(e for e in entries if e.id in costs)
+
+    selected = None
+    pending = False
+    errors = []
+    if not entries:
+        errors.append(
+            'There are no valid shipping options for your current order.')
+    elif current_id is None:
+        selected = entries[0]
+        pending = True
+    else:
+        matching = [e for e in entries if e.id == current_id]
+        if matching:
+            selected = matching[0]
+        else:
+            # Check if a ShippingOption with the same Option as our shipping
+            # option is available, so if the user changes region it keeps the
+            # same type of shipping selected.
+            current = index.get(current_id)
+            same_option = [e for e in entries
+                           if current and e.option_id == current.option_id]
+            if same_option:
+                selected = same_option[0]
+                pending = True
+            else:
+                errors.append('Please select a shipping option.')
+
+    resolution = ShippingResolution(entries, selected, errors, pending, costs)
+    cart._shipping_resolution = (key, resolution)
+    return resolution
+
+
 def available_options(cart):
     """Return iterable of shipping option choices applicable to this cart.
        Choices should be of the form
        (shipping_option_id, shipping_option_id)
     """
-    return available_options_qs(cart).values_list('id', 'option__name')
+    return resolve_shipping(cart).options
 
 
 def calculate(cart):
-    """Return the total shipping cost for the cart. """
+    """Return the total shipping cost for the cart. This is the cost of the
+       option resolve_shipping selects, which may be pending, so anything
+       storing the cost should store resolve_shipping(cart).selected_id as
+       the option with it. """
 
     if not hasattr(cart, 'get_shipping_option'):
         raise NotImplementedError()
-    option_id = cart.get_shipping_option()
-    region = get_region(cart.request)
-
-    region_query = Q(region=region)
-    min_query = Q(min_cart_value__lte=cart.subtotal)
-    max_query = Q(max_cart_value__isnull=True) | \
-        Q(max_cart_value__gte=cart.subtotal)
-
-    options = ShippingOption.objects.filter(
-        region_query, min_query, max_query, id=option_id)
-    option = options.order_by('cost').first()
-
-    if option:
-        return option.cost
 
-    return 0
+    return resolve_shipping(cart).cost
 
 
 def shipping_context(cart):
     """Return shipping related context for use in cart related html.
     """
-    available_shipping_options = list(available_options(cart))
-    selected_option_id = cart.get_shipping_option()
-    selected_shipping_option = None
-    try:
-        selected_shipping_option = \
-            ShippingOption.objects.get(id=selected_option_id)
-    except ShippingOption.DoesNotExist:
-        pass
+    resolution = resolve_shipping(cart)
+    available_shipping_options = resolution.options
+    selected_option_id = resolution.selected_id
+    selected_shipping_option = resolution.selected_option
 
     initial = {}
 
@@ -13,6 +13,16 @@ def save_discounts(*args, **kwargs):
     return save_discounts(*args, **kwargs)
 
 
+def check_codes(*args, **kwargs):
+    from .util import check_codes
+    return check_codes(*args, **kwargs)
+
+
+def release_discounts(*args, **kwargs):
+    from .util import release_discounts
+    return release_discounts(*args, **kwargs)
+
+
 def get_context(request):
     from .util import vouchers_context
     return vouchers_context(request)
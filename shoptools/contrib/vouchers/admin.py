@@ -2,17 +2,23 @@
 
 from datetime import date
 
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin.helpers import ActionForm
+from django.db import transaction
 try:
     from django.urls import reverse
 except ImportError:
     from django.core.urlresolvers import reverse
-from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 from django.utils.text import mark_safe
 
 from .models import PercentageVoucher, FixedVoucher, Discount, \
     FreeShippingVoucher
-from .export import generate_csv
+from shoptools.exports import export_response
+
+from .export import stream_csv, GENERATED_FIELDS
+from .util import copy_fields, generate_vouchers
 
 
 @admin.register(Discount)
@@ -20,6 +26,10 @@ class DiscountAdmin(admin.ModelAdmin):
     readonly_fields = ('order', 'base_voucher', 'amount', )
     list_display = ('order', 'voucher', 'amount')
 
+    def get_queryset(self, request):
+        qs = super(DiscountAdmin, self).get_queryset(request)
+        return qs.select_related('order').select_vouchers()
+
     def has_add_permission(self, request):
         return False
 
@@ -31,15 +41,58 @@ class DiscountInline(admin.TabularInline):
     can_delete = False
     readonly_fields = ('base_voucher', 'amount', )
 
+    def get_queryset(self, request):
+        qs = super(DiscountInline, self).get_queryset(request)
+        return qs.select_vouchers()
+
+
+class GenerateVouchersForm(ActionForm):
+    count = forms.IntegerField(min_value=1, required=False,
+                               help_text="Number of copies to generate")
+
 
 class VoucherAdmin(admin.ModelAdmin):
-    list_display = ('__str__', 'limit_', 'minimum_spend', 'code',
-                    'created', )
+    list_display = ('__str__', 'limit_', 'use_count', 'minimum_spend',
+                    'code', 'created', )
     list_filter = ('created', )
+    action_form = GenerateVouchersForm
+    actions = ('generate_copies', )
 
     def limit_(self, obj):
         return obj.limit or ''
 
+    def generate_copies(self, request, queryset):
+        """Create the given number of copies of each selected voucher, with
+           new codes, and download them as CSV. """
+
+        try:
+            count = int(request.POST.get('count', ''))
+        except ValueError:
+            count = 0
+        if count < 1:
+            self.message_user(request, "Enter the number of copies",
+                              level=messages.ERROR)
+            return None
+
+        # create every copy before responding, so a failure (or the client
+        # going away) part way through can't leave some created but missing
+        # from the download
+        with transaction.atomic():
+            vouchers = [
+                copy for voucher in list(queryset)
+                for chunk in generate_vouchers(type(voucher), count,
+                                               **copy_fields(voucher))
+                for copy in chunk]
+
+        filename = 'Vouchers_' + date.today().strftime('%Y%m%d')
+        response = StreamingHttpResponse(
+            stream_csv(vouchers, GENERATED_FIELDS), content_type='text/csv')
+        response['Content-Disposition'] = \
+            "attachment; filename=%s.csv" % filename
+        return response
+    generate_copies.short_description = \
+        "Generate copies of selected vouchers"
+
 
 admin.site.register(PercentageVoucher, VoucherAdmin)
 admin.site.register(FreeShippingVoucher, VoucherAdmin)
@@ -51,7 +104,7 @@ class FixedVoucherAdmin(VoucherAdmin):
         'order', 'amount_redeemed', 'amount_remaining', )
     readonly_fields = ('currency_code', )
     exclude = ('limit', )
-    actions = ('csv_export', )
+    actions = VoucherAdmin.actions + ('csv_export', )
 
     def amount_remaining(self, obj):
         val = obj.amount_remaining()
@@ -67,11 +120,6 @@ class FixedVoucherAdmin(VoucherAdmin):
 
     def csv_export(self, request, queryset):
         filename = 'Vouchers_' + date.today().strftime('%Y%m%d')
-
-        # response = HttpResponse()
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = \
-            "attachment; filename=%s.csv" % filename
-
-        generate_csv(queryset, response)
-        return response
+        return export_response(
+            self, request, queryset,
+            'shoptools.contrib.vouchers.export.stream_export', filename)
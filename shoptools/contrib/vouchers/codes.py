@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory Bloom filter of valid voucher codes, so get_vouchers can reject
+codes which definitely don't exist (e.g. from bots guessing codes) without
+querying the database.
+
+The filter is built lazily from the voucher table. Codes are added to this
+process's filter when a voucher is saved (see the receivers in models.py) or
+bulk created, and a generation token in the default cache is changed once
+the transaction adding them commits, so other processes rebuild their
+filters too. Filters are also rebuilt after SHOPTOOLS_VOUCHER_CODE_FILTER_TTL
+seconds, in case a change is missed. Bloom filters never give false
+negatives, so after changing codes without saving (e.g. QuerySet.update),
+call invalidate_code_filter().
+
+Disabled if SHOPTOOLS_VOUCHER_CODE_FILTER is False.
+"""
+
+import math
+import time
+import uuid
+import hashlib
+import threading
+
+from django.core.cache import cache
+from django.db import transaction
+
+from shoptools import settings as shoptools_settings
+
+
+CACHE_KEY = 'shoptools_voucher_code_filter'
+
+
+class BloomFilter(object):
+    """Fixed-size Bloom filter of strings, sized for capacity items at the
+       given false positive rate. """
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = max(int(capacity), 1)
+        self.size = int(math.ceil(
+            -self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(
+            float(self.size) / self.capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # double hashing, see Kirsch & Mitzenmacher, "Less Hashing, Same
+        # Performance"
+        digest = hashlib.sha1(key.encode('utf-8')).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:16], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for p in self._positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[p >> 3] & (1 << (p & 7))
+                   for p in self._positions(key))
+
+    @property
+    def full(self):
+        return self.count >= self.capacity
+
+
+class Counters(object):
+    """Thread-safe named counters, for monitoring. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + n
+
+    def as_dict(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+counters = Counters()
+
+
+class CodeFilter(object):
+    def __init__(self, token):
+        from .models import BaseVoucher
+
+        self.token = token
+        self.built = time.time()
+
+        qs = BaseVoucher.objects.values_list('code', flat=True)
+        # leave room for codes added before the next rebuild
+        self.bloom = BloomFilter(
+            qs.count() * 2 + 1000,
+            shoptools_settings.VOUCHER_CODE_FILTER_ERROR_RATE)
+        for code in qs.iterator():
+            self.bloom.add(code)
+
+        counters.incr('rebuilds')
+
+    @property
+    def expired(self):
+        ttl = shoptools_settings.VOUCHER_CODE_FILTER_TTL
+        return bool(ttl) and time.time() - self.built > ttl
+
+
+_lock = threading.Lock()
+_filter = None
+
+
+def _current_token():
+    token = cache.get(CACHE_KEY)
+    if token is None:
+        cache.add(CACHE_KEY, uuid.uuid4().hex, None)
+        token = cache.get(CACHE_KEY)
+    return token
+
+
+def get_code_filter():
+    """Return the current CodeFilter, rebuilding it if it has been
+       invalidated in this or any other process. """
+
+    global _filter
+
+    token = _current_token()
+    code_filter = _filter
+    if code_filter is not None and code_filter.token == token and \
+            not code_filter.expired:
+        return code_filter
+
+    with _lock:
+        if _filter is None or _filter.token != token or _filter.expired:
+            _filter = CodeFilter(token)
+        return _filter
+
+
+def invalidate_code_filter():
+    global _filter
+
+    _filter = None
+    cache.set(CACHE_KEY, uuid.uuid4().hex, None)
+
+
+def add_codes(codes):
+    """Add new (normalised) codes to this process's filter. If any weren't
+       in it already, other processes are told to rebuild theirs once the
+       current transaction commits, however many codes were added in it. """
+
+    global _filter
+
+    if not shoptools_settings.VOUCHER_CODE_FILTER:
+        return
+
+    with _lock:
+        code_filter = _filter
+        new_codes = True
+        if code_filter is not None:
+            new_codes = [code for code in codes
+                         if code not in code_filter.bloom]
+            for code in new_codes:
+                code_filter.bloom.add(code)
+            if code_filter.bloom.full:
+                # too many additions for the false positive rate, so rebuild
+                code_filter = _filter = None
+    if not new_codes:
+        return
+
+    _pending.codes = True
+    transaction.on_commit(lambda: _publish(code_filter))
+
+
+_pending = threading.local()
+
+
+def _publish(code_filter):
+    # several callbacks may be registered in one transaction, so only the
+    # first publishes a new token
+    if not getattr(_pending, 'codes', False):
+        return
+    _pending.codes = False
+
+    token = uuid.uuid4().hex
+    cache.set(CACHE_KEY, token, None)
+    with _lock:
+        if code_filter is not None and _filter is code_filter:
+            code_filter.token = token
+
+
+def possible_codes(codes):
+    """Return the set of (normalised) codes which may match a voucher, i.e.
+       without those which definitely don't. """
+
+    codes = set(codes)
+    if not shoptools_settings.VOUCHER_CODE_FILTER or not codes:
+        return codes
+
+    bloom = get_code_filter().bloom
+    possible = set(code for code in codes if code in bloom)
+
+    counters.incr('lookups', len(codes))
+    counters.incr('rejected', len(codes) - len(possible))
+    return possible
+
+
+def stats():
+    """Return counters for monitoring: lookups and rejected (by the filter),
+       rebuilds, failed_attempts and throttled (see check_codes), plus the
+       filter's current size and capacity. """
+
+    data = dict.fromkeys(('lookups', 'rejected', 'rebuilds',
+                          'failed_attempts', 'throttled'), 0)
+    data.update(counters.as_dict())
+
+    code_filter = _filter
+    data['size'] = code_filter.bloom.count if code_filter else None
+    data['capacity'] = code_filter.bloom.capacity if code_filter else None
+    return data
@@ -2,6 +2,8 @@
 
 import csv
 
+from shoptools.exports import Echo
+
 
 FIELDS = (
     ('Amount', 'amount'),
@@ -11,22 +13,48 @@ FIELDS = (
     ('Order', 'order_line.parent_object'),
     ('Order ID', 'order_line.parent_object.pk'),
     ('Amount Redeemed', 'amount_redeemed'),
-    ('Amount Remaining', lambda o: o.amount_remaining()
-        if o.amount_remaining() is not None else ''),
+    ('Amount Remaining', 'amount_remaining'),
 )
 
 
-def generate_csv(qs, file_object):
-    csvfile = csv.writer(file_object)
-    header = [f[0] for f in FIELDS]
-    csvfile.writerow(header)
+GENERATED_FIELDS = (
+    ('Code', 'code'),
+    ('Voucher', 'discount_text'),
+    ('Limit', 'limit'),
+    ('Minimum Spend', 'minimum_spend'),
+    ('Expiry Date', 'expiry_date'),
+)
+
+
+def stream_csv(objects, fields=FIELDS):
+    """Yield lines of CSV for an iterable of vouchers, e.g. for a
+       StreamingHttpResponse. """
+
+    csvfile = csv.writer(Echo())
+    yield csvfile.writerow([f[0] for f in fields])
 
-    for obj in qs:
-        row = []
-        for name, getter in FIELDS:
-            row.append(getval(obj, getter))
+    for obj in objects:
+        yield csvfile.writerow(
+            [getval(obj, getter) for name, getter in fields])
 
-        csvfile.writerow(row)
+
+def export_queryset(qs, chunk_size=2000):
+    """Iterate over FixedVouchers for export, fetching each voucher's order
+       line and order in the same query, chunk_size rows at a time. The
+       redemption figures come from the stored usage totals, so the whole
+       export runs without a query per row. """
+
+    return qs.select_related('order_line__parent_object') \
+             .iterator(chunk_size=chunk_size)
+
+
+def stream_export(qs):
+    return stream_csv(export_queryset(qs))
+
+
+def generate_csv(qs, file_object):
+    for line in stream_export(qs):
+        file_object.write(line)
 
 
 def getval(obj, getter):
@@ -0,0 +1,88 @@
+import itertools
+import time
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from shoptools import settings as shoptools_settings
+from shoptools.contrib.vouchers.export import GENERATED_FIELDS, stream_csv
+from shoptools.contrib.vouchers.models import \
+    FixedVoucher, PercentageVoucher, FreeShippingVoucher
+from shoptools.contrib.vouchers.util import generate_vouchers
+
+
+VOUCHER_TYPES = {
+    'fixed': FixedVoucher,
+    'percentage': PercentageVoucher,
+    'free-shipping': FreeShippingVoucher,
+}
+
+
+class Command(BaseCommand):
+    help = ('Generate a batch of vouchers with unique random codes, e.g. '
+            'gift cards for a promotion, and write them out as CSV.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('count', type=int)
+        parser.add_argument('--type', default='fixed',
+                            choices=sorted(VOUCHER_TYPES))
+        parser.add_argument('--amount', default=None,
+                            help="Dollar amount or percentage")
+        parser.add_argument(
+            '--currency-code',
+            default=shoptools_settings.DEFAULT_CURRENCY_CODE)
+        parser.add_argument(
+            '--currency-symbol',
+            default=shoptools_settings.DEFAULT_CURRENCY_SYMBOL)
+        parser.add_argument('--limit', type=int, default=None)
+        parser.add_argument('--minimum-spend', type=int, default=0)
+        parser.add_argument('--expiry-date', default=None,
+                            help="YYYY-MM-DD")
+        parser.add_argument('--prefix', default='')
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--output', default=None,
+                            help="CSV file to write (default stdout)")
+
+    def handle(self, count, type, amount, chunk_size, prefix, output,
+               **options):
+        model = VOUCHER_TYPES[type]
+        fields = {'minimum_spend': options['minimum_spend']}
+
+        if model is FreeShippingVoucher:
+            if amount is not None:
+                raise CommandError('Free shipping vouchers have no amount')
+        elif amount is None:
+            raise CommandError('--amount is required')
+        else:
+            try:
+                fields['amount'] = model._meta.get_field('amount') \
+                    .clean(amount, None)
+            except ValidationError as e:
+                raise CommandError('Invalid amount: %s' % ' '.join(e))
+
+        if model is FixedVoucher:
+            fields['currency_code'] = options['currency_code']
+            fields['currency_symbol'] = options['currency_symbol']
+        else:
+            fields['limit'] = options['limit']
+
+        if options['expiry_date']:
+            fields['expiry_date'] = parse_date(options['expiry_date'])
+            if not fields['expiry_date']:
+                raise CommandError('Invalid expiry date')
+
+        started = time.time()
+        vouchers = itertools.chain.from_iterable(generate_vouchers(
+            model, count, prefix=prefix, chunk_size=chunk_size, **fields))
+        lines = stream_csv(vouchers, GENERATED_FIELDS)
+
+        if output:
+            with open(output, 'w', newline='') as f:
+                f.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
+
+        elapsed = time.time() - started
+        self.stderr.write('Created %s vouchers in %.1fs' % (count, elapsed))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from shoptools.contrib.vouchers.util import reconcile_usage
+
+
+class Command(BaseCommand):
+    help = ("Rebuild vouchers' denormalised use_count and amount redeemed "
+            "totals from their discounts.")
+
+    def handle(self, **options):
+        fixed = reconcile_usage()
+        self.stdout.write('Updated usage totals for %s vouchers' % fixed)
@@ -0,0 +1,28 @@
+from django.db import migrations
+from django.db.models import Count
+from django.db.models.functions import Upper
+
+
+def uppercase_codes(apps, schema_editor):
+    BaseVoucher = apps.get_model('vouchers', 'BaseVoucher')
+
+    clashes = BaseVoucher.objects.annotate(upper_code=Upper('code')) \
+        .values('upper_code').annotate(n=Count('id')).filter(n__gt=1) \
+        .values_list('upper_code', flat=True)
+    if clashes:
+        raise ValueError(
+            'Voucher codes differ only by case, rename them before '
+            'migrating: %s' % ', '.join(clashes))
+
+    BaseVoucher.objects.update(code=Upper('code'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vouchers', '0002_auto_20180723_1412'),
+    ]
+
+    operations = [
+        migrations.RunPython(uppercase_codes, migrations.RunPython.noop),
+    ]
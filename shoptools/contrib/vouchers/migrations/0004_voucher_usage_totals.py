@@ -0,0 +1,36 @@
+# Generated by Django 2.1.15 on 2026-10-19 05:29
+
+from django.db import migrations, models
+
+
+def populate_usage_totals(apps, schema_editor):
+    BaseVoucher = apps.get_model('vouchers', 'BaseVoucher')
+    Discount = apps.get_model('vouchers', 'Discount')
+
+    usage = Discount.objects.order_by().values('base_voucher') \
+        .annotate(count=models.Count('pk'), amount=models.Sum('amount'))
+    for row in usage.iterator():
+        BaseVoucher.objects.filter(pk=row['base_voucher']).update(
+            use_count=row['count'], _amount_redeemed=row['amount'] or 0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vouchers', '0003_uppercase_codes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='basevoucher',
+            name='_amount_redeemed',
+            field=models.DecimalField(db_column='amount_redeemed', decimal_places=2, default=0, editable=False, max_digits=10, verbose_name='amount redeemed'),
+        ),
+        migrations.AddField(
+            model_name='basevoucher',
+            name='use_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(populate_usage_totals,
+                             migrations.RunPython.noop),
+    ]
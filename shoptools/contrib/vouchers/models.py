@@ -1,10 +1,12 @@
 # from datetime import datetime
+import decimal
 import uuid
 
-from django.db import models
+from django.db import models, transaction
 from django.template.defaultfilters import floatformat
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.core.exceptions import ValidationError
+from django.dispatch import receiver
 from model_utils.managers import InheritanceManager
 
 from shoptools import settings as shoptools_settings
@@ -13,7 +15,17 @@ from shoptools.checkout.models import Order, OrderLine
 
 def make_code():
     u = uuid.uuid4()
-    return str(u).replace('-', '')[:8]
+    return normalise_code(str(u).replace('-', '')[:8])
+
+
+def normalise_code(code):
+    """Codes are stored upper-cased so they can be looked up case-insensitively
+       with the unique index on code. """
+    return code.strip().upper()
+
+
+USAGE_FIELDS = ('use_count', '_amount_redeemed')
+CENTS = decimal.Decimal('0.01')
 
 
 class BaseVoucher(models.Model):
@@ -24,30 +36,69 @@ class BaseVoucher(models.Model):
     minimum_spend = models.PositiveIntegerField(default=0)
     expiry_date = models.DateField(blank=True, null=True)
 
+    # Denormalised usage totals, maintained by the Discount post_save and
+    # post_delete receivers below with F() expressions. Rebuild them with
+    # ./manage.py reconcile_voucher_usage
+    use_count = models.PositiveIntegerField(default=0, editable=False)
+    _amount_redeemed = models.DecimalField(
+        max_digits=10, decimal_places=2, default=0, editable=False,
+        db_column='amount_redeemed', verbose_name='amount redeemed')
+
     objects = InheritanceManager()
 
     @property
     def voucher(self):
-        qs = BaseVoucher.objects.select_subclasses()
-        return qs.get(pk=self.pk)
+        """Return this voucher as its subclass, e.g. FixedVoucher. """
+
+        if type(self) is not BaseVoucher:
+            return self
+        if getattr(self, '_voucher', None) is None:
+            qs = BaseVoucher.objects.select_subclasses()
+            self._voucher = qs.get(pk=self.pk)
+        return self._voucher
 
     @property
     def base_voucher(self):
-        return BaseVoucher.objects.get(pk=self.pk)
+        """Return this voucher as a plain BaseVoucher. For subclasses this is
+           built from the inherited fields, without a query. """
+
+        if type(self) is BaseVoucher:
+            return self
+        fields = BaseVoucher._meta.concrete_fields
+        base = BaseVoucher.from_db(
+            self._state.db, [f.attname for f in fields],
+            [getattr(self, f.attname) for f in fields])
+        base._voucher = self
+        return base
+
+    def refresh_from_db(self, *args, **kwargs):
+        self._voucher = None
+        return super(BaseVoucher, self).refresh_from_db(*args, **kwargs)
 
     def uses(self, exclude={}):
         return Discount.objects.exclude(**exclude) \
-                               .filter(base_voucher=self.base_voucher)
+                               .filter(base_voucher_id=self.pk)
+
+    def excluded_usage(self, exclude={}):
+        """Return (count, amount) of this voucher's discounts matching the
+           exclude lookups, which are left out of the usage totals. """
+
+        if not exclude:
+            return (0, 0)
+        usage = Discount.objects.filter(base_voucher_id=self.pk, **exclude) \
+            .aggregate(count=models.Count('pk'), amount=models.Sum('amount'))
+        return (usage['count'], usage['amount'] or 0)
 
     def available(self, exclude={}):
         # FixedVoucher always unlimited uses
         if self.limit is None or isinstance(self.voucher, FixedVoucher):
             return True
-        return bool(self.limit - self.uses(exclude).count())
+        count, amount = self.excluded_usage(exclude)
+        return self.use_count - count < self.limit
 
     def amount_redeemed(self, exclude={}):
-        uses = self.uses(exclude)
-        return uses.aggregate(models.Sum('amount'))['amount__sum'] or 0
+        count, amount = self.excluded_usage(exclude)
+        return self._amount_redeemed - amount
 
     def amount_remaining(self, exclude={}):
         """Return dollar amount remaining on a voucher, where it makes sense.
@@ -62,8 +113,41 @@ class BaseVoucher(models.Model):
     def save(self, *args, **kwargs):
         if not self.code:
             self.code = make_code()
+        self.code = normalise_code(self.code)
+
+        # don't clobber usage totals updated concurrently via F() expressions
+        if not self._state.adding and not kwargs.get('update_fields') and \
+                not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in USAGE_FIELDS]
+
         return super(BaseVoucher, self).save(*args, **kwargs)
 
+    @classmethod
+    def adjust_usage(cls, pk, count, amount):
+        cls.objects.filter(pk=pk).update(
+            use_count=models.F('use_count') + count,
+            _amount_redeemed=models.F('_amount_redeemed') + amount)
+
+    def claim(self, amount):
+        """Record one use of the voucher for the given amount, provided it's
+           still available, i.e. under its limit or, for fixed vouchers, with
+           enough balance remaining. The check is part of the UPDATE, so
+           concurrent redemptions can't oversubscribe the voucher, and no row
+           lock is taken if it fails. Return True if the use was claimed. """
+
+        qs = BaseVoucher.objects.filter(pk=self.pk)
+        voucher = self.voucher
+        if isinstance(voucher, FixedVoucher):
+            qs = qs.filter(_amount_redeemed__lte=voucher.amount - amount)
+        else:
+            qs = qs.filter(models.Q(limit__isnull=True) |
+                           models.Q(use_count__lt=models.F('limit')))
+        return bool(qs.update(
+            use_count=models.F('use_count') + 1,
+            _amount_redeemed=models.F('_amount_redeemed') + amount))
+
     def __str__(self):
         return '%s (%s)' % (self.code, self.voucher.discount_text)
 
@@ -112,16 +196,36 @@ class FreeShippingVoucher(BaseVoucher):
         return 'free shipping'
 
 
+class DiscountQuerySet(models.QuerySet):
+    def select_vouchers(self):
+        """Fetch every discount's voucher as its subclass in one extra query,
+           so discount.voucher doesn't need a query per discount. """
+
+        return self.prefetch_related(models.Prefetch(
+            'base_voucher', queryset=BaseVoucher.objects.select_subclasses()))
+
+
 class Discount(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE)
     base_voucher = models.ForeignKey(BaseVoucher, on_delete=models.PROTECT)
     amount = models.DecimalField(max_digits=6, decimal_places=2)
 
+    objects = DiscountQuerySet.as_manager()
+
     def __init__(self, *args, **kwargs):
         voucher = kwargs.pop('voucher', None)
         if voucher:
             kwargs['base_voucher'] = voucher.base_voucher
         super(Discount, self).__init__(*args, **kwargs)
+        # (base_voucher_id, amount) as currently included in the voucher's
+        # usage totals
+        self._counted = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Discount, cls).from_db(db, field_names, values)
+        instance._counted = (instance.base_voucher_id, instance.amount)
+        return instance
 
     @property
     def voucher(self):
@@ -131,6 +235,21 @@ class Discount(models.Model):
     def voucher(self, voucher_obj):
         self.base_voucher = voucher_obj.base_voucher
 
+    def redeem(self):
+        """Save this (new) discount, claiming its use of the voucher in the
+           same transaction. Return False, without saving, if the voucher has
+           been used up in the meantime. """
+
+        assert self.pk is None
+        self.amount = decimal.Decimal(self.amount).quantize(CENTS)
+        with transaction.atomic():
+            if not self.base_voucher.claim(self.amount):
+                return False
+            # already counted, so the post_save receiver leaves it alone
+            self._counted = (self.base_voucher_id, self.amount)
+            self.save()
+        return True
+
     def clean(self):
         """Verify that the voucher doesn't violate
            - the usage limit (if there is one)
@@ -139,16 +258,16 @@ class Discount(models.Model):
         """
 
         voucher = self.voucher
-        uses = voucher.uses(exclude={'pk': self.pk})
+        exclude = {'pk': self.pk} if self.pk else {}
 
-        if voucher.limit is not None and uses.count() > voucher.limit:
+        if not voucher.available(exclude=exclude):
             raise ValidationError("Voucher has already been used")
 
         if isinstance(voucher, FixedVoucher):
             if self.amount > voucher.amount:
                 raise ValidationError("Discount exceeds voucher amount")
 
-        remaining = voucher.amount_remaining(exclude={'pk': self.pk})
+        remaining = voucher.amount_remaining(exclude=exclude)
         if remaining is not None and self.amount > remaining:
             msg = "Discount exceeds voucher's remaining balance"
             raise ValidationError(msg)
@@ -158,3 +277,34 @@ class Discount(models.Model):
             return "%s: %s" % (self.order, self.voucher)
         else:
             return str(self.voucher)
+
+
+@receiver(models.signals.post_save, sender=Discount)
+def count_discount(sender, instance, **kwargs):
+    # round as the db does, so totals match what's stored
+    amount = decimal.Decimal(instance.amount).quantize(CENTS)
+    counted = (instance.base_voucher_id, amount)
+    if instance._counted != counted:
+        if instance._counted:
+            old_voucher_id, old_amount = instance._counted
+            BaseVoucher.adjust_usage(old_voucher_id, -1, -old_amount)
+        BaseVoucher.adjust_usage(instance.base_voucher_id, 1, amount)
+        instance._counted = counted
+
+
+@receiver(models.signals.post_delete, sender=Discount)
+def uncount_discount(sender, instance, **kwargs):
+    if instance._counted:
+        voucher_id, amount = instance._counted
+        BaseVoucher.adjust_usage(voucher_id, -1, -amount)
+        instance._counted = None
+
+
+@receiver(models.signals.post_save)
+def add_voucher_code(sender, instance, **kwargs):
+    # post_save is sent with the concrete class, so connect without a sender
+    # to catch voucher types defined elsewhere (see rules.py)
+    if not issubclass(sender, BaseVoucher):
+        return
+    from .codes import add_codes
+    add_codes([instance.code])
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Registry of product-specific discount rules, so apps can define their own
+voucher types which discount particular items, e.g.
+
+    from shoptools.contrib.vouchers import rules
+
+    class ProductVoucher(BaseVoucher):
+        objects = models.Manager()
+
+        product = models.ForeignKey(Product, on_delete=models.CASCADE)
+        amount = models.DecimalField(max_digits=6, decimal_places=2)
+
+    @rules.register(ProductVoucher)
+    class ProductRule(rules.DiscountRule):
+        content_type = 'catalogue.product'
+
+        def __init__(self, voucher):
+            super(ProductRule, self).__init__(voucher)
+            self.item_ids = [voucher.product_id]
+
+        def get_amount(self, lines_total):
+            return min(lines_total, self.voucher.amount)
+
+calculate_discounts builds one rule per matching voucher, then indexes the
+rules by (content type, item id) once, so matching lines to rules is linear
+in the number of lines plus rules.
+"""
+
+import decimal
+from collections import OrderedDict
+
+
+_registry = OrderedDict()
+
+
+class DiscountRule(object):
+    """Base class for discount rules, which are instantiated with a voucher
+       for each calculation. Subclasses should set
+
+           content_type: 'app_label.model_name' of the items the rule applies
+               to, or None for any item
+           item_ids: ids of the items it applies to, or None for all items of
+               content_type
+
+       and may override matches() to filter items further. Each cart line is
+       discounted by at most one rule, the one with the highest priority. """
+
+    content_type = None
+    item_ids = None
+    priority = 0
+
+    def __init__(self, voucher):
+        self.voucher = voucher
+
+    def matches(self, item):
+        return True
+
+    def get_amount(self, lines_total):
+        """Return the discount for the total of the lines this rule applies
+           to. """
+        raise NotImplementedError()
+
+
+def register(voucher_cls):
+    """Class decorator registering a DiscountRule subclass for vouchers of
+       the given BaseVoucher subclass. """
+
+    def inner(rule_cls):
+        _registry[voucher_cls] = rule_cls
+        return rule_cls
+    return inner
+
+
+def get_rule_cls(voucher):
+    return _registry.get(type(voucher))
+
+
+class RuleIndex(object):
+    """Index of rules by the items they target. """
+
+    def __init__(self, rules):
+        self.by_item = {}
+        self.by_ctype = {}
+        self.any_item = []
+
+        for rule in rules:
+            if rule.content_type is None:
+                self.any_item.append(rule)
+            elif rule.item_ids is None:
+                self.by_ctype.setdefault(rule.content_type, []).append(rule)
+            else:
+                for item_id in rule.item_ids:
+                    self.by_item.setdefault(
+                        (rule.content_type, item_id), []).append(rule)
+
+    def candidates(self, line):
+        ctype = line.ctype
+        return self.by_item.get((ctype, line.item.pk), []) + \
+            self.by_ctype.get(ctype, []) + self.any_item
+
+
+def apply_rules(vouchers, lines):
+    """Match cart lines to the rules for any vouchers with a registered rule.
+       Return a list of (voucher, amount) for the vouchers whose rules
+       matched at least one line, in the order given. """
+
+    rules = []
+    for voucher in vouchers:
+        rule_cls = get_rule_cls(voucher)
+        if rule_cls:
+            rules.append(rule_cls(voucher))
+    if not rules:
+        return []
+
+    index = RuleIndex(rules)
+    totals = OrderedDict((rule, 0) for rule in rules)
+    matched = set()
+
+    for line in lines:
+        best = None
+        for rule in index.candidates(line):
+            if (best is None or rule.priority > best.priority) and \
+                    rule.matches(line.item):
+                best = rule
+        if best is not None:
+            totals[best] += line.total or 0
+            matched.add(best)
+
+    return [(rule.voucher, rule.get_amount(decimal.Decimal(total)))
+            for rule, total in totals.items() if rule in matched]
@@ -0,0 +1,480 @@
+import decimal
+import threading
+import time
+from datetime import date, timedelta
+from io import StringIO
+from unittest import mock
+
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management import call_command
+from django.db import connection, models, OperationalError
+from django.test import TestCase, TransactionTestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext, isolate_apps
+
+from shoptools.cart.session import SessionCart
+from shoptools.checkout.models import Order
+from shoptools.contrib.catalogue.models import Product
+
+from .models import BaseVoucher, Discount, FixedVoucher, PercentageVoucher
+from . import rules
+from .export import export_queryset, stream_csv
+from .codes import BloomFilter, get_code_filter, invalidate_code_filter, \
+    stats
+from .util import calculate_discounts, check_codes, generate_vouchers, \
+    get_vouchers, save_discounts
+
+
+class VoucherCodeTestCase(TestCase):
+    def test_codes_stored_upper_case(self):
+        voucher = PercentageVoucher.objects.create(code=' spring10 ',
+                                                   amount=10)
+        self.assertEqual(voucher.code, 'SPRING10')
+
+        voucher = PercentageVoucher.objects.create(amount=10)
+        self.assertEqual(voucher.code, voucher.code.upper())
+
+    def test_get_vouchers(self):
+        PercentageVoucher.objects.create(code='SPRING10', amount=10)
+        FixedVoucher.objects.create(code='GIFT50', amount=50)
+        get_code_filter()
+
+        with self.assertNumQueries(1):
+            vouchers = list(get_vouchers(['spring10', 'Gift50', 'nope']))
+        self.assertEqual(sorted(v.code for v in vouchers),
+                         ['GIFT50', 'SPRING10'])
+        self.assertIsInstance(
+            [v for v in vouchers if v.code == 'GIFT50'][0], FixedVoucher)
+
+
+class CodeFilterTestCase(TestCase):
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000, 0.01)
+        codes = ['CODE%s' % i for i in range(1000)]
+        for code in codes:
+            bloom.add(code)
+        self.assertTrue(all(code in bloom for code in codes))
+        false_positives = sum('OTHER%s' % i in bloom for i in range(1000))
+        self.assertLess(false_positives, 30)
+
+    def test_get_vouchers(self):
+        invalidate_code_filter()
+        PercentageVoucher.objects.create(code='SPRING10', amount=10)
+        get_code_filter()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(list(get_vouchers(['BOGUS123'])), [])
+
+        # codes saved after the filter is built are added to it
+        FixedVoucher.objects.create(code='GIFT50', amount=50)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(get_vouchers(['gift50', 'spring10'])), 2)
+
+    @isolate_apps('shoptools.contrib.vouchers')
+    def test_voucher_subclass(self):
+        class ProductVoucher(BaseVoucher):
+            amount = models.DecimalField(max_digits=6, decimal_places=2)
+
+        code_filter = get_code_filter()
+        voucher = ProductVoucher(code='PRODUCT5', amount=5)
+        models.signals.post_save.send(sender=ProductVoucher,
+                                      instance=voucher, created=True)
+        self.assertIn('PRODUCT5', code_filter.bloom)
+
+        # other models' saves are ignored
+        Product.objects.create(name='Widget', price=20, shipping_cost=0)
+
+    def test_throttle(self):
+        PercentageVoucher.objects.create(code='SPRING10', amount=10)
+        request = RequestFactory().get('/')
+        request.session = SessionStore()
+        cart = SessionCart(request)
+
+        # the default limit is 10 invalid codes
+        for i in range(10):
+            codes, errors = check_codes(cart, ['BOGUS%s' % i])
+            self.assertEqual(errors, [])
+        throttled = stats()['throttled']
+
+        # codes already on the cart are kept, but new ones refused
+        cart.set_voucher_codes(['nope'])
+        codes, errors = check_codes(cart, ['nope', 'spring10'])
+        self.assertEqual(codes, ['nope'])
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(stats()['throttled'], throttled + 1)
+
+
+class CodeFilterPublishTestCase(TransactionTestCase):
+    def test_publish_once_per_transaction(self):
+        from django.core.cache import cache
+        from django.db import transaction
+        from .codes import CACHE_KEY
+
+        PercentageVoucher.objects.create(code='SPRING10', amount=10)
+        code_filter = get_code_filter()
+        token = cache.get(CACHE_KEY)
+
+        with mock.patch.object(cache, 'set', wraps=cache.set) as cache_set:
+            with transaction.atomic():
+                for i in range(3):
+                    FixedVoucher.objects.create(code='GIFT%s' % i, amount=5)
+                list(generate_vouchers(FixedVoucher, 20, chunk_size=5,
+                                       amount=decimal.Decimal(1)))
+                self.assertEqual(cache.get(CACHE_KEY), token)
+            self.assertEqual(cache_set.call_count, 1)
+
+            # this process's filter already has the codes, so is kept
+            self.assertIs(get_code_filter(), code_filter)
+            self.assertIn('GIFT0', code_filter.bloom)
+
+            # saving a voucher whose code is already known publishes nothing
+            PercentageVoucher.objects.get(code='SPRING10').save()
+            self.assertEqual(cache_set.call_count, 1)
+
+
+class VoucherUsageTestCase(TestCase):
+    def setUp(self):
+        self.voucher = FixedVoucher.objects.create(code='GIFT50', amount=50)
+        self.order = Order.objects.create()
+
+    def refresh(self):
+        return FixedVoucher.objects.get(pk=self.voucher.pk)
+
+    def test_usage_totals(self):
+        discount = Discount.objects.create(order=self.order,
+                                           voucher=self.voucher, amount=20)
+        Discount.objects.create(order=Order.objects.create(),
+                                voucher=self.voucher, amount=5)
+        voucher = self.refresh()
+        self.assertEqual(voucher.use_count, 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(voucher.amount_remaining(), 25)
+
+        discount.amount = 10
+        discount.save()
+        self.assertEqual(self.refresh().amount_remaining(), 35)
+        self.assertEqual(self.refresh().use_count, 2)
+
+        discount.delete()
+        voucher = self.refresh()
+        self.assertEqual(voucher.use_count, 1)
+        self.assertEqual(voucher.amount_redeemed(), 5)
+
+        # saving a stale instance doesn't overwrite the totals
+        self.voucher.save()
+        self.assertEqual(self.refresh().use_count, 1)
+
+    def test_limit(self):
+        voucher = PercentageVoucher.objects.create(amount=10, limit=1)
+        self.assertTrue(voucher.available())
+        discount = Discount.objects.create(order=self.order, voucher=voucher,
+                                           amount=2)
+        voucher = PercentageVoucher.objects.get(pk=voucher.pk)
+        self.assertFalse(voucher.available())
+        self.assertTrue(voucher.available(exclude={'pk': discount.pk}))
+
+    def test_reconcile(self):
+        Discount.objects.create(order=self.order, voucher=self.voucher,
+                                amount=20)
+        BaseVoucher.objects.update(use_count=0, _amount_redeemed=0)
+
+        call_command('reconcile_voucher_usage', stdout=StringIO())
+        voucher = self.refresh()
+        self.assertEqual(voucher.use_count, 1)
+        self.assertEqual(voucher.amount_redeemed(), decimal.Decimal(20))
+
+
+class VoucherSubclassTestCase(TestCase):
+    def test_voucher(self):
+        voucher = FixedVoucher.objects.create(code='GIFT50', amount=50)
+        with self.assertNumQueries(0):
+            self.assertIs(voucher.voucher, voucher)
+            base = voucher.base_voucher
+            self.assertIs(type(base), BaseVoucher)
+            self.assertEqual(base.pk, voucher.pk)
+            self.assertIs(base.voucher, voucher)
+            self.assertEqual(voucher.amount_remaining(), 50)
+            str(voucher)
+
+        base = BaseVoucher.objects.get(pk=voucher.pk)
+        with self.assertNumQueries(1):
+            self.assertIsInstance(base.voucher, FixedVoucher)
+            self.assertIs(base.voucher, base.voucher)
+
+    def test_select_vouchers(self):
+        fixed = FixedVoucher.objects.create(amount=50)
+        percentage = PercentageVoucher.objects.create(amount=10)
+        for voucher in (fixed, percentage):
+            Discount.objects.create(order=Order.objects.create(),
+                                    voucher=voucher, amount=5)
+
+        with self.assertNumQueries(2):
+            discounts = list(Discount.objects.order_by('pk')
+                             .select_vouchers())
+            self.assertIsInstance(discounts[0].voucher, FixedVoucher)
+            self.assertIsInstance(discounts[1].voucher, PercentageVoucher)
+            [str(d.voucher) for d in discounts]
+
+
+class CartDiscountsTestCase(TestCase):
+    def setUp(self):
+        request = RequestFactory().get('/')
+        request.session = SessionStore()
+        self.cart = SessionCart(request)
+        self.product = Product.objects.create(name='Widget', price=20,
+                                              shipping_cost=0)
+        self.cart.add(self.product, 2)
+        PercentageVoucher.objects.create(code='SPRING10', amount=10)
+
+    def test_memoized(self):
+        self.cart.set_voucher_codes(['spring10', 'nope'])
+        discounts, invalid = self.cart.calculate_discounts()
+        self.assertEqual(invalid, ['NOPE'])
+        self.assertEqual(self.cart.total_discount, 4)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.cart.calculate_discounts(),
+                             (discounts, invalid))
+
+        # changing the cart's codes or contents recalculates
+        self.cart.set_voucher_codes(['spring10'])
+        self.assertEqual(self.cart.calculate_discounts()[1], [])
+        self.cart.add(self.product, 1)
+        self.assertEqual(self.cart.total_discount, 6)
+
+    def test_filters(self):
+        yesterday = date.today() - timedelta(days=1)
+        PercentageVoucher.objects.create(code='EXPIRED', amount=50,
+                                         expiry_date=yesterday)
+        PercentageVoucher.objects.create(code='BIGSPEND', amount=50,
+                                         minimum_spend=100)
+        PercentageVoucher.objects.create(code='USEDUP', amount=50, limit=0)
+        FixedVoucher.objects.create(code='AUD', amount=5,
+                                    currency_code='AUD')
+        FixedVoucher.objects.create(code='NZD', amount=5)
+
+        discounts, invalid = calculate_discounts(
+            self.cart, ['expired', 'bigspend', 'usedup', 'aud', 'nzd',
+                        'spring10'])
+        self.assertEqual(sorted(d.voucher.code for d in discounts),
+                         ['NZD', 'SPRING10'])
+        self.assertEqual(sorted(invalid),
+                         ['AUD', 'BIGSPEND', 'EXPIRED', 'USEDUP'])
+
+    def test_query_count(self):
+        codes = [v.code for v in generate_vouchers(
+            FixedVoucher, 20, amount=decimal.Decimal(1)).__next__()]
+        get_code_filter()
+
+        def count_queries(codes):
+            with CaptureQueriesContext(connection) as queries:
+                calculate_discounts(self.cart, codes)
+            return len(queries)
+
+        # warm up the shipping index etc
+        count_queries([])
+        self.assertEqual(count_queries(codes[:1]), count_queries(codes))
+        self.assertEqual(count_queries(codes[:1]), count_queries(codes[:10]))
+
+
+class GenerateVouchersTestCase(TestCase):
+    def test_generate(self):
+        FixedVoucher.objects.create(code='GIFT50', amount=50)
+        vouchers = [v for chunk in generate_vouchers(
+                    FixedVoucher, 25, prefix='gift', chunk_size=10,
+                    amount=decimal.Decimal(20), currency_code='AUD')
+                    for v in chunk]
+
+        self.assertEqual(len(vouchers), 25)
+        self.assertEqual(len(set(v.code for v in vouchers)), 25)
+        self.assertTrue(all(v.code.startswith('GIFT') for v in vouchers))
+        self.assertEqual(FixedVoucher.objects.filter(amount=20).count(), 25)
+
+        voucher = BaseVoucher.objects.select_subclasses() \
+            .get(code=vouchers[0].code)
+        self.assertIsInstance(voucher, FixedVoucher)
+        self.assertEqual(voucher.pk, vouchers[0].pk)
+        self.assertEqual(voucher.currency_code, 'AUD')
+        self.assertEqual(voucher.amount_remaining(), 20)
+
+    def test_admin_copies(self):
+        from django.contrib.auth.models import User
+        from django.urls import reverse
+
+        voucher = PercentageVoucher.objects.create(code='SPRING10',
+                                                   amount=10, limit=1)
+        self.client.force_login(User.objects.create_superuser(
+            'admin', 'a@example.com', 'pw'))
+        response = self.client.post(
+            reverse('admin:vouchers_percentagevoucher_changelist'), {
+                'action': 'generate_copies', 'index': 0, 'count': 3,
+                '_selected_action': [voucher.pk]})
+
+        # created before the download is read
+        self.assertEqual(PercentageVoucher.objects.filter(
+            amount=10, limit=1).count(), 4)
+        lines = b''.join(response.streaming_content).splitlines()
+        self.assertEqual(len(lines), 4)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('generate_vouchers', 3, type='percentage', amount='15',
+                     limit=1, stdout=out, stderr=StringIO())
+
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], 'Code,Voucher,Limit,Minimum Spend,'
+                                   'Expiry Date')
+        self.assertEqual(len(lines), 4)
+        codes = [line.split(',')[0] for line in lines[1:]]
+        self.assertEqual(
+            PercentageVoucher.objects.filter(code__in=codes, amount=15,
+                                             limit=1).count(), 3)
+
+
+class RedeemTestCase(TransactionTestCase):
+    def redeem_concurrently(self, voucher, amount, attempts=8):
+        orders = [Order.objects.create() for i in range(attempts)]
+        results = []
+        errors = []
+        barrier = threading.Barrier(attempts)
+
+        def redeem(order):
+            barrier.wait()
+            try:
+                while True:
+                    try:
+                        results.append(Discount(order=order, voucher=voucher,
+                                                amount=amount).redeem())
+                        return
+                    except OperationalError as e:
+                        # SQLite's shared in-memory test database fails
+                        # immediately rather than waiting for the lock
+                        if 'locked' not in str(e):
+                            raise
+                        time.sleep(0.001)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=redeem, args=(order, ))
+                   for order in orders]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), attempts)
+        return results
+
+    def test_limit(self):
+        voucher = PercentageVoucher.objects.create(amount=10, limit=3)
+        results = self.redeem_concurrently(voucher, 5)
+
+        self.assertEqual(results.count(True), 3)
+        self.assertEqual(Discount.objects.count(), 3)
+        voucher = PercentageVoucher.objects.get(pk=voucher.pk)
+        self.assertEqual(voucher.use_count, 3)
+        self.assertFalse(voucher.available())
+
+    def test_balance(self):
+        voucher = FixedVoucher.objects.create(amount=50)
+        results = self.redeem_concurrently(voucher, 20)
+
+        self.assertEqual(results.count(True), 2)
+        self.assertEqual(
+            FixedVoucher.objects.get(pk=voucher.pk).amount_remaining(), 10)
+
+    def test_payment_failure(self):
+        voucher = PercentageVoucher.objects.create(code='ONCE', amount=10,
+                                                   limit=1)
+        order = Order.objects.create()
+        product = Product.objects.create(name='Widget', price=20,
+                                         shipping_cost=0)
+        order.lines.create(item=product, quantity=1)
+
+        saved, unavailable = save_discounts(order, ['ONCE'])
+        self.assertEqual((len(saved), unavailable), (1, []))
+        self.assertEqual(save_discounts(Order.objects.create(), ['ONCE']),
+                         ([], []))
+
+        order.transaction_failed()
+        self.assertEqual(order.discount_set.count(), 0)
+        self.assertTrue(PercentageVoucher.objects.get(
+            pk=voucher.pk).available())
+
+
+class ExportTestCase(TestCase):
+    def test_export(self):
+        product = Product.objects.create(name='Gift card', price=50,
+                                         shipping_cost=0)
+        for i in range(3):
+            order = Order.objects.create()
+            line = order.lines.create(item=product, quantity=1)
+            voucher = FixedVoucher.objects.create(amount=50, order_line=line)
+            Discount.objects.create(order=Order.objects.create(),
+                                    voucher=voucher, amount=20)
+        FixedVoucher.objects.create(amount=10)
+
+        with self.assertNumQueries(1):
+            lines = list(stream_csv(export_queryset(
+                FixedVoucher.objects.order_by('pk'), chunk_size=2)))
+
+        self.assertEqual(len(lines), 5)
+        row = lines[3].strip().split(',')
+        self.assertEqual(row[4:6], [str(order), str(order.pk)])
+        self.assertEqual(row[-2:], ['20.00', '30.00'])
+        self.assertEqual(lines[-1].strip().split(',')[-2:], ['', '10.00'])
+
+
+class StubVoucher(object):
+    def __init__(self, amount, item_ids=None):
+        self.amount = amount
+        self.item_ids = item_ids
+
+
+class StubItem(object):
+    def __init__(self, pk, allow_discounts=True):
+        self.pk = pk
+        self.allow_discounts = allow_discounts
+
+
+class StubLine(object):
+    def __init__(self, ctype, item, total):
+        self.ctype = ctype
+        self.item = item
+        self.total = total
+
+
+class DiscountRulesTestCase(TestCase):
+    def setUp(self):
+        class StubRule(rules.DiscountRule):
+            content_type = 'catalogue.product'
+
+            def __init__(self, voucher):
+                super(StubRule, self).__init__(voucher)
+                self.item_ids = voucher.item_ids
+                # item-specific rules win over catalogue-wide ones
+                self.priority = 1 if voucher.item_ids else 0
+
+            def matches(self, item):
+                return item.allow_discounts
+
+            def get_amount(self, lines_total):
+                return lines_total * self.voucher.amount / 100
+
+        rules.register(StubVoucher)(StubRule)
+        self.addCleanup(rules._registry.pop, StubVoucher)
+
+    def test_apply_rules(self):
+        widget = StubVoucher(50, item_ids=[1])
+        catalogue = StubVoucher(10)
+        lines = [
+            StubLine('catalogue.product', StubItem(1), 20),
+            StubLine('catalogue.product', StubItem(2), 30),
+            StubLine('catalogue.product', StubItem(3, False), 40),
+            StubLine('other.model', StubItem(1), 50),
+        ]
+
+        self.assertEqual(rules.apply_rules([catalogue, widget], lines),
+                         [(catalogue, 3), (widget, 10)])
+        self.assertEqual(rules.apply_rules([widget], lines[1:]), [])
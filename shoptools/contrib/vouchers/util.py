@@ -1,22 +1,71 @@
 import decimal
+import time
 from datetime import date
-from functools import reduce
 
-from django.db.models import Q
+from django.db import connections, router, transaction
+from django.db.models import \
+    Count, DecimalField, F, IntegerField, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
 
+from shoptools import settings as shoptools_settings
 from shoptools.util import get_vouchers_module
 from shoptools.abstractions.models import ICart
 from shoptools.checkout.models import Order
 
 from .models import \
-    BaseVoucher, FreeShippingVoucher, Discount, FixedVoucher, PercentageVoucher
+    BaseVoucher, FreeShippingVoucher, Discount, FixedVoucher, \
+    PercentageVoucher, USAGE_FIELDS, make_code, normalise_code
+from .codes import add_codes, counters, possible_codes
+from .rules import apply_rules, get_rule_cls
+
+
+ATTEMPTS_SESSION_KEY = 'shoptools_voucher_attempts'
 
 
 def get_vouchers(codes):
     qs = BaseVoucher.objects.select_subclasses()
+    # skip the query for codes which definitely don't exist
+    codes = possible_codes(normalise_code(c) for c in codes)
     if not len(codes):
         return qs.none()
-    return qs.filter(reduce(Q.__or__, [Q(code__iexact=c) for c in codes]))
+    return qs.filter(code__in=codes)
+
+
+def check_codes(cart, codes):
+    """Throttle failed voucher code attempts per session. Each new code
+       (i.e. not already on the cart) which doesn't match a voucher counts as
+       a failed attempt, and once a session has VOUCHER_ATTEMPT_LIMIT failures
+       within VOUCHER_ATTEMPT_WINDOW seconds, further new codes are refused.
+
+       return (codes, errors)
+    """
+
+    session = getattr(getattr(cart, 'request', None), 'session', None)
+    if session is None:
+        return (codes, [])
+
+    existing = set(normalise_code(c) for c in cart.get_voucher_codes())
+    new = set(normalise_code(c) for c in codes) - existing
+    if not new:
+        return (codes, [])
+
+    now = time.time()
+    window = now - shoptools_settings.VOUCHER_ATTEMPT_WINDOW
+    failures = [t for t in session.get(ATTEMPTS_SESSION_KEY, [])
+                if t > window]
+
+    if len(failures) >= shoptools_settings.VOUCHER_ATTEMPT_LIMIT:
+        counters.incr('throttled')
+        codes = [c for c in codes if normalise_code(c) in existing]
+        return (codes, ['Too many invalid voucher codes, please try again '
+                        'later.'])
+
+    found = set(v.code for v in get_vouchers(new))
+    failed = len(new - found)
+    if failed:
+        counters.incr('failed_attempts', failed)
+        session[ATTEMPTS_SESSION_KEY] = failures + [now] * failed
+    return (codes, [])
 
 
 def calculate_discounts(obj, codes, include_shipping=True):
@@ -33,12 +82,15 @@ def calculate_discounts(obj, codes, include_shipping=True):
 
     assert isinstance(obj, ICart)
 
-    codes = set([c.upper() for c in codes])  # normalise and remove duplicates
-    vouchers = get_vouchers(codes)
+    # normalise and remove duplicates
+    codes = set([normalise_code(c) for c in codes])
+
+    subtotal = obj.subtotal
+    currency_code, _ = obj.get_currency()
 
     discounts = []
-    total = obj.subtotal + (decimal.Decimal(obj.shipping_cost)
-                            if include_shipping else decimal.Decimal(0))
+    total = subtotal + (decimal.Decimal(obj.shipping_cost)
+                        if include_shipping else decimal.Decimal(0))
     # if obj is or has an associated an order, and the voucher has already been
     # used on that order, those instances are ignored when checking limits etc,
     # since they will be overridden when it's saved. The order is also attached
@@ -52,16 +104,30 @@ def calculate_discounts(obj, codes, include_shipping=True):
         else:
             defaults = {}
 
-    # filter out any that have already been used
-    vouchers = [v for v in vouchers if v.available(exclude=defaults)]
-
-    # filter out any that are expired
-    vouchers = [v for v in vouchers if
-                (not v.expiry_date or v.expiry_date >= date.today())]
-
-    # filter out any under their minimum_spend value
-    # invalid_spend = [v for v in vouchers if obj.subtotal < v.minimum_spend]
-    vouchers = [v for v in vouchers if obj.subtotal >= v.minimum_spend]
+    # Usage totals are denormalised onto each voucher, so only vouchers
+    # already used on this order need a query to leave those uses out
+    if defaults.get('order') and defaults['order'].pk:
+        used_on_order = set(Discount.objects.filter(**defaults)
+                            .values_list('base_voucher_id', flat=True))
+    else:
+        used_on_order = set()
+
+    def exclude(voucher):
+        return defaults if voucher.pk in used_on_order else {}
+
+    # filter out any that are expired, under their minimum_spend value, used
+    # up, or (fixed vouchers) in another currency in the query. Vouchers
+    # already used on this order are checked again below, leaving out those
+    # uses.
+    vouchers = get_vouchers(codes).filter(
+        Q(expiry_date__isnull=True) | Q(expiry_date__gte=date.today()),
+        Q(fixedvoucher__isnull=True) |
+        Q(fixedvoucher__currency_code=currency_code),
+        Q(fixedvoucher__isnull=False) | Q(limit__isnull=True) |
+        Q(use_count__lt=F('limit')) | Q(pk__in=used_on_order),
+        minimum_spend__lte=subtotal)
+    vouchers = [v for v in vouchers if v.pk not in used_on_order or
+                v.available(exclude=exclude(v))]
 
     if include_shipping:
         # apply free shipping (only one)
@@ -72,45 +138,25 @@ def calculate_discounts(obj, codes, include_shipping=True):
             discounts.append(
                 Discount(voucher=shipping[0], amount=amount, **defaults))
 
-    # TODO make this generic - let apps define their own product-specific
-    # vouchers and process them here
-
-    # apply product vouchers (max one per product), using the largest if more
-    # than one
-    # product = filter(lambda v: isinstance(v, ProductVoucher), vouchers)
-    # product.sort(key=lambda v: v.amount_remaining(), reverse=True)
-    # products_discounted = []
-    # for voucher in product:
-    #     # one per product
-    #     if voucher.product.id in products_discounted:
-    #         continue
-    #     products_discounted.append(voucher.product.id)
-    #
-    #     # get the order total for this specific product
-    #     product_total = decimal.Decimal(sum([
-    #         line.total for line in obj.get_lines()
-    #         if line.item == voucher.product]))
-    #
-    #     amount = min(product_total, voucher.amount,
-    #                  voucher.amount_remaining())
-    #     if amount == 0:
-    #         continue
-    #     total -= amount
-    #     discounts.append(Discount(voucher=voucher, amount=amount,
-    #                      **defaults))
+    # apply product-specific vouchers, for voucher types with a registered
+    # DiscountRule (see rules.py). Each line is discounted by at most one.
+    for voucher, amount in apply_rules(vouchers, obj.get_lines()):
+        remaining = voucher.amount_remaining(exclude=exclude(voucher))
+        amount = min(total, amount,
+                     remaining if remaining is not None else amount)
+        if amount <= 0:
+            continue
+        total -= amount
+        discounts.append(Discount(voucher=voucher, amount=amount, **defaults))
+    vouchers = [v for v in vouchers if not get_rule_cls(v)]
 
     # apply fixed vouchers, smallest remaining amount first
     fixed = [v for v in vouchers if isinstance(v, FixedVoucher)]
-    fixed.sort(key=lambda v: v.amount_remaining(exclude=defaults))
+    fixed.sort(key=lambda v: v.amount_remaining(exclude=exclude(v)))
 
     for voucher in fixed:
-        # exclude any vouchers that do not match the cart's currency
-        cart_currency_code, _ = obj.get_currency()
-        if voucher.currency_code != cart_currency_code:
-            continue
-
         amount = min(total, voucher.amount,
-                     voucher.amount_remaining(exclude=defaults))
+                     voucher.amount_remaining(exclude=exclude(voucher)))
         if amount == 0:
             continue
         total -= amount
@@ -139,17 +185,156 @@ def calculate_discounts(obj, codes, include_shipping=True):
             Discount(voucher=p_voucher, amount=amount, **defaults))
 
     # identify bad codes and add to the list
-    valid_codes = [d.voucher.code.upper() for d in discounts]
+    valid_codes = [d.voucher.code for d in discounts]
     invalid_codes = [c for c in codes if c not in valid_codes]
     return discounts, invalid_codes
 
 
+def reconcile_usage(queryset=None):
+    """Rebuild the denormalised use_count and amount redeemed totals for the
+       given vouchers (default all) from their Discounts. Returns the number
+       of vouchers whose totals were out of date. """
+
+    if queryset is None:
+        queryset = BaseVoucher.objects.all()
+
+    uses = Discount.objects.filter(base_voucher=OuterRef('pk')) \
+        .order_by().values('base_voucher')
+    count = Coalesce(
+        Subquery(uses.annotate(n=Count('pk')).values('n'),
+                 output_field=IntegerField()), 0)
+    amount = Coalesce(
+        Subquery(uses.annotate(total=Sum('amount')).values('total'),
+                 output_field=DecimalField()), 0)
+
+    stale = queryset.annotate(actual_count=count, actual_amount=amount) \
+        .exclude(use_count=F('actual_count'),
+                 _amount_redeemed=F('actual_amount')) \
+        .values_list('pk', flat=True)
+    stale = list(stale)
+
+    if stale:
+        BaseVoucher.objects.filter(pk__in=stale).update(
+            use_count=count, _amount_redeemed=amount)
+    return len(stale)
+
+
+def unused_codes(count, prefix=''):
+    """Return a list of count distinct new codes, none of which are already
+       in use. Candidates are checked against existing codes in bulk. """
+
+    prefix = normalise_code(prefix)
+    codes = set()
+    while len(codes) < count:
+        candidates = set(prefix + make_code()
+                         for i in range(count - len(codes))) - codes
+        existing = BaseVoucher.objects.filter(code__in=candidates) \
+            .values_list('code', flat=True)
+        codes |= candidates.difference(existing)
+    return list(codes)
+
+
+def bulk_create_vouchers(vouchers):
+    """Insert a list of unsaved vouchers, all of the same BaseVoucher
+       subclass. bulk_create doesn't support multi-table inheritance, so the
+       BaseVoucher rows are bulk created first, then the subclass's own rows
+       are inserted pointing at them, with one executemany per batch. Codes
+       must already be set. """
+
+    model = type(vouchers[0])
+    db = router.db_for_write(model)
+    connection = connections[db]
+
+    with transaction.atomic(using=db):
+        bases = [v.base_voucher for v in vouchers]
+        BaseVoucher.objects.using(db).bulk_create(bases)
+
+        if any(b.pk is None for b in bases):
+            # the backend can't return ids from bulk inserts
+            pks = dict(BaseVoucher.objects.using(db)
+                       .filter(code__in=[b.code for b in bases])
+                       .values_list('code', 'pk'))
+        else:
+            pks = dict((b.code, b.pk) for b in bases)
+
+        for voucher, base in zip(vouchers, bases):
+            # set both the parent link and the inherited id
+            voucher.pk = voucher.id = pks[voucher.code]
+            voucher.created = base.created
+
+        fields = model._meta.local_concrete_fields
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            connection.ops.quote_name(model._meta.db_table),
+            ', '.join(connection.ops.quote_name(f.column) for f in fields),
+            ', '.join(['%s'] * len(fields)))
+        batch_size = max(connection.ops.bulk_batch_size(fields, vouchers), 1)
+        with connection.cursor() as cursor:
+            for i in range(0, len(vouchers), batch_size):
+                cursor.executemany(sql, [
+                    [f.get_db_prep_save(getattr(v, f.attname), connection)
+                     for f in fields]
+                    for v in vouchers[i:i + batch_size]])
+
+    for voucher in vouchers:
+        voucher._state.adding = False
+        voucher._state.db = db
+
+    # bulk inserts don't send post_save
+    add_codes(v.code for v in vouchers)
+    return vouchers
+
+
+def copy_fields(voucher):
+    """Return the field values needed to generate copies of voucher, i.e.
+       everything but its code, usage and any order it was bought with. """
+
+    exclude = ('code', 'created', 'order_line') + USAGE_FIELDS
+    return dict((f.attname, getattr(voucher, f.attname))
+                for f in type(voucher)._meta.concrete_fields
+                if not f.primary_key and f.name not in exclude)
+
+
+def generate_vouchers(model, count, prefix='', chunk_size=500, **fields):
+    """Create count vouchers of the given BaseVoucher subclass with the given
+       field values (e.g. amount) and unique random codes. Vouchers are
+       created chunk_size at a time, each chunk in its own transaction, and
+       yielded as they're created, so they can be written out as they go. """
+
+    remaining = count
+    while remaining > 0:
+        codes = unused_codes(min(chunk_size, remaining), prefix)
+        vouchers = [model(code=code, **fields) for code in codes]
+        bulk_create_vouchers(vouchers)
+        remaining -= len(vouchers)
+        yield vouchers
+
+
 def save_discounts(obj, codes):
+    """Calculate and redeem discounts for an order. Discounts whose voucher
+       has been used up since they were calculated aren't saved.
+
+       return (saved, unavailable) lists of discounts
+    """
+
     assert isinstance(obj, Order)
 
     discounts, invalid = calculate_discounts(obj, codes)
+    saved, unavailable = [], []
     for discount in discounts:
-        discount.save()
+        (saved if discount.redeem() else unavailable).append(discount)
+    return saved, unavailable
+
+
+def release_discounts(obj):
+    """Delete an order's discounts, e.g. when payment fails, releasing their
+       use of the vouchers. They're recalculated when the order is next
+       submitted. """
+
+    assert isinstance(obj, Order)
+
+    # delete individually so the post_delete receiver adjusts usage totals
+    for discount in obj.discount_set.all():
+        discount.delete()
 
 
 def vouchers_context(request):
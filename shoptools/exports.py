@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Background CSV exports, for admin selections too large to export within a
+request. An exporter is the import path of a function taking a queryset and
+yielding lines of CSV, e.g. shoptools.checkout.export.stream_csv. Jobs are
+recorded as checkout.ExportJob, and run either by a pool of
+SHOPTOOLS_EXPORT_THREADS threads in the web process, or by
+
+    ./manage.py run_export_jobs
+
+e.g. from cron. Completed exports can be downloaded from the Export jobs
+admin.
+"""
+
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.http import StreamingHttpResponse
+from django.utils.html import format_html
+from django.utils.module_loading import import_string
+try:
+    from django.urls import reverse
+except ImportError:
+    from django.core.urlresolvers import reverse
+
+from shoptools import settings as shoptools_settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class Echo(object):
+    """File-like object which returns what's written to it, so csv.writer
+       can be used to stream rows. """
+
+    def write(self, value):
+        return value
+
+
+_lock = threading.Lock()
+_executor = None
+
+
+def get_executor():
+    global _executor
+
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=shoptools_settings.EXPORT_THREADS)
+        return _executor
+
+
+def start_export(queryset, exporter, name, user=None, compress=None):
+    """Create an ExportJob for the rows in the queryset, and if there's a
+       thread pool, run it there once the current transaction commits. """
+
+    from shoptools.checkout.models import ExportJob
+
+    if compress is None:
+        compress = shoptools_settings.EXPORT_GZIP
+
+    job = ExportJob.objects.create(
+        name=name, user=user, exporter=exporter, compress=compress,
+        content_type=ContentType.objects.get_for_model(queryset.model),
+        pks=json.dumps(list(queryset.values_list('pk', flat=True)),
+                       cls=DjangoJSONEncoder))
+
+    if shoptools_settings.EXPORT_THREADS:
+        transaction.on_commit(
+            lambda: get_executor().submit(run_in_thread, job.pk))
+    return job
+
+
+def run_job(job, chunk_size=500):
+    """Run a pending job. Return False if it had already been started. """
+
+    if not job.claim():
+        return False
+    job.run(chunk_size=chunk_size)
+    return True
+
+
+def run_in_thread(job_pk):
+    from shoptools.checkout.models import ExportJob
+
+    try:
+        run_job(ExportJob.objects.get(pk=job_pk))
+    except Exception:
+        logger.exception('Export job %s failed', job_pk)
+    finally:
+        # threads get their own connection, which Django won't close
+        connection.close()
+
+
+def export_response(modeladmin, request, queryset, exporter, name):
+    """Admin action helper: stream small exports straight back as CSV,
+       otherwise start an export job and point the user to it. """
+
+    if queryset.count() <= shoptools_settings.EXPORT_STREAM_LIMIT:
+        response = StreamingHttpResponse(import_string(exporter)(queryset),
+                                         content_type='text/csv')
+        response['Content-Disposition'] = \
+            "attachment; filename=%s.csv" % name
+        return response
+
+    job = start_export(queryset, exporter, name, user=request.user)
+    modeladmin.message_user(request, format_html(
+        'Export started, <a href="{}">download it here</a> when complete.',
+        reverse('admin:checkout_exportjob_change', args=(job.pk, ))))
+    return None
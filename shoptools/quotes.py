@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Per-process cache of shipping quotes, wrapping SHOPTOOLS_SHIPPING_MODULE's
+calculate(cart) hook. Quotes are keyed by the cart's content signature, its
+region and its shipping option, so carrier-rate lookups in custom shipping
+modules run once per distinct cart rather than on every shipping_cost access.
+
+Disabled unless SHOPTOOLS_SHIPPING_QUOTE_CACHE_TTL (seconds) is set.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+from shoptools import settings as shoptools_settings
+from shoptools.util import get_shipping_module, get_regions_module
+
+
+class QuoteCache(object):
+    """Bounded LRU cache with a time-to-live, which keeps hit/miss stats. """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        """Return (found, value) for key. """
+        now = time.time()
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return (False, None)
+            if expires < now:
+                del self._data[key]
+                self.misses += 1
+                return (False, None)
+            self._data.move_to_end(key)
+            self.hits += 1
+            return (True, value)
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_calculate(self, key, calculate):
+        found, value = self.get(key)
+        if not found:
+            value = calculate()
+            self.set(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._data),
+                'hit_rate': float(self.hits) / lookups if lookups else None,
+            }
+
+
+shipping_quotes = QuoteCache(shoptools_settings.SHIPPING_QUOTE_CACHE_TTL,
+                             shoptools_settings.SHIPPING_QUOTE_CACHE_SIZE)
+
+
+def quote_key(cart):
+    """Cache key for a cart's shipping quote: content signature, region id
+       and shipping option id. """
+
+    region_id = None
+    regions_module = get_regions_module()
+    request = getattr(cart, 'request', None)
+    if regions_module and request is not None:
+        region = regions_module.get_region(request)
+        region_id = region.pk if region else None
+
+    option_id = cart.get_shipping_option() \
+        if hasattr(cart, 'get_shipping_option') else None
+
+    return (cart.content_signature(), region_id, option_id)
+
+
+def calculate_shipping(cart):
+    """Return the shipping module's calculate(cart), via the quote cache if
+       it's enabled. """
+
+    shipping_module = get_shipping_module()
+    if not shipping_module:
+        return 0
+
+    if not shipping_quotes.ttl:
+        return shipping_module.calculate(cart)
+
+    return shipping_quotes.get_or_calculate(
+        quote_key(cart), lambda: shipping_module.calculate(cart))
@@ -25,3 +25,38 @@ DEFAULT_CURRENCY_CODE = getattr(settings, 'SHOPTOOLS_DEFAULT_CURRENCY_CODE',
                                 'NZD')
 DEFAULT_CURRENCY_SYMBOL = getattr(settings,
                                   'SHOPTOOLS_DEFAULT_CURRENCY_SYMBOL', '$')
+
+# Seconds to cache shipping quotes for (0 disables the cache), and the maximum
+# number of quotes kept per process. See shoptools.quotes
+SHIPPING_QUOTE_CACHE_TTL = getattr(
+    settings, 'SHOPTOOLS_SHIPPING_QUOTE_CACHE_TTL', 0)
+SHIPPING_QUOTE_CACHE_SIZE = getattr(
+    settings, 'SHOPTOOLS_SHIPPING_QUOTE_CACHE_SIZE', 1000)
+
+# Reject voucher codes which don't exist using an in-memory Bloom filter,
+# before querying, rebuilt at least every VOUCHER_CODE_FILTER_TTL seconds
+# (0 for never). See shoptools.contrib.vouchers.codes
+VOUCHER_CODE_FILTER = getattr(settings, 'SHOPTOOLS_VOUCHER_CODE_FILTER', True)
+VOUCHER_CODE_FILTER_ERROR_RATE = getattr(
+    settings, 'SHOPTOOLS_VOUCHER_CODE_FILTER_ERROR_RATE', 0.001)
+VOUCHER_CODE_FILTER_TTL = getattr(
+    settings, 'SHOPTOOLS_VOUCHER_CODE_FILTER_TTL', 3600)
+
+# Maximum number of invalid voucher codes a session may enter within the
+# window (in seconds) before further codes are refused
+VOUCHER_ATTEMPT_LIMIT = getattr(settings, 'SHOPTOOLS_VOUCHER_ATTEMPT_LIMIT',
+                                10)
+VOUCHER_ATTEMPT_WINDOW = getattr(settings,
+                                 'SHOPTOOLS_VOUCHER_ATTEMPT_WINDOW', 3600)
+
+# Admin CSV exports of more than EXPORT_STREAM_LIMIT rows are written to
+# MEDIA_ROOT/EXPORT_DIR by a background job instead of in the response. Jobs
+# run in a pool of EXPORT_THREADS threads, or if 0, with
+# ./manage.py run_export_jobs. See shoptools.exports
+EXPORT_STREAM_LIMIT = getattr(settings, 'SHOPTOOLS_EXPORT_STREAM_LIMIT', 1000)
+EXPORT_THREADS = getattr(settings, 'SHOPTOOLS_EXPORT_THREADS', 0)
+EXPORT_DIR = getattr(settings, 'SHOPTOOLS_EXPORT_DIR', 'shoptools/exports')
+EXPORT_GZIP = getattr(settings, 'SHOPTOOLS_EXPORT_GZIP', False)
+# Seconds after which a running export job is assumed to have died (e.g. its
+# process was killed) and is marked failed, 0 for never
+EXPORT_TIMEOUT = getattr(settings, 'SHOPTOOLS_EXPORT_TIMEOUT', 6 * 3600)
@@ -1,5 +1,9 @@
+from unittest import mock
+
 from django.test import TestCase
 
+from shoptools.quotes import QuoteCache
+
 
 class ShoptoolsTestCase(TestCase):
     """Integration tests for shoptools apps. """
@@ -9,3 +13,38 @@ class ShoptoolsTestCase(TestCase):
 
     def test_sample(self):
         self.assertEqual(1, 1)
+
+
+class QuoteCacheTestCase(TestCase):
+    def test_hits_and_misses(self):
+        cache = QuoteCache(ttl=60, max_size=10)
+        calls = []
+
+        def calculate():
+            calls.append(1)
+            return 5
+
+        self.assertEqual(cache.get_or_calculate('a', calculate), 5)
+        self.assertEqual(cache.get_or_calculate('a', calculate), 5)
+        self.assertEqual(len(calls), 1)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+    def test_bounded(self):
+        cache = QuoteCache(ttl=60, max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        # b was least recently used
+        self.assertEqual(cache.get('b'), (False, None))
+        self.assertEqual(cache.get('a'), (True, 1))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_expiry(self):
+        cache = QuoteCache(ttl=60, max_size=2)
+        with mock.patch('shoptools.quotes.time.time', return_value=1000):
+            cache.set('a', 1)
+        with mock.patch('shoptools.quotes.time.time', return_value=1061):
+            self.assertEqual(cache.get('a'), (False, None))